@@ -2,12 +2,16 @@ from .nodes.minicpm_o_loader import MiniCPMLoader
 from .nodes.minicpm_o_image import MiniCPMInference
 from .nodes.minicpm_o_image_analyzer import MiniCPMImageAnalyzer
 from .nodes.minicpm_o_video import MiniCPMVideoInference
+from .nodes.minicpm_o_dataset import MiniCPMDatasetCaptioner
+from .nodes.minicpm_o_audio import MiniCPMAudioInference
 
 NODE_CLASS_MAPPINGS = {
     "Load MiniCPM Model": MiniCPMLoader,
     "MiniCPM Image Chat": MiniCPMInference,
     "MiniCPMImageAnalyzer": MiniCPMImageAnalyzer,
     "MiniCPM Video Chat": MiniCPMVideoInference,
+    "MiniCPM Dataset Captioner": MiniCPMDatasetCaptioner,
+    "MiniCPM Audio Chat": MiniCPMAudioInference,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
@@ -15,6 +19,8 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "MiniCPM Image Chat": "MiniCPM-o image",
     "MiniCPMImageAnalyzer": "MiniCPM-o Image Analyzer",
     "MiniCPM Video Chat": "MiniCPM-o Video",
+    "MiniCPM Dataset Captioner": "MiniCPM-o Dataset Captioner",
+    "MiniCPM Audio Chat": "MiniCPM-o Audio",
 }
 
 __all__ = ['NODE_CLASS_MAPPINGS', 'NODE_DISPLAY_NAME_MAPPINGS']
\ No newline at end of file
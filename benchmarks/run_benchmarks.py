@@ -0,0 +1,299 @@
+"""MiniCPM-o 节点基准测试
+
+使用确定性的替身模型运行 MiniCPMInference、MiniCPMImageAnalyzer、MiniCPMVideoInference 与 MiniCPMAudioInference，
+输入为不同分辨率的合成图像批次、不同时长的合成视频与合成音频，报告吞吐量、延迟分位数与峰值内存，
+并与保存的基线比较。
+
+    python benchmarks/run_benchmarks.py                     # 运行全部场景，存在基线时进行比较
+    python benchmarks/run_benchmarks.py --quick --only video
+    python benchmarks/run_benchmarks.py --save-baseline     # 将本次结果保存为基线
+    python benchmarks/run_benchmarks.py --check             # 有场景退化时以非零状态退出
+    python benchmarks/run_benchmarks.py --replicas 4        # 4 个替身模型副本的数据并行
+"""
+import argparse
+import atexit
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from pathlib import Path
+
+import numpy as np
+import torch
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(BENCH_DIR))
+
+from standins import (StandInModel, StandInTokenizer, install_runtime_standins, synthetic_audio,  # noqa: E402
+                      synthetic_images, synthetic_video)
+
+# 基准过程中不写性能日志
+os.environ.setdefault("MINICPM_METRICS_LOG", "0")
+install_runtime_standins()
+
+# 以独立的包名加载节点模块，避免与 ComfyUI 自身的 nodes 模块冲突
+_package = types.ModuleType("minicpm_o_nodes")
+_package.__path__ = [str(ROOT / "nodes")]
+sys.modules["minicpm_o_nodes"] = _package
+
+from minicpm_o_nodes.minicpm_o_image import MiniCPMInference  # noqa: E402
+from minicpm_o_nodes.minicpm_o_image_analyzer import MiniCPMImageAnalyzer  # noqa: E402
+from minicpm_o_nodes.minicpm_o_video import MiniCPMVideoInference  # noqa: E402
+from minicpm_o_nodes.minicpm_o_audio import MiniCPMAudioInference  # noqa: E402
+from minicpm_o_nodes.minicpm_o_registry import process_rss_bytes  # noqa: E402
+from minicpm_o_nodes.minicpm_o_replicas import ReplicatedModel  # noqa: E402
+
+DEFAULT_BASELINE = BENCH_DIR / "baseline.json"
+SEED = 666666666666666
+AUDIO_DIR = Path(tempfile.mkdtemp(prefix="minicpm_bench_audio_"))
+atexit.register(shutil.rmtree, AUDIO_DIR, ignore_errors=True)
+
+
+def image_scenario(name, count, width, height, **options):
+    def setup():
+        return synthetic_images(count, width, height)
+
+    def run(model, tokenizer, images):
+        return MiniCPMInference().generate(model, tokenizer, images, "Use System Preset", "", SEED,
+                                           cache_mode="Off", vision_cache=False, **options)
+
+    return {"name": name, "setup": setup, "run": run, "items": count, "unit": "images"}
+
+
+def analyzer_scenario(name, width, height, execution_mode):
+    def setup():
+        return synthetic_images(3, width, height).split(1)
+
+    def run(model, tokenizer, images):
+        return MiniCPMImageAnalyzer().analyze(model, tokenizer, *images, SEED, execution_mode=execution_mode,
+                                              cache_mode="Off", vision_cache=False)
+
+    return {"name": name, "setup": setup, "run": run, "items": 3, "unit": "images"}
+
+
+def video_scenario(name, width, height, seconds, fps=30, **options):
+    def setup():
+        return synthetic_video(width, height, int(seconds * fps), fps)
+
+    def run(model, tokenizer, video):
+        return MiniCPMVideoInference().generate(model, tokenizer, video, "Use System Preset", "", SEED,
+                                                cache_mode="Off", **options)
+
+    return {"name": name, "setup": setup, "run": run, "items": seconds, "unit": "video s"}
+
+
+def audio_scenario(name, seconds, sample_rate=44100, channels=2, task="Transcribe", **options):
+    def setup():
+        path = AUDIO_DIR / f"{name}.wav"
+        return str(path) if path.exists() else synthetic_audio(path, seconds, sample_rate, channels)
+
+    def run(model, tokenizer, audio):
+        return MiniCPMAudioInference().generate(model, tokenizer, audio, task, "", SEED, cache_mode="Off", **options)
+
+    return {"name": name, "setup": setup, "run": run, "items": seconds, "unit": "audio s"}
+
+
+def build_scenarios(quick=False):
+    scale = 0.5 if quick else 1.0
+
+    def size(value):
+        return max(64, int(value * scale) // 8 * 8)
+
+    return [
+        image_scenario("image_single_1024", 1, size(1024), size(1024)),
+        image_scenario("image_batch_8x1024", 8, size(1024), size(1024), batch_mode="All Images", micro_batch_size=4),
+        image_scenario("image_batch_4x4k", 2 if quick else 4, size(3840), size(2160), batch_mode="All Images"),
+        image_scenario("image_stream_512", 1, size(512), size(512), streaming=True),
+        image_scenario("image_scheduler_8x768", 8, size(768), size(768), batch_mode="All Images", use_scheduler=True),
+        analyzer_scenario("analyzer_sequential_768", size(768), size(768), "Sequential"),
+        analyzer_scenario("analyzer_batched_768", size(768), size(768), "Batched"),
+        analyzer_scenario("analyzer_concurrent_768", size(768), size(768), "Concurrent"),
+        video_scenario("video_720p_short", size(1280), size(720), 5 if quick else 10),
+        video_scenario("video_1080p_keyframe", size(1920), size(1080), 20 if quick else 60, sampling_mode="Keyframe"),
+        video_scenario("video_720p_long_mapreduce", size(1280), size(720), 120 if quick else 600,
+                       summary_mode="Map-Reduce"),
+        audio_scenario("audio_transcribe_short", 60 if quick else 120),
+        # 长音频使用 22.05kHz 单声道，控制临时文件大小
+        audio_scenario("audio_long_mapreduce", 600 if quick else 3600, 22050, 1, task="Describe",
+                       summary_mode="Map-Reduce"),
+    ]
+
+
+class PeakMemory:
+    """后台线程采样进程常驻内存，记录峰值"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start = process_rss_bytes()
+        self.peak = self.start
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, process_rss_bytes())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, process_rss_bytes())
+
+
+def model_calls(model):
+    if isinstance(model, ReplicatedModel):
+        return sum(replica.calls for replica in model.replica_pool.replicas)
+    return model.calls
+
+
+def run_scenario(scenario, model, tokenizer, repeat, warmup):
+    inputs = scenario["setup"]()
+    sink = io.StringIO()
+    # 节点的 print 输出不计入结果，重定向到内存
+    with contextlib.redirect_stdout(sink):
+        for _ in range(warmup):
+            scenario["run"](model, tokenizer, inputs)
+        calls_before = model_calls(model)
+        latencies = []
+        with PeakMemory() as memory:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                scenario["run"](model, tokenizer, inputs)
+                latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies)
+    total = latencies.sum()
+    return {
+        "unit": scenario["unit"],
+        "runs": repeat,
+        "throughput": round(scenario["items"] * repeat / total, 3) if total > 0 else None,
+        "mean_ms": round(latencies.mean() * 1000, 2),
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+        "p90_ms": round(float(np.percentile(latencies, 90)) * 1000, 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 2),
+        "peak_rss_mb": round(memory.peak / 1024 ** 2, 1),
+        "peak_rss_delta_mb": round((memory.peak - memory.start) / 1024 ** 2, 1),
+        "model_calls_per_run": (model_calls(model) - calls_before) / repeat,
+    }
+
+
+def environment(args):
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "latency_ms": args.latency_ms,
+        "token_ms": args.token_ms,
+        "tokens": args.tokens,
+        "replicas": args.replicas,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """与基线比较，返回退化项列表"""
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        checks = [
+            ("p50_ms", current["p50_ms"], base["p50_ms"], current["p50_ms"] > base["p50_ms"] * (1 + tolerance)),
+            ("throughput", current["throughput"], base["throughput"],
+             current["throughput"] < base["throughput"] * (1 - tolerance)),
+            # 峰值内存增量允许 16MB 的采样噪声
+            ("peak_rss_delta_mb", current["peak_rss_delta_mb"], base["peak_rss_delta_mb"],
+             current["peak_rss_delta_mb"] > base["peak_rss_delta_mb"] * (1 + tolerance) + 16),
+        ]
+        for metric, value, reference, regressed in checks:
+            change = (value - reference) / reference * 100 if reference else 0.0
+            current.setdefault("vs_baseline", {})[metric] = round(change, 1)
+            if regressed:
+                regressions.append(f"{name}.{metric}: {reference} -> {value} ({change:+.1f}%)")
+    return regressions
+
+
+def print_table(results):
+    header = f"{'scenario':<28}{'throughput':>18}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'peak MB':>10}{'Δ p50':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        delta = r.get("vs_baseline", {}).get("p50_ms")
+        delta = f"{delta:+.1f}%" if delta is not None else ""
+        throughput = f"{r['throughput']:.2f} {r['unit']}/s"
+        print(f"{name:<28}{throughput:>18}{r['p50_ms']:>10.1f}{r['p90_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+              f"{r['peak_rss_mb']:>10.1f}{delta:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MiniCPM-o 节点基准测试（替身模型）")
+    parser.add_argument("--quick", action="store_true", help="使用更小的输入，快速检查")
+    parser.add_argument("--only", default="", help="只运行名称包含该字符串的场景，多个用逗号分隔")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="替身模型每次调用的固定延迟")
+    parser.add_argument("--token-ms", type=float, default=0.2, help="替身模型每个 token 的延迟")
+    parser.add_argument("--tokens", type=int, default=64, help="替身模型每个回答的最大 token 数")
+    parser.add_argument("--replicas", type=int, default=1, help="替身模型副本数，大于 1 时按数据并行分发")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="将本次结果写入基线文件")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="判定为退化的相对变化")
+    parser.add_argument("--check", action="store_true", help="存在退化时以状态码 1 退出")
+    parser.add_argument("--output", type=Path, help="将结果写入 JSON 文件")
+    args = parser.parse_args(argv)
+
+    torch.manual_seed(0)
+    model = StandInModel(args.latency_ms, args.token_ms, args.tokens)
+    if args.replicas > 1:
+        replicas = [model] + [StandInModel(args.latency_ms, args.token_ms, args.tokens)
+                              for _ in range(args.replicas - 1)]
+        model = ReplicatedModel(replicas, [f"standin:{i}" for i in range(args.replicas)])
+    tokenizer = StandInTokenizer()
+    filters = [f for f in args.only.split(",") if f]
+    scenarios = [s for s in build_scenarios(args.quick) if not filters or any(f in s["name"] for f in filters)]
+
+    results = {}
+    for scenario in scenarios:
+        print(f"运行 {scenario['name']}...", flush=True)
+        results[scenario["name"]] = run_scenario(scenario, model, tokenizer, args.repeat, args.warmup)
+
+    report = {"environment": environment(args), "results": results}
+    regressions = []
+    if args.baseline.exists() and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        settings = ("quick", "latency_ms", "token_ms", "tokens", "replicas")
+        base_env, current_env = baseline.get("environment", {}), environment(args)
+        if any(base_env.get(key) != current_env[key] for key in settings):
+            print("警告: 基线与本次运行的输入规模或替身模型设置不同，比较结果仅供参考")
+        regressions = compare(results, baseline.get("results", {}), args.tolerance)
+
+    print()
+    print_table(results)
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"\n基线已保存: {args.baseline}")
+    if regressions:
+        print("\n相对基线退化:")
+        for line in regressions:
+            print(f"  {line}")
+        if args.check:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""基准测试使用的替身模型与合成数据
+
+StandInModel 实现与 MiniCPM-o 相同的 model.chat 接口，按可配置的延迟与 token 数返回确定性的文本；
+合成视频以 "synthetic://宽x高x帧数@fps" 形式的路径表示，由 SyntheticVideoReader 按需生成帧，
+替代 decord 的 VideoReader。这样基准只衡量节点自身的 Python 处理开销，结果可复现。
+"""
+import hashlib
+import queue
+import re
+import sys
+import threading
+import time
+import types
+import wave
+
+import numpy as np
+import torch
+from PIL import Image
+
+VOCAB = ("the", "a", "scene", "light", "red", "blue", "person", "walks", "under", "soft", "sky", "street",
+         "tree", "window", "shadow", "bright", "quiet", "wide", "close", "frame")
+
+
+class StandInTokenizer:
+    """按空格分词的替身分词器"""
+
+    def encode(self, text, add_special_tokens=False):
+        return text.split()
+
+    def decode(self, ids, **kwargs):
+        return " ".join(ids)
+
+
+class _Config:
+    def __init__(self):
+        self._name_or_path = "standin/MiniCPM-o-2_6"
+        self.slice_config = {"scale_resolution": 448, "max_slice_nums": 9}
+
+
+# MiniCPM-o 的 chat 只把这些采样参数传给生成，其余关键字参数被丢弃
+GENERATION_KEYS = {"top_p", "top_k", "temperature", "do_sample", "repetition_penalty", "min_new_tokens"}
+
+
+class _TextStreamer:
+    """与 transformers.TextIteratorStreamer 相同的队列式文本流"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def put(self, text):
+        self._queue.put(text)
+
+    def end(self):
+        self._queue.put(None)
+
+    def __iter__(self):
+        while True:
+            text = self._queue.get()
+            if text is None:
+                return
+            yield text
+
+
+class StandInModel:
+    """确定性的 CPU 替身模型
+
+    每次 model.chat 调用耗时 latency_ms + 生成 token 数 × token_ms（批量调用按批内最长的回答计），
+    回答由消息内容的哈希决定，同样的输入总是得到同样的输出。流式调用与 MiniCPM-o 相同：
+    _decode_stream 在后台线程中逐 token 生成，每个 token 后检查 stopping_criteria。
+    """
+
+    def __init__(self, latency_ms=5.0, token_ms=0.2, tokens=64):
+        self.latency = latency_ms / 1000.0
+        self.token_time = token_ms / 1000.0
+        self.tokens = tokens
+        self.config = _Config()
+        self.dtype = torch.float32
+        self.calls = 0
+        self.conversations = 0
+        self.generated_tokens = 0
+        self.decode_kwargs = []
+
+    @staticmethod
+    def _digest(msgs):
+        h = hashlib.sha256()
+        for message in msgs:
+            content = message.get("content")
+            for item in content if isinstance(content, list) else [content]:
+                if isinstance(item, Image.Image):
+                    # 只取尺寸与少量像素，避免哈希整张图的开销计入基准
+                    h.update(f"{item.size}{item.getpixel((0, 0))}".encode())
+                else:
+                    h.update(str(item).encode())
+        return h.digest()
+
+    def _answer(self, msgs, max_new_tokens):
+        digest = self._digest(msgs)
+        count = max(1, min(max_new_tokens, self.tokens - digest[0] % max(1, self.tokens // 4)))
+        return [VOCAB[(digest[i % len(digest)] + i) % len(VOCAB)] for i in range(count)]
+
+    def _generate(self, words, streamer, stopping_criteria=None, **kwargs):
+        try:
+            for i, word in enumerate(words):
+                time.sleep(self.token_time)
+                self.generated_tokens += 1
+                streamer.put(word if i == 0 else " " + word)
+                if stopping_criteria is not None and \
+                        bool(stopping_criteria(torch.zeros((1, i + 1), dtype=torch.long), None).all()):
+                    break
+        finally:
+            streamer.end()
+
+    def _decode_stream(self, words, **kwargs):
+        streamer = _TextStreamer()
+        threading.Thread(target=self._generate, args=(words, streamer), kwargs=kwargs, daemon=True).start()
+        return streamer
+
+    def chat(self, msgs=None, tokenizer=None, max_new_tokens=512, stream=False, **kwargs):
+        self.calls += 1
+        batched = bool(msgs) and isinstance(msgs[0], list)
+        conversations = msgs if batched else [msgs]
+        self.conversations += len(conversations)
+        answers = [self._answer(conversation, max_new_tokens) for conversation in conversations]
+
+        time.sleep(self.latency)
+        if stream and not batched:
+            return iter(self._decode_stream(answers[0], **{k: kwargs[k] for k in GENERATION_KEYS & kwargs.keys()}))
+        texts = self._decode(answers, **{k: kwargs[k] for k in GENERATION_KEYS & kwargs.keys()})
+        return texts if batched else texts[0]
+
+    def _decode(self, answers, **kwargs):
+        """非流式生成；记录收到的生成参数，供测试检查注入的 logits_processor 等参数"""
+        self.decode_kwargs.append(kwargs)
+        time.sleep(self.token_time * max(len(words) for words in answers))
+        return [" ".join(words) for words in answers]
+
+
+def synthetic_images(count, width, height, seed=0):
+    """生成 ComfyUI 格式（NHWC float32，0~1）的确定性图像批次"""
+    generator = torch.Generator().manual_seed(seed)
+    base = torch.rand((count, 1, 1, 3), generator=generator)
+    ramp_x = torch.linspace(0, 1, width).view(1, 1, width, 1)
+    ramp_y = torch.linspace(0, 1, height).view(1, height, 1, 1)
+    return ((base + ramp_x * 0.5 + ramp_y * 0.5) % 1.0).float()
+
+
+def synthetic_video(width, height, frames, fps=30):
+    """返回合成视频的路径标识"""
+    return f"synthetic://{width}x{height}x{frames}@{fps}"
+
+
+def synthetic_audio(path, seconds, sample_rate=44100, channels=2, silence_every=4):
+    """写入合成的 PCM WAV 文件并返回路径
+
+    音高每 30 秒变化一次，每隔 silence_every 分钟有一分钟静音，用于检验静音窗口的跳过。逐分钟写入，不占用大量内存。
+    """
+    rng = np.random.default_rng(0)
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for minute in range(int(np.ceil(seconds / 60))):
+            length = int(min(60, seconds - minute * 60) * sample_rate)
+            t = np.arange(length) / sample_rate
+            pitch = 220 * (1 + (minute * 2 + (t >= 30)) % 5)
+            level = 0.0 if silence_every and minute % silence_every == silence_every - 1 else 0.3
+            samples = level * np.sin(2 * np.pi * pitch * t) + 0.01 * rng.standard_normal(length) * (level > 0)
+            f.writeframes((np.repeat(samples[:, None], channels, axis=1) * 32767).astype(np.int16).tobytes())
+    return str(path)
+
+
+_SYNTHETIC = re.compile(r"synthetic://(\d+)x(\d+)x(\d+)@(\d+(?:\.\d+)?)")
+
+
+class _Batch:
+    def __init__(self, array):
+        self._array = array
+
+    def asnumpy(self):
+        return self._array
+
+
+class SyntheticVideoReader:
+    """按需生成帧的视频读取器，接口与 decord.VideoReader 的常用部分一致
+
+    画面是平移的渐变，每 scene_length 帧切换一次色调，使关键帧选择有镜头切换可检测。
+    """
+
+    def __init__(self, uri, ctx=None, width=-1, height=-1, scene_length=90):
+        match = _SYNTHETIC.fullmatch(str(uri))
+        if match is None:
+            raise ValueError(f"不是合成视频路径: {uri}")
+        source_width, source_height, self._frames, self._fps = (int(match[1]), int(match[2]), int(match[3]),
+                                                               float(match[4]))
+        self.width = width if width > 0 else source_width
+        self.height = height if height > 0 else source_height
+        self.scene_length = scene_length
+        x = np.linspace(0, 255, self.width, dtype=np.float32)
+        y = np.linspace(0, 255, self.height, dtype=np.float32)
+        self._base = ((x[None, :, None] + y[:, None, None]) / 2).astype(np.uint8).repeat(3, axis=2)
+
+    def __len__(self):
+        return self._frames
+
+    def get_avg_fps(self):
+        return self._fps
+
+    def _frame(self, index):
+        shift = (index * 4) % self.width
+        frame = np.roll(self._base, shift, axis=1)
+        tint = np.array([(index // self.scene_length) * 67 % 256, 40, 90], dtype=np.uint8)
+        return frame + tint
+
+    def __getitem__(self, index):
+        return self._frame(index)
+
+    def get_batch(self, indices):
+        return _Batch(np.stack([self._frame(int(i)) for i in indices]))
+
+
+class StandInModelPatcher:
+    """与 comfy.model_patcher.ModelPatcher 方法签名一致的最小替身，只做权重记账"""
+
+    def __init__(self, model, load_device, offload_device, size=0, weight_inplace_update=False):
+        self.model = model
+        self.load_device = load_device
+        self.offload_device = offload_device
+        self.size = size
+        if not hasattr(model, "model_loaded_weight_memory"):
+            model.model_loaded_weight_memory = 0
+
+    def model_size(self):
+        return self.size
+
+    def loaded_size(self):
+        return self.model.model_loaded_weight_memory
+
+    def current_loaded_device(self):
+        return self.load_device if self.model.model_loaded_weight_memory else self.offload_device
+
+    def model_dtype(self):
+        return getattr(self.model, "dtype", None)
+
+    def load(self, device_to=None, lowvram_model_memory=0, force_patch_weights=False, full_load=False):
+        self.model.model_loaded_weight_memory = self.size
+
+    def partially_load(self, device_to, extra_memory=0, force_patch_weights=False):
+        return 0
+
+    def partially_unload(self, device_to, memory_to_free=0, force_patch_weights=False):
+        return 0
+
+    def unpatch_model(self, device_to=None, unpatch_weights=True):
+        self.model.model_loaded_weight_memory = 0
+
+
+def install_runtime_standins():
+    """在导入节点模块之前调用：为缺失的 ComfyUI 模块提供最小替身，并以合成视频读取器替代 decord"""
+    try:
+        import comfy.model_management  # noqa: F401
+    except ImportError:
+        comfy = types.ModuleType("comfy")
+        model_management = types.ModuleType("comfy.model_management")
+        model_management.InterruptProcessingException = type("InterruptProcessingException", (Exception,), {})
+        model_management.free_memory = lambda *args, **kwargs: None
+        model_management.processing_interrupted = lambda: False
+        model_management.throw_exception_if_processing_interrupted = lambda: None
+        comfy.model_management = model_management
+        sys.modules.setdefault("comfy", comfy)
+        sys.modules.setdefault("comfy.model_management", model_management)
+        model_patcher = types.ModuleType("comfy.model_patcher")
+        model_patcher.ModelPatcher = StandInModelPatcher
+        comfy.model_patcher = model_patcher
+        sys.modules.setdefault("comfy.model_patcher", model_patcher)
+    # 基准只读取合成视频，始终使用合成读取器替代 decord
+    decord = types.ModuleType("decord")
+    decord.VideoReader = SyntheticVideoReader
+    decord.cpu = lambda index=0: None
+    sys.modules["decord"] = decord
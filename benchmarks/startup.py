@@ -0,0 +1,141 @@
+"""启动与加载准备耗时
+
+boot:      在新进程中（torch/numpy/PIL 已由 ComfyUI 预先导入）导入本插件的耗时，以及是否带入了重型依赖
+prepare:   加载节点在 from_pretrained 之前的模型目录检查与远程代码同步，分别测量首次检查、
+           重启后命中清单、同一进程内再次加载三种情况
+legacy:    旧流程（导入 transformers 取得缓存目录并每次复制远程代码文件）的耗时，作为对照
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --repeat 10 --output startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+import numpy as np
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+
+HEAVY_MODULES = ("transformers", "decord", "comfy.model_management", "folder_paths")
+
+BOOT_SCRIPT = """
+import importlib.util, json, sys, time
+import torch, numpy, PIL.Image  # ComfyUI 启动时已导入
+before = set(sys.modules)
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("minicpm_o_plugin", {init!r}, submodule_search_locations=[{root!r}])
+module = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = module
+spec.loader.exec_module(module)
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "modules": len(set(sys.modules) - before),
+                  "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+LEGACY_SCRIPT = """
+import json, shutil, time
+from pathlib import Path
+start = time.perf_counter()
+import transformers.utils  # 旧流程从这里取 TRANSFORMERS_CACHE（新版 transformers 已移除该常量）
+target = Path({target!r})
+target.parent.mkdir(parents=True, exist_ok=True)
+shutil.copy2({source!r}, str(target))
+print(json.dumps({{"seconds": time.perf_counter() - start}}))
+"""
+
+
+def run_json(script, env=None):
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            env={**os.environ, **(env or {})})
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def summarize(values):
+    values = np.array(values) * 1000
+    return {"p50_ms": round(float(np.percentile(values, 50)), 2), "min_ms": round(float(values.min()), 2),
+            "max_ms": round(float(values.max()), 2)}
+
+
+def make_model_dir(path, shards=4):
+    """生成文件结构与 MiniCPM-o-2_6 相同的小型模型目录"""
+    path.mkdir(parents=True)
+    (path / "config.json").write_text(json.dumps({"auto_map": {
+        "AutoConfig": "configuration_minicpm.MiniCPMOConfig",
+        "AutoModel": "modeling_minicpmo.MiniCPMO",
+        "AutoModelForCausalLM": "modeling_minicpmo.MiniCPMO",
+    }}))
+    for name in ("configuration_minicpm.py", "modeling_minicpmo.py", "image_processing_minicpmv.py",
+                 "processing_minicpmo.py", "resampler.py"):
+        (path / name).write_text("# stand-in\n" * 2000)
+    weight_map = {}
+    for i in range(shards):
+        shard = f"model-{i + 1:05d}-of-{shards:05d}.safetensors"
+        (path / shard).write_bytes(b"\0" * 4096)
+        weight_map[f"layer{i}.weight"] = shard
+    (path / "model.safetensors.index.json").write_text(json.dumps({"weight_map": weight_map}))
+    (path / "tokenizer_config.json").write_text("{}")
+
+
+def bench_prepare(repeat):
+    # 与节点相同的方式加载 nodes 包，只用到模型文件模块
+    package = types.ModuleType("minicpm_o_nodes")
+    package.__path__ = [str(ROOT / "nodes")]
+    sys.modules["minicpm_o_nodes"] = package
+    from minicpm_o_nodes import minicpm_o_model_files as model_files
+
+    results = {"validated": [], "manifest": [], "memory": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["HF_MODULES_CACHE"] = str(Path(tmp) / "modules")
+        for i in range(repeat):
+            model_dir = Path(tmp) / f"model{i}" / "MiniCPM-o-2_6"
+            make_model_dir(model_dir)
+            name = f"MiniCPM-o-2_6-{i}"
+            files = model_files.ModelFiles()
+            for expected, instance in (("validated", files), ("manifest", model_files.ModelFiles()), ("memory", None)):
+                instance = instance or files
+                start = time.perf_counter()
+                path = instance.prepare(model_dir, name)
+                results[expected].append(time.perf_counter() - start)
+                assert path == expected, (path, expected)
+
+        model_dir = Path(tmp) / "model0" / "MiniCPM-o-2_6"
+        target = Path(tmp) / "legacy" / "image_processing_minicpmv.py"
+        legacy = [run_json(LEGACY_SCRIPT.format(source=str(model_dir / "image_processing_minicpmv.py"),
+                                                target=str(target)))["seconds"]
+                  for _ in range(min(repeat, 3))]
+    return {name: summarize(values) for name, values in results.items()}, summarize(legacy)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MiniCPM-o 插件启动与加载准备耗时")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="将结果写入 JSON 文件")
+    args = parser.parse_args(argv)
+
+    script = BOOT_SCRIPT.format(init=str(ROOT / "__init__.py"), root=str(ROOT), heavy=HEAVY_MODULES)
+    boots = [run_json(script) for _ in range(args.repeat)]
+    report = {
+        "boot": {**summarize([b["seconds"] for b in boots]), "modules_imported": boots[-1]["modules"],
+                 "heavy_modules": boots[-1]["heavy"]},
+    }
+    report["prepare"], report["legacy_prepare"] = bench_prepare(args.repeat)
+
+    print(f"插件导入: p50 {report['boot']['p50_ms']:.1f}ms, 新导入模块 {report['boot']['modules_imported']} 个, "
+          f"重型依赖: {report['boot']['heavy_modules'] or '无'}")
+    for name, stats in report["prepare"].items():
+        print(f"加载准备 ({name}): p50 {stats['p50_ms']:.2f}ms")
+    print(f"加载准备 (旧流程, 含导入 transformers): p50 {report['legacy_prepare']['p50_ms']:.1f}ms")
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
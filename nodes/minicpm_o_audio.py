@@ -0,0 +1,265 @@
+import json
+import re
+import time
+from difflib import SequenceMatcher
+from functools import partial
+
+import torch
+
+from .minicpm_o_cache import RESPONSE_CACHE, CACHE_MODES
+from .minicpm_o_audio_stream import AudioWindowStream
+from .minicpm_o_lazy import LazyModalityModel
+from .minicpm_o_memory import load_for_inference
+from .minicpm_o_metrics import INSTRUMENTATION, PROFILE_MODES
+from .minicpm_o_replicas import replica_count
+from .minicpm_o_scheduler import get_scheduler
+from .minicpm_o_streaming import interrupted, send_progress_text, progress_bar, is_interrupt_exception
+from .minicpm_o_summarize import bounded_ordered_map, chat_text, format_parts, reduce_hierarchically
+
+# 音频编码器输出经池化后每秒约 25 个 token，用于估算推理显存
+AUDIO_TOKENS_PER_SECOND = 25
+
+_PUNCTUATION = re.compile(r"[^\w]+")
+
+
+def _is_cjk(char):
+    return "　" <= char <= "鿿" or "가" <= char <= "힯" or "＀" <= char <= "￯"
+
+
+def _tokens(text):
+    """有空格分隔时按词切分，否则（中文等）按字符切分"""
+    text = text.strip()
+    return text.split() if " " in text else list(text)
+
+
+def _normalize(token):
+    return _PUNCTUATION.sub("", token.lower())
+
+
+def join_text(left, right):
+    """拼接两段文本，中日韩文字之间不加空格"""
+    if not left or not right:
+        return left + right
+    return left + ("" if _is_cjk(left[-1]) or _is_cjk(right[0]) else " ") + right
+
+
+def stitch_overlap(previous, current, max_tokens=48, min_match=3):
+    """去掉 current 开头与 previous 末尾重复转写的部分，返回 current 中应追加的文本
+
+    相邻窗口有一段重叠的音频，这段内容会被转写两次。在 previous 末尾与 current 开头各取 max_tokens
+    个词（或字），忽略大小写与标点找最长的公共片段；片段足够长且位于 previous 末尾附近时，
+    从 current 中该片段之后开始拼接，否则保留 current 的全部内容。
+    """
+    previous_tokens, current_tokens = _tokens(previous), _tokens(current)
+    if not previous_tokens or not current_tokens:
+        return current.strip()
+    tail = previous_tokens[-max_tokens:]
+    head = current_tokens[:max_tokens]
+    tail_norm, head_norm = [_normalize(t) for t in tail], [_normalize(t) for t in head]
+    match = SequenceMatcher(None, tail_norm, head_norm, autojunk=False).find_longest_match(
+        0, len(tail_norm), 0, len(head_norm))
+    # 重复的内容应在上一窗口的结尾处
+    if match.size < min_match or match.a + match.size < len(tail) - max(2, max_tokens // 4):
+        return current.strip()
+    rest = current_tokens[match.b + match.size:]
+    return (" " if " " in current.strip() else "").join(rest)
+
+
+class MiniCPMAudioInference:
+    """MiniCPM 音频理解节点：按重叠窗口流式处理长音频或视频音轨"""
+
+    RETURN_TYPES = ("STRING", "STRING", "STRING")
+    RETURN_NAMES = ("text", "segments", "metrics")
+    FUNCTION = "generate"
+    CATEGORY = "MiniCPM-o"
+
+    TRANSCRIBE_PROMPT = "请仔细听这段音频，逐字转写其中的语音内容，保持原有语言，只输出转写文本，不要添加任何说明。"
+
+    DESCRIBE_PROMPT = "描述这段音频：说话人及其语气、讲话内容要点、背景声音与音乐。只描述听到的内容，不超过三句话，输出为纯文本。"
+
+    # Map-Reduce 模式：合并相邻窗口描述的提示词
+    REDUCE_PROMPT = """以下是同一段音频中连续片段按时间顺序排列的描述：
+
+{parts}
+
+请将它们合并为一段连贯、简洁的描述，保留说话内容和声音变化的先后顺序，去除重复内容，输出为纯文本。"""
+
+    # Map-Reduce 模式：最后一轮合并，按任务提示词生成最终结果
+    FINAL_REDUCE_PROMPT = """以下是同一段音频按时间顺序排列的分段描述：
+
+{parts}
+
+请把整段音频作为一个整体，根据这些描述完成下面的要求，不要逐段复述：
+
+{prompt}"""
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "model": ("MODEL",),
+                "tokenizer": ("TOKENIZER",),
+                # 音频文件，或与视频节点相同的视频路径（读取其音轨）
+                "audio": ("PATH",),
+                "task": (["Transcribe", "Describe", "Custom"], {"default": "Transcribe"}),
+                "prompt": ("STRING", {"multiline": True, "default": ""}),
+                "seed": ("INT", {"default": 666666666666666, "min": 0, "max": 0xffffffffffffffff}),
+                "temperature": ("FLOAT", {"default": 0.3, "min": 0.1, "max": 2.0}),
+                "top_p": ("FLOAT", {"default": 0.9, "min": 0.1, "max": 1.0}),
+                "max_new_tokens": ("INT", {"default": 256, "min": 1, "max": 2048}),
+                "window_seconds": ("FLOAT", {"default": 30.0, "min": 5.0, "max": 120.0, "step": 1.0}),
+                "overlap_seconds": ("FLOAT", {"default": 3.0, "min": 0.0, "max": 30.0, "step": 0.5}),
+            },
+            "optional": {
+                "cache_mode": (CACHE_MODES, {"default": "Memory"}),
+                # 电平低于该值（dBFS）的窗口视为静音，不送入模型；-100 表示不跳过
+                "silence_threshold_db": ("FLOAT", {"default": -50.0, "min": -100.0, "max": 0.0, "step": 1.0}),
+                # 解码预读的窗口数，限制峰值内存
+                "prefetch_windows": ("INT", {"default": 2, "min": 1, "max": 16}),
+                # Describe / Custom 任务的汇总方式：带时间戳逐段拼接，或分层合并为一段结果
+                "summary_mode": (["Concatenate", "Map-Reduce"], {"default": "Concatenate"}),
+                # 每轮合并的片段数
+                "reduce_fan_in": ("INT", {"default": 4, "min": 2, "max": 16}),
+                # 通过共享调度器提交请求，与其他节点的请求合并为动态批次
+                "use_scheduler": ("BOOLEAN", {"default": False}),
+                # 对本次运行进行性能剖析
+                "profile": (PROFILE_MODES, {"default": "Off"}),
+            },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
+            }
+        }
+
+    def chat_window(self, model, tokenizer, samples, final_prompt, seed, temperature, top_p, max_new_tokens,
+                    cache_mode, scheduler=None):
+        """对一个音频窗口调用 model.chat，并按音频内容缓存回答"""
+        def run():
+            chat = partial(scheduler.chat, seed=seed) if scheduler is not None else model.chat
+            return chat(
+                msgs=[{'role': 'user', 'content': [final_prompt, samples]}],
+                tokenizer=tokenizer,
+                temperature=temperature,
+                top_p=top_p,
+                max_new_tokens=max_new_tokens
+            )
+
+        cache_key = RESPONSE_CACHE.make_key(model, [samples], final_prompt, seed, temperature, top_p, max_new_tokens,
+                                            extra="audio") if cache_mode != "Off" else None
+        return RESPONSE_CACHE.cached_chat(cache_mode, cache_key, run)
+
+    def generate(self, model, tokenizer, audio, task, prompt, seed, temperature=0.3, top_p=0.9, max_new_tokens=256,
+                 window_seconds=30.0, overlap_seconds=3.0, cache_mode="Memory", silence_threshold_db=-50.0,
+                 prefetch_windows=2, summary_mode="Concatenate", reduce_fan_in=4, use_scheduler=False,
+                 profile="Off", unique_id=None):
+        """生成回答"""
+        try:
+            # 设置随机种子
+            torch.manual_seed(seed)
+            torch.cuda.manual_seed(seed)
+
+            if not isinstance(model, LazyModalityModel) and getattr(model, "init_audio", True) is False:
+                raise ValueError("模型未启用音频功能，请在加载节点中打开 init_audio 或使用 lazy 模式")
+
+            if task == "Transcribe":
+                final_prompt = self.TRANSCRIBE_PROMPT
+            elif task == "Describe":
+                final_prompt = self.DESCRIBE_PROMPT
+            else:
+                final_prompt = prompt
+            map_reduce = task != "Transcribe" and summary_mode == "Map-Reduce"
+            window_prompt = self.DESCRIBE_PROMPT if map_reduce else final_prompt
+
+            scheduler = get_scheduler(model, tokenizer) if use_scheduler else None
+            # 模型有多个副本或启用调度器时多个窗口并发推理，进行中的窗口数有上限
+            workers = max(scheduler.max_batch_size if scheduler is not None else 1, replica_count(model))
+
+            with INSTRUMENTATION.call("MiniCPMAudioInference", model, profile, task=task) as metrics:
+                stream = AudioWindowStream(audio, window_seconds, overlap_seconds, prefetch=prefetch_windows)
+                print(f"加载音频: {audio}" + (f", 时长={stream.duration:.2f}秒" if stream.duration else ""))
+
+                # 每个窗口的音频 token 数决定预填充长度
+                with metrics.stage("model_load"):
+                    load_for_inference(model, images=0, max_new_tokens=max_new_tokens, batch_size=workers,
+                                       prompt_tokens=int(window_seconds * AUDIO_TOKENS_PER_SECOND) + 128)
+
+                def answer(item):
+                    start, end, samples, level = item
+                    if level < silence_threshold_db:
+                        return start, end, None
+                    text = self.chat_window(model, tokenizer, samples, window_prompt, seed, temperature, top_p,
+                                            max_new_tokens, cache_mode, scheduler)
+                    return start, end, text.strip()
+
+                progress = progress_bar(int(stream.duration)) if stream.duration else None
+                segments = []
+                transcript = ""
+                previous = ""
+                audio_seconds = 0.0
+                start_time = time.perf_counter()
+                with stream:
+                    windows = metrics.timed_iter(stream, "audio_io")
+                    for start, end, text in bounded_ordered_map(answer, windows, workers):
+                        segments.append({"start": round(start, 2), "end": round(end, 2), "text": text,
+                                         "silent": text is None})
+                        audio_seconds = end
+                        if text:
+                            if task == "Transcribe":
+                                transcript = join_text(transcript, stitch_overlap(previous, text))
+                                send_progress_text(transcript, unique_id)
+                            else:
+                                send_progress_text(f"[{start:.0f}s-{end:.0f}s] {text}", unique_id)
+                            previous = text
+                        else:
+                            previous = ""
+                        if progress is not None:
+                            progress.update_absolute(min(int(end), int(stream.duration)), int(stream.duration))
+                        if interrupted():
+                            import comfy.model_management
+                            comfy.model_management.throw_exception_if_processing_interrupted()
+
+                parts = [(s["start"], s["end"], s["text"]) for s in segments if s["text"]]
+                if task == "Transcribe":
+                    response = transcript
+                elif map_reduce and parts:
+                    response, rounds = self.reduce(model, tokenizer, parts, final_prompt, seed, temperature, top_p,
+                                                   max_new_tokens, cache_mode, reduce_fan_in, workers, scheduler)
+                    print(f"分层合并完成: 各轮段数 {rounds}")
+                else:
+                    response = format_parts(parts)
+
+                elapsed = time.perf_counter() - start_time
+                rtf = elapsed / audio_seconds if audio_seconds > 0 else None
+                silent = sum(1 for s in segments if s["silent"])
+                metrics.info.update({"backend": stream.backend, "audio_seconds": round(audio_seconds, 2),
+                                     "windows": len(segments), "silent_windows": silent,
+                                     "rtf": round(rtf, 4) if rtf is not None else None})
+                if rtf:
+                    print(f"音频处理完成: {audio_seconds:.1f}秒音频, {len(segments)} 个窗口（静音 {silent} 个）, "
+                          f"耗时 {elapsed:.2f}秒, 实时率 RTF={rtf:.3f}（{1 / rtf:.1f}x 实时）")
+
+            info = {"backend": stream.backend, "duration": round(audio_seconds, 2),
+                    "rtf": metrics.info["rtf"], "segments": segments}
+            return (response, json.dumps(info, ensure_ascii=False), metrics.to_json())
+
+        except Exception as e:
+            if is_interrupt_exception(e):
+                raise
+            raise RuntimeError(f"处理音频时发生错误: {str(e)}")
+
+    def reduce(self, model, tokenizer, parts, final_prompt, seed, temperature, top_p, max_new_tokens, cache_mode,
+               reduce_fan_in, workers=1, scheduler=None):
+        """把各窗口的描述分层合并为一段结果，返回 (结果, 各轮段数)"""
+        def combine(group, final):
+            if final:
+                text = self.FINAL_REDUCE_PROMPT.format(parts=format_parts(group), prompt=final_prompt)
+            else:
+                text = self.REDUCE_PROMPT.format(parts=format_parts(group))
+            # 每轮的合并并发提交，最后一轮只有一次调用，不必等待调度器的批次窗口
+            return chat_text(model, tokenizer, text, seed, temperature, top_p, max_new_tokens, cache_mode,
+                             None, scheduler, gather=not final)
+
+        return reduce_hierarchically(parts, combine, reduce_fan_in, workers)
+
+    @classmethod
+    def IS_CHANGED(cls, seed, **kwargs):
+        return seed
@@ -0,0 +1,239 @@
+import queue
+import shutil
+import subprocess
+import threading
+import wave
+
+import numpy as np
+
+# MiniCPM-o 的音频编码器（Whisper）输入为 16kHz 单声道
+SAMPLE_RATE = 16000
+
+
+def _resampled(blocks, source_rate, target_rate):
+    """用 soxr 的流式重采样把样本块转换到目标采样率，块与块之间保持连续（soxr 随 librosa 一起安装）"""
+    if source_rate == target_rate:
+        yield from blocks
+        return
+    import soxr
+    resampler = soxr.ResampleStream(source_rate, target_rate, 1, dtype="float32")
+    for block in blocks:
+        yield resampler.resample_chunk(block.astype(np.float32, copy=False))
+    yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+
+# 标准库 wave 可直接解码的 PCM 采样位宽（字节）
+WAVE_SAMPLE_WIDTHS = (1, 2, 3, 4)
+
+
+def _pcm_to_float(data, width):
+    """小端 PCM 字节转换为 [-1, 1) 的 float32；24 bit 样本左移 8 位按 int32 解码"""
+    if width == 3:
+        padded = np.zeros((len(data) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        return padded.view("<i4").reshape(-1).astype(np.float32) / float(2 ** 31)
+    samples = np.frombuffer(data, dtype={1: np.uint8, 2: "<i2", 4: "<i4"}[width]).astype(np.float32)
+    if width == 1:
+        samples -= 128.0
+    return samples / float(2 ** (width * 8 - 1))
+
+
+def _wave_blocks(path, block_seconds, sample_rate):
+    """标准库 wave 读取 PCM WAV，逐块转换为单声道 float32"""
+    with wave.open(str(path), "rb") as f:
+        channels, width, rate = f.getnchannels(), f.getsampwidth(), f.getframerate()
+        frames = int(block_seconds * rate)
+
+        def blocks():
+            while True:
+                data = f.readframes(frames)
+                if not data:
+                    return
+                yield _pcm_to_float(data, width).reshape(-1, channels).mean(axis=1)
+
+        yield from _resampled(blocks(), rate, sample_rate)
+
+
+def _ffmpeg_blocks(path, block_seconds, sample_rate):
+    """ffmpeg 解码任意音频或视频文件的音轨，由 ffmpeg 流式转换为 16kHz 单声道"""
+    process = subprocess.Popen(
+        [shutil.which("ffmpeg"), "-nostdin", "-v", "error", "-i", str(path), "-vn", "-ac", "1",
+         "-ar", str(sample_rate), "-f", "f32le", "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    block_bytes = int(block_seconds * sample_rate) * 4
+    try:
+        while True:
+            data = process.stdout.read(block_bytes)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) // 4 * 4], dtype=np.float32)
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg 解码失败: {process.stderr.read().decode(errors='replace').strip()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def _soundfile_blocks(path, block_seconds, sample_rate):
+    import soundfile
+    with soundfile.SoundFile(str(path)) as f:
+        rate = f.samplerate
+        blocks = (block.mean(axis=1) for block in
+                  f.blocks(blocksize=int(block_seconds * rate), dtype="float32", always_2d=True))
+        yield from _resampled(blocks, rate, sample_rate)
+
+
+def _decord_blocks(path, block_seconds, sample_rate):
+    """没有 ffmpeg 时读取视频音轨；decord 会一次解码整条音轨，内存随时长增长"""
+    from decord import AudioReader, cpu
+    print("警告: 未找到 ffmpeg，使用 decord 读取音轨，整条音轨会一次性解码到内存")
+    reader = AudioReader(str(path), ctx=cpu(0), sample_rate=sample_rate, mono=True)
+    total = reader.shape[1]
+    step = int(block_seconds * sample_rate)
+    for start in range(0, total, step):
+        yield reader[start:min(start + step, total)].asnumpy().reshape(-1).astype(np.float32)
+
+
+def _probe_duration(path):
+    """尽量不解码地获取时长（秒），无法获取时返回 None"""
+    try:
+        if str(path).lower().endswith(".wav"):
+            with wave.open(str(path), "rb") as f:
+                return f.getnframes() / f.getframerate()
+        if shutil.which("ffprobe"):
+            output = subprocess.run(
+                ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", str(path)],
+                capture_output=True, text=True, timeout=30)
+            return float(output.stdout.strip())
+        import soundfile
+        return soundfile.info(str(path)).duration
+    except Exception:
+        return None
+
+
+def open_audio(path, block_seconds=60.0, sample_rate=SAMPLE_RATE):
+    """打开音频文件或视频文件的音轨，返回 (16kHz 单声道 float32 样本块的迭代器, 后端名称)
+
+    依次尝试：标准库 wave（PCM WAV）、ffmpeg（任意容器，含视频音轨）、soundfile、decord。
+    除 decord 外都按块流式解码，内存占用与文件时长无关。
+    """
+    path = str(path)
+    if path.lower().endswith(".wav"):
+        # 解码在后台线程中才开始，这里先确认格式与位宽，不支持时交给其他后端
+        try:
+            with wave.open(path, "rb") as f:
+                supported = f.getsampwidth() in WAVE_SAMPLE_WIDTHS
+        except (wave.Error, EOFError):
+            supported = False
+        if supported:
+            return _wave_blocks(path, block_seconds, sample_rate), "wave"
+    if shutil.which("ffmpeg"):
+        return _ffmpeg_blocks(path, block_seconds, sample_rate), "ffmpeg"
+    try:
+        import soundfile
+        soundfile.info(path)
+        return _soundfile_blocks(path, block_seconds, sample_rate), "soundfile"
+    except Exception:
+        pass
+    return _decord_blocks(path, block_seconds, sample_rate), "decord"
+
+
+def iter_windows(blocks, window, hop, min_samples=1):
+    """把连续的样本块切成长度为 window、步长为 hop 的重叠窗口
+
+    产出 (起始样本, 窗口样本, 电平 dBFS)。每个样本块中所有窗口的电平一次性算出，
+    缓冲区最多保留一个窗口加一个样本块。最后不足一个窗口的部分只要包含足够的新样本也会输出。
+    """
+    buffer = np.zeros(0, dtype=np.float32)
+    offset = 0
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        if len(buffer) < window:
+            continue
+        count = (len(buffer) - window) // hop + 1
+        # 用平方和的前缀和一次算出所有窗口的电平
+        energy = np.concatenate([[0.0], np.cumsum(np.square(buffer, dtype=np.float64))])
+        starts = np.arange(count) * hop
+        levels = 10 * np.log10((energy[starts + window] - energy[starts]) / window + 1e-12)
+        for start, level in zip(starts, levels):
+            yield offset + int(start), buffer[start:start + window].copy(), float(level)
+        buffer = buffer[count * hop:].copy()
+        offset += count * hop
+    # 前一个窗口已覆盖缓冲区开头的 window - hop 个样本
+    fresh = len(buffer) - (window - hop if offset > 0 else 0)
+    if fresh >= min_samples:
+        level = 10 * np.log10(np.mean(np.square(buffer, dtype=np.float64)) + 1e-12)
+        yield offset, buffer, float(level)
+
+
+class _StreamEnd:
+    pass
+
+
+class AudioWindowStream:
+    """后台线程解码音频并切分为重叠窗口
+
+    通过有界队列限制预读的窗口数，解码与推理重叠，内存占用与音频时长无关。
+    产出 (起始秒, 结束秒, 16kHz 样本, 电平 dBFS)。
+    """
+
+    def __init__(self, path, window_seconds=30.0, overlap_seconds=3.0, block_seconds=60.0, prefetch=2,
+                 sample_rate=SAMPLE_RATE):
+        if overlap_seconds >= window_seconds:
+            raise ValueError("重叠时长必须小于窗口时长")
+        self.path = path
+        self.sample_rate = sample_rate
+        self.window = int(window_seconds * sample_rate)
+        self.hop = self.window - int(overlap_seconds * sample_rate)
+        self.block_seconds = max(block_seconds, window_seconds)
+        self.duration = _probe_duration(path)
+        self.backend = None
+        self._queue = queue.Queue(maxsize=max(1, prefetch))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self):
+        try:
+            blocks, self.backend = open_audio(self.path, self.block_seconds, self.sample_rate)
+            # 少于 0.5 秒的尾部不单独送入模型
+            for start, samples, level in iter_windows(blocks, self.window, self.hop, self.sample_rate // 2):
+                item = (start / self.sample_rate, (start + len(samples)) / self.sample_rate, samples, level)
+                if not self._put(item):
+                    return
+            self._put(_StreamEnd)
+        except Exception as e:
+            self._put(e)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._worker, name="minicpm-audio-decode", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _StreamEnd:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
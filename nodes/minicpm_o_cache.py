@@ -0,0 +1,206 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+CACHE_MODES = ["Memory", "Memory + Disk", "Off"]
+
+
+def hash_image(image):
+    """计算图像内容哈希，支持 PIL Image、numpy 数组和 torch tensor"""
+    h = hashlib.sha256()
+    if hasattr(image, "tobytes") and hasattr(image, "mode") and hasattr(image, "size"):
+        # PIL Image
+        h.update(f"pil:{image.mode}:{image.size}".encode())
+        h.update(image.tobytes())
+    elif hasattr(image, "detach"):
+        # torch tensor
+        array = image.detach().cpu().contiguous().numpy()
+        h.update(f"tensor:{array.dtype}:{array.shape}".encode())
+        h.update(array.tobytes())
+    elif hasattr(image, "tobytes"):
+        # numpy 数组
+        h.update(f"array:{image.dtype}:{image.shape}".encode())
+        h.update(image.tobytes())
+    else:
+        h.update(repr(image).encode())
+    return h.hexdigest()
+
+
+def model_identity(model):
+    """返回跨进程稳定的模型标识
+
+    模型路径 + dtype；由 MiniCPMLoader 加载的模型再附加加载键（设备、量化、模态、延迟加载、内存限制与副本配置）的哈希。
+    """
+    config = getattr(model, "config", None)
+    name = getattr(config, "_name_or_path", None) or getattr(model, "name_or_path", None) or type(model).__name__
+    dtype = getattr(model, "dtype", "")
+    load_key = getattr(model, "_minicpm_load_key", None)
+    if load_key is None:
+        return f"{name}:{dtype}"
+    return f"{name}:{dtype}:{hashlib.sha256(repr(load_key).encode()).hexdigest()[:16]}"
+
+
+class ResponseCache:
+    """内容寻址的回答缓存
+
+    键为图像/帧内容、提示词、模型标识与采样参数的哈希。内存层为 LRU，
+    可选的磁盘层使用 ComfyUI 输出目录下的 SQLite 文件，进程崩溃后重跑可直接复用。
+    """
+
+    def __init__(self, max_memory_entries=1024, max_disk_entries=200000, disk_path=None):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._disk_path = disk_path
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()
+        self._conn = None
+        # 磁盘层行数的进程内计数，连接建立时统计一次，避免每次写入都执行 COUNT(*)
+        self._disk_count = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, images, prompt, seed, temperature, top_p, max_new_tokens, extra=None):
+        """构建缓存键，images 为图像列表（可为空）"""
+        h = hashlib.sha256()
+        h.update(model_identity(model).encode())
+        for image in images or []:
+            h.update(hash_image(image).encode())
+        h.update(b"\0")
+        h.update(str(prompt).encode())
+        h.update(f"\0{seed}\0{float(temperature)!r}\0{float(top_p)!r}\0{int(max_new_tokens)}".encode())
+        if extra is not None:
+            h.update(f"\0{extra}".encode())
+        return h.hexdigest()
+
+    def _get_disk_path(self):
+        if self._disk_path is None:
+            import folder_paths
+            self._disk_path = Path(folder_paths.get_output_directory()) / "minicpm_cache" / "responses.sqlite"
+        return Path(self._disk_path)
+
+    def _get_conn(self):
+        if self._conn is None:
+            path = self._get_disk_path()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(path), check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.commit()
+            self._disk_count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return self._conn
+
+    def get(self, key, use_disk=False):
+        """查询缓存，未命中返回 None"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+
+            if use_disk:
+                try:
+                    conn = self._get_conn()
+                    row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+                        conn.commit()
+                        self.disk_hits += 1
+                        self._put_memory(key, row[0])
+                        return row[0]
+                except sqlite3.Error as e:
+                    print(f"读取磁盘缓存失败: {e}")
+
+            self.misses += 1
+            return None
+
+    def put(self, key, response, use_disk=False):
+        """写入缓存"""
+        if not isinstance(response, str):
+            return
+        with self._lock:
+            self._put_memory(key, response)
+            if use_disk:
+                try:
+                    conn = self._get_conn()
+                    # 按主键查询是否已存在，覆盖写入不增加行数
+                    exists = conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is not None
+                    conn.execute(
+                        "INSERT OR REPLACE INTO responses (key, response, accessed) VALUES (?, ?, ?)",
+                        (key, response, time.time())
+                    )
+                    if not exists:
+                        self._disk_count += 1
+                    self._trim_disk(conn)
+                    conn.commit()
+                except sqlite3.Error as e:
+                    print(f"写入磁盘缓存失败: {e}")
+
+    def _put_memory(self, key, response):
+        self._memory[key] = response
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _trim_disk(self, conn):
+        if self._disk_count <= self.max_disk_entries:
+            return
+        # 计数超限时重新统计，修正其他进程写入同一文件造成的偏差
+        self._disk_count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        overflow = self._disk_count - self.max_disk_entries
+        if overflow > 0:
+            deleted = conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed ASC LIMIT ?)",
+                (overflow,)
+            ).rowcount
+            self._disk_count -= deleted
+
+    def clear(self, disk=False):
+        """清空缓存"""
+        with self._lock:
+            self._memory.clear()
+            if disk:
+                conn = self._get_conn()
+                conn.execute("DELETE FROM responses")
+                conn.commit()
+                self._disk_count = 0
+
+    def stats(self):
+        """返回命中率统计"""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": self._disk_count if self._conn is not None else None,
+            }
+
+    def cached_chat(self, cache_mode, key, compute):
+        """按缓存模式查询，未命中时调用 compute() 生成并写回"""
+        if cache_mode == "Off":
+            return compute()
+        use_disk = cache_mode == "Memory + Disk"
+        response = self.get(key, use_disk)
+        if response is None:
+            response = compute()
+            self.put(key, response, use_disk)
+        return response
+
+
+# 进程级单例
+RESPONSE_CACHE = ResponseCache(
+    max_memory_entries=int(os.environ.get("MINICPM_RESPONSE_CACHE_SIZE", "1024")),
+    max_disk_entries=int(os.environ.get("MINICPM_RESPONSE_CACHE_DISK_ENTRIES", "200000")),
+)
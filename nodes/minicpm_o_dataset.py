@@ -0,0 +1,352 @@
+import glob
+import hashlib
+import json
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+from .minicpm_o_cache import RESPONSE_CACHE, CACHE_MODES, model_identity
+from .minicpm_o_image import MiniCPMInference
+from .minicpm_o_preprocess import tensor_to_pil, model_max_pixels
+from .minicpm_o_prefix_cache import PREFIX_CACHE
+from .minicpm_o_scheduler import get_scheduler
+from .minicpm_o_streaming import interrupted, send_progress_text, progress_bar
+from .minicpm_o_memory import load_for_inference
+from .minicpm_o_metrics import INSTRUMENTATION, PROFILE_MODES
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff", ".gif"}
+
+
+def list_images(source):
+    """解析输入源，返回 (图像路径列表, 默认输出目录)
+
+    source 可以是目录（递归查找图像）、glob 模式，或每行一个 JSON 对象的清单文件，
+    清单中的 "file"/"image"/"path" 字段为图像路径，相对路径以清单所在目录为基准。
+    """
+    source = os.path.expanduser(source.strip())
+    path = Path(source)
+    if path.is_file() and path.suffix.lower() == ".jsonl":
+        files = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                name = entry.get("file") or entry.get("image") or entry.get("path")
+                if name:
+                    files.append(Path(name) if Path(name).is_absolute() else path.parent / name)
+        return files, path.parent
+    if path.is_dir():
+        files = sorted(p for p in path.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS and p.is_file())
+        return files, path
+    files = sorted(Path(p) for p in glob.glob(source, recursive=True)
+                   if Path(p).suffix.lower() in IMAGE_EXTENSIONS)
+    root = Path(os.path.commonpath([str(p.parent) for p in files])) if files else Path(".")
+    return files, root
+
+
+def load_image_tensor(path):
+    """按 ComfyUI LoadImage 的方式解码为 HWC float tensor，保证与交互节点的输入逐像素一致"""
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode == "I":
+            img = img.point(lambda i: i * (1 / 255))
+        image = np.array(img.convert("RGB")).astype(np.float32) / 255.0
+    return torch.from_numpy(image)
+
+
+def run_hash(model, prompt, seed, temperature, top_p, max_new_tokens, prefix_cache=False):
+    """模型、提示词、采样参数与消息格式的哈希，任一项改变时已有描述失效"""
+    h = hashlib.sha256()
+    h.update(model_identity(model).encode())
+    h.update(f"\0{prompt}\0{seed}\0{float(temperature)!r}\0{float(top_p)!r}\0{int(max_new_tokens)}".encode())
+    if prefix_cache:
+        # 前缀复用改变消息格式，描述可能不同；关闭时不写入，保持已有检查点有效
+        h.update(b"\0prefix")
+    return h.hexdigest()[:16]
+
+
+class CaptionState:
+    """以追加写入的 JSONL 文件记录已完成的描述，作为断点续跑的检查点
+
+    每条记录包含图像路径、文件大小与修改时间、运行哈希和描述文本，同一图像以最后一条记录为准。
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.records = {}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时可能留下不完整的最后一行
+                        continue
+                    self.records[record["file"]] = record
+        self._file = None
+
+    @staticmethod
+    def _signature(path):
+        stat = os.stat(path)
+        return stat.st_size, int(stat.st_mtime)
+
+    def is_done(self, key, path, hash_value):
+        record = self.records.get(key)
+        if record is None or record.get("hash") != hash_value:
+            return False
+        try:
+            return [record.get("size"), record.get("mtime")] == list(self._signature(path))
+        except OSError:
+            return False
+
+    def append(self, records):
+        """追加一批记录并刷新到磁盘"""
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        for record in records:
+            self.records[record["file"]] = record
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self, compact=True):
+        """关闭文件；compact 为 True 时去除重复记录后原子替换"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if compact and self.records:
+            tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                for record in self.records.values():
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            os.replace(tmp, self.path)
+
+
+def sidecar_paths(files):
+    """返回 {图像路径: .txt 描述文件路径}
+
+    通常与图像同名（a.png -> a.txt）；同一目录下主文件名相同的图像（a.png 与 a.jpg）保留原扩展名
+    （a.png.txt、a.jpg.txt），避免互相覆盖。按整个数据集判断，续跑时文件名保持不变。
+    """
+    files = [Path(p) for p in files]
+    # 不区分大小写，Windows 上 a.txt 与 A.txt 是同一个文件
+    stems = Counter((str(p.parent).lower(), p.stem.lower()) for p in files)
+    return {
+        p: p.with_suffix(".txt") if stems[(str(p.parent).lower(), p.stem.lower())] == 1 else p.with_name(p.name + ".txt")
+        for p in files
+    }
+
+
+def write_sidecar(target, caption):
+    """写入 .txt 描述文件（先写临时文件再替换，避免留下半截文件）"""
+    target = Path(target)
+    tmp = target.with_name(target.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(caption)
+    os.replace(tmp, target)
+
+
+class MiniCPMDatasetCaptioner:
+    """MiniCPM 批量数据集描述节点
+
+    直接从目录、glob 模式或 JSONL 清单读取图像，线程池并行解码，按批次调用模型，
+    并逐批写出 .txt 与 JSONL 描述。提示词模板与采样参数与 MiniCPM-o image 节点一致。
+    """
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("summary",)
+    FUNCTION = "caption"
+    CATEGORY = "MiniCPM-o"
+    OUTPUT_NODE = True
+
+    TEMPLATE_PROMPT = MiniCPMInference.TEMPLATE_PROMPT
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "model": ("MODEL",),
+                "tokenizer": ("TOKENIZER",),
+                # 图像目录、glob 模式（如 /data/**/*.png）或 JSONL 清单
+                "source": ("STRING", {"default": ""}),
+                "prompt_mode": (["Use System Preset", "Use Custom Input"], {"default": "Use System Preset"}),
+                "prompt": ("STRING", {"multiline": True, "default": ""}),
+                "seed": ("INT", {"default": 666666666666666, "min": 0, "max": 0xffffffffffffffff}),
+                "temperature": ("FLOAT", {"default": 0.7, "min": 0.1, "max": 2.0}),
+                "top_p": ("FLOAT", {"default": 0.9, "min": 0.1, "max": 1.0}),
+                "max_new_tokens": ("INT", {"default": 512, "min": 1, "max": 2048}),
+            },
+            "optional": {
+                "output_format": (["txt + jsonl", "txt", "jsonl"], {"default": "txt + jsonl"}),
+                # JSONL 输出（同时作为检查点）路径，留空时写到输入目录下的 captions.jsonl
+                "jsonl_path": ("STRING", {"default": ""}),
+                "batch_size": ("INT", {"default": 4, "min": 1, "max": 64}),
+                "decode_workers": ("INT", {"default": 4, "min": 1, "max": 32}),
+                # 忽略检查点，重新描述所有图像
+                "overwrite": ("BOOLEAN", {"default": False}),
+                # 最多处理的图像数，0 表示不限
+                "limit": ("INT", {"default": 0, "min": 0, "max": 10000000}),
+                "cache_mode": (CACHE_MODES, {"default": "Memory"}),
+                "vision_cache": ("BOOLEAN", {"default": False}),
+                "use_scheduler": ("BOOLEAN", {"default": False}),
+                "prefix_cache": ("BOOLEAN", {"default": False}),
+                # 对本次运行进行性能剖析
+                "profile": (PROFILE_MODES, {"default": "Off"}),
+            },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
+            }
+        }
+
+    def caption(self, model, tokenizer, source, prompt_mode, prompt, seed, temperature=0.7, top_p=0.9,
+                max_new_tokens=512, output_format="txt + jsonl", jsonl_path="", batch_size=4, decode_workers=4,
+                overwrite=False, limit=0, cache_mode="Memory", vision_cache=False, use_scheduler=False,
+                prefix_cache=False, profile="Off", unique_id=None):
+        """为数据集中的图像生成描述"""
+        torch.manual_seed(seed)
+        torch.cuda.manual_seed(seed)
+
+        files, root = list_images(source)
+        if not files:
+            raise ValueError(f"未找到图像: {source}")
+
+        final_prompt = self.TEMPLATE_PROMPT if prompt_mode == "Use System Preset" else prompt
+        hash_value = run_hash(model, final_prompt, seed, temperature, top_p, max_new_tokens, prefix_cache)
+        write_txt = "txt" in output_format
+        sidecars = sidecar_paths(files) if write_txt else {}
+        state = CaptionState(jsonl_path.strip() or root / "captions.jsonl")
+
+        def key_of(path):
+            try:
+                return str(Path(path).resolve().relative_to(root.resolve()))
+            except ValueError:
+                return str(Path(path).resolve())
+
+        # 跳过检查点中运行哈希与文件签名都一致的图像
+        todo = [p for p in files if overwrite or not state.is_done(key_of(p), p, hash_value)]
+        if limit:
+            todo = todo[:limit]
+        skipped = len(files) - len(todo)
+        print(f"数据集: 共 {len(files)} 张, 已完成 {skipped} 张, 待处理 {len(todo)} 张")
+
+        use_cache = cache_mode != "Off"
+        use_disk = cache_mode == "Memory + Disk"
+        cache_extra = "prefix" if prefix_cache else None
+        max_pixels = model_max_pixels(model)
+        scheduler = get_scheduler(model, tokenizer, max_batch_size=max(8, batch_size)) if use_scheduler else None
+        # 数据集中图像尺寸不一，按切片上限预留推理显存
+        load_for_inference(model, max_new_tokens=max_new_tokens,
+                           batch_size=scheduler.max_batch_size if scheduler is not None else batch_size)
+        if prefix_cache:
+            PREFIX_CACHE.prepare(model, tokenizer, final_prompt)
+        inference = MiniCPMInference()
+
+        def decode(path):
+            try:
+                tensor = load_image_tensor(path)
+                return path, tensor, tensor_to_pil(tensor, max_pixels), None
+            except Exception as e:
+                return path, None, None, e
+
+        done = failed = 0
+        start_time = time.perf_counter()
+        progress = progress_bar(len(todo))
+        batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+
+        try:
+            with INSTRUMENTATION.call("MiniCPMDatasetCaptioner", model, profile, images=len(todo)) as metrics, \
+                    ThreadPoolExecutor(max_workers=decode_workers) as executor:
+                # 预先提交后两批的解码任务，解码与推理重叠且内存有上限
+                pending = deque()
+                next_batch = 0
+                while next_batch < len(batches) and len(pending) < 2:
+                    pending.append([executor.submit(decode, p) for p in batches[next_batch]])
+                    next_batch += 1
+
+                while pending:
+                    # 等待解码的时间，持续偏高说明瓶颈在图像读取
+                    with metrics.stage("decode_wait"):
+                        decoded = [future.result() for future in pending.popleft()]
+                    if next_batch < len(batches):
+                        pending.append([executor.submit(decode, p) for p in batches[next_batch]])
+                        next_batch += 1
+
+                    if interrupted():
+                        import comfy.model_management
+                        comfy.model_management.throw_exception_if_processing_interrupted()
+
+                    records = []
+                    ready = []
+                    for path, tensor, pil_image, error in decoded:
+                        if error is not None:
+                            print(f"无法读取图像 {path}: {error}")
+                            failed += 1
+                            continue
+                        key = RESPONSE_CACHE.make_key(model, [tensor], final_prompt, seed, temperature, top_p,
+                                                      max_new_tokens, extra=cache_extra) if use_cache else None
+                        cached = RESPONSE_CACHE.get(key, use_disk) if use_cache else None
+                        ready.append((path, key, pil_image, cached))
+
+                    missing = [item for item in ready if item[3] is None]
+                    responses = iter(inference.chat_batch(
+                        model, tokenizer, [item[2] for item in missing], final_prompt, temperature, top_p,
+                        max_new_tokens, vision_cache, None, scheduler, prefix_cache, seed
+                    ) if missing else [])
+
+                    for path, key, _, cached in ready:
+                        caption = cached
+                        if caption is None:
+                            caption = next(responses)
+                            if use_cache:
+                                RESPONSE_CACHE.put(key, caption, use_disk)
+                        if write_txt:
+                            write_sidecar(sidecars[Path(path)], caption)
+                        size, mtime = CaptionState._signature(path)
+                        records.append({"file": key_of(path), "caption": caption, "hash": hash_value,
+                                        "size": size, "mtime": mtime})
+
+                    # 每批写入检查点，崩溃后最多丢失一个批次
+                    state.append(records)
+                    done += len(records)
+
+                    processed = done + failed
+                    elapsed = time.perf_counter() - start_time
+                    rate = processed / elapsed if elapsed > 0 else 0.0
+                    eta = (len(todo) - processed) / rate if rate > 0 else 0.0
+                    message = f"{processed}/{len(todo)} 张, {rate:.2f} 张/秒, 预计剩余 {eta:.0f} 秒"
+                    print(f"批量描述: {message}")
+                    send_progress_text(message, unique_id)
+                    if progress is not None:
+                        progress.update(len(decoded))
+        finally:
+            # 仅输出 .txt 时检查点文件仍然保留，用于续跑判断
+            state.close()
+
+        elapsed = time.perf_counter() - start_time
+        summary = {
+            "total": len(files),
+            "captioned": done,
+            "skipped": skipped,
+            "failed": failed,
+            "elapsed": round(elapsed, 2),
+            "images_per_sec": round(done / elapsed, 3) if elapsed > 0 else 0.0,
+            "jsonl": str(state.path),
+            "metrics": metrics.as_dict(),
+        }
+        if scheduler is not None:
+            print(f"推理调度器: {scheduler.stats()}")
+        print(f"批量描述完成: {summary}")
+        return (json.dumps(summary, ensure_ascii=False),)
+
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        # 目录内容可能变化，每次都重新执行；已完成的图像由检查点跳过
+        return float("nan")
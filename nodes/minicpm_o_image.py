@@ -1,12 +1,23 @@
 import torch
 from PIL import Image
 import numpy as np
+from .minicpm_o_cache import RESPONSE_CACHE, CACHE_MODES
+from .minicpm_o_vision_cache import VISION_CACHE
+from .minicpm_o_streaming import stream_chat, parse_stop_strings, stream_cache_extra
+from .minicpm_o_preprocess import tensor_batch_to_pil, model_max_pixels
+from .minicpm_o_scheduler import get_scheduler
+from .minicpm_o_prefix_cache import PREFIX_CACHE, build_messages
+from .minicpm_o_metrics import INSTRUMENTATION, PROFILE_MODES
+from .minicpm_o_summarize import bounded_ordered_map
+from .minicpm_o_replicas import replica_count
+from .minicpm_o_memory import load_for_inference, image_crops
 
 class MiniCPMInference:
     """MiniCPM 推理节点"""
     
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("response",)
+    RETURN_TYPES = ("STRING", "STRING", "STRING")
+    RETURN_NAMES = ("response", "captions", "metrics")
+    OUTPUT_IS_LIST = (False, True, False)
     FUNCTION = "generate"
     CATEGORY = "MiniCPM-o"
 
@@ -30,10 +41,88 @@ Please ensure the description is based on visible information in the image, avoi
                 "temperature": ("FLOAT", {"default": 0.7, "min": 0.1, "max": 2.0}),
                 "top_p": ("FLOAT", {"default": 0.9, "min": 0.1, "max": 1.0}),
                 "max_new_tokens": ("INT", {"default": 512, "min": 1, "max": 2048}),
+            },
+            "optional": {
+                # 批处理模式：仅处理第一张图片，或为批次中的每张图片生成描述
+                "batch_mode": (["First Image", "All Images"], {"default": "First Image"}),
+                "micro_batch_size": ("INT", {"default": 4, "min": 1, "max": 64}),
+                "caption_delimiter": ("STRING", {"default": "\\n\\n"}),
+                "cache_mode": (CACHE_MODES, {"default": "Memory"}),
+                # 缓存同一图片的视觉编码结果
+                "vision_cache": ("BOOLEAN", {"default": True}),
+                # 流式输出：逐块推送部分文本，可在 token 之间中断，并支持提前停止
+                "streaming": ("BOOLEAN", {"default": False}),
+                "stop_strings": ("STRING", {"multiline": True, "default": ""}),
+                "max_sentences": ("INT", {"default": 0, "min": 0, "max": 100}),
+                # 通过共享调度器提交请求，与其他节点的请求合并为动态批次（不使用视觉编码缓存）
+                "use_scheduler": ("BOOLEAN", {"default": False}),
+                # 将提示词放入 system 消息并复用其预填充的 KV 缓存（单张推理时生效）
+                "prefix_cache": ("BOOLEAN", {"default": False}),
+                # 对本次运行进行性能剖析
+                "profile": (PROFILE_MODES, {"default": "Off"}),
+            },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
             }
         }
 
-    def generate(self, model, tokenizer, image, prompt_mode, prompt, seed, temperature=0.7, top_p=0.9, max_new_tokens=512):
+    def _chat(self, model, msgs, pil_images, vision_cache, stream_options=None, **kwargs):
+        """调用 model.chat，启用时复用视觉编码缓存；stream_options 不为 None 时流式生成"""
+        def chat(**chat_kwargs):
+            if vision_cache:
+                return VISION_CACHE.chat(model, msgs, pil_images, **chat_kwargs)
+            return model.chat(msgs=msgs, **chat_kwargs)
+
+        if stream_options is None:
+            return chat(**kwargs)
+
+        tokenizer = kwargs.pop("tokenizer")
+        max_new_tokens = kwargs.pop("max_new_tokens")
+        text, _ = stream_chat(lambda **stream_kwargs: chat(**stream_kwargs, **kwargs),
+                              tokenizer, max_new_tokens, **stream_options)
+        return text
+
+    def chat_batch(self, model, tokenizer, pil_images, final_prompt, temperature, top_p, max_new_tokens, vision_cache=True,
+                   stream_options=None, scheduler=None, prefix_cache=False, seed=None):
+        """对一个微批次调用 model.chat，模型不支持批量输入或流式输出时逐张推理"""
+        batch_msgs = [build_messages([pil_image], final_prompt, prefix_cache) for pil_image in pil_images]
+        if scheduler is not None and stream_options is None:
+            # 逐条提交，由调度器负责合并批次
+            futures = [
+                scheduler.submit(msgs, seed=seed, temperature=temperature, top_p=top_p, max_new_tokens=max_new_tokens)
+                for msgs in batch_msgs
+            ]
+            return [future.result() for future in futures]
+
+        if len(batch_msgs) > 1 and stream_options is None:
+            try:
+                responses = self._chat(
+                    model, batch_msgs, pil_images, vision_cache,
+                    tokenizer=tokenizer,
+                    temperature=temperature,
+                    top_p=top_p,
+                    max_new_tokens=max_new_tokens
+                )
+                if isinstance(responses, (list, tuple)) and len(responses) == len(batch_msgs):
+                    return list(responses)
+            except (TypeError, ValueError, NotImplementedError) as e:
+                print(f"批量推理不可用，回退为逐张推理: {e}")
+
+        return [
+            self._chat(
+                model, msgs, [pil_image], vision_cache, stream_options,
+                tokenizer=tokenizer,
+                temperature=temperature,
+                top_p=top_p,
+                max_new_tokens=max_new_tokens
+            )
+            for msgs, pil_image in zip(batch_msgs, pil_images)
+        ]
+
+    def generate(self, model, tokenizer, image, prompt_mode, prompt, seed, temperature=0.7, top_p=0.9, max_new_tokens=512,
+                 batch_mode="First Image", micro_batch_size=4, caption_delimiter="\\n\\n", cache_mode="Memory", vision_cache=True,
+                 streaming=False, stop_strings="", max_sentences=0, use_scheduler=False, prefix_cache=False,
+                 profile="Off", unique_id=None):
         """生成回答"""
         try:
             # 设置随机种子
@@ -41,39 +130,80 @@ Please ensure the description is based on visible information in the image, avoi
             torch.cuda.manual_seed(seed)
 
             # ComfyUI 的图像是 NHWC 格式的 tensor
-            if len(image.shape) == 4:
-                image = image[0]  # 取第一张图片
-            
-            # 转换为 numpy，并确保值在 0-255 范围内
-            image_np = (image.cpu().numpy() * 255).clip(0, 255).astype(np.uint8)
-            
-            # 转换为 PIL Image
-            pil_image = Image.fromarray(image_np, 'RGB')
-            
-            print(f"图像大小: {pil_image.size}")
-            
+            if len(image.shape) == 3:
+                image = image.unsqueeze(0)
+            if batch_mode != "All Images":
+                image = image[:1]  # 取第一张图片
+
             # 根据选择使用模板提示词或用户输入的提示词
             final_prompt = self.TEMPLATE_PROMPT if prompt_mode == "Use System Preset" else prompt
-            
-            # 按照官方示例构建消息
-            messages = [
-                {
-                    'role': 'user', 
-                    'content': [pil_image, final_prompt]
+
+            print(f"图像数量: {image.shape[0]}, 图像大小: {image.shape[2]}x{image.shape[1]}")
+
+            use_cache = cache_mode != "Off"
+            use_disk = cache_mode == "Memory + Disk"
+
+            max_pixels = model_max_pixels(model)
+            scheduler = get_scheduler(model, tokenizer) if use_scheduler else None
+
+            stream_options = None
+            if streaming:
+                stream_options = {
+                    "node_id": unique_id,
+                    "stop_strings": parse_stop_strings(stop_strings),
+                    "max_sentences": max_sentences,
                 }
-            ]
-            
-            # 生成回答
-            response = model.chat(
-                msgs=messages,
-                tokenizer=tokenizer,
-                temperature=temperature,
-                top_p=top_p,
-                max_new_tokens=max_new_tokens
-            )
-            
-            return (response,)
-            
+            # 消息格式与停止条件会影响输出，需纳入缓存键
+            cache_extra = stream_cache_extra("prefix" if prefix_cache else None, stream_options)
+
+            def caption_batch(frames):
+                keys = [
+                    RESPONSE_CACHE.make_key(model, [frame], final_prompt, seed, temperature, top_p, max_new_tokens,
+                                            extra=cache_extra)
+                    if use_cache else None
+                    for frame in frames
+                ]
+                batch_captions = [RESPONSE_CACHE.get(key, use_disk) if use_cache else None for key in keys]
+
+                # 仅对未命中缓存的图片调用模型
+                missing = [i for i, caption in enumerate(batch_captions) if caption is None]
+                if missing:
+                    # 整批转换为 uint8，超出模型切片面积的图像先在 tensor 上缩放
+                    with metrics.stage("preprocess"):
+                        pil_images = tensor_batch_to_pil(frames[missing], max_pixels)
+                    responses = self.chat_batch(model, tokenizer, pil_images, final_prompt,
+                                                temperature, top_p, max_new_tokens, vision_cache, stream_options,
+                                                scheduler, prefix_cache, seed)
+                    for i, response in zip(missing, responses):
+                        batch_captions[i] = response
+                        if use_cache:
+                            RESPONSE_CACHE.put(keys[i], response, use_disk)
+                return batch_captions
+
+            # 模型有多个副本时各微批次并发推理，流式输出时保持逐批顺序执行
+            workers = replica_count(model) if stream_options is None else 1
+            captions = []
+            with INSTRUMENTATION.call("MiniCPMInference", model, profile, images=image.shape[0]) as metrics:
+                # 按微批次大小与切片数预留推理显存，由 ComfyUI 加载模型并在需要时卸载其他模型
+                with metrics.stage("model_load"):
+                    batch_size = scheduler.max_batch_size if scheduler is not None else micro_batch_size
+                    load_for_inference(model, crops=image_crops(model, image.shape[2], image.shape[1]),
+                                       max_new_tokens=max_new_tokens, batch_size=min(batch_size, image.shape[0]))
+                if prefix_cache:
+                    PREFIX_CACHE.prepare(model, tokenizer, final_prompt)
+                batches = (image[start:start + micro_batch_size] for start in range(0, image.shape[0], micro_batch_size))
+                for batch_captions in bounded_ordered_map(caption_batch, batches, workers):
+                    captions.extend(batch_captions)
+
+            if use_cache:
+                print(f"回答缓存: {RESPONSE_CACHE.stats()}")
+            if scheduler is not None:
+                print(f"推理调度器: {scheduler.stats()}")
+
+            # 支持在输入框中用 \n / \t 表示换行和制表符
+            delimiter = caption_delimiter.replace("\\n", "\n").replace("\\t", "\t")
+            return (delimiter.join(captions), captions, metrics.to_json())
+
         except Exception as e:
             raise e
 
@@ -2,6 +2,17 @@ import torch
 from PIL import Image
 import numpy as np
 import random
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from .minicpm_o_cache import RESPONSE_CACHE, CACHE_MODES
+from .minicpm_o_vision_cache import VISION_CACHE
+from .minicpm_o_preprocess import tensor_to_pil, model_max_pixels
+from .minicpm_o_memory import load_for_inference, image_crops
+from .minicpm_o_scheduler import get_scheduler, seeded_sampling
+from .minicpm_o_prefix_cache import PREFIX_CACHE, build_messages
+from .minicpm_o_metrics import INSTRUMENTATION, PROFILE_MODES
 
 class MiniCPMImageAnalyzer:
     """MiniCPM Image Analyzer Node for analyzing theme, scene and style"""
@@ -60,8 +71,8 @@ class MiniCPMImageAnalyzer:
     Anime style with bold cel-shading.
     """
 
-    RETURN_TYPES = ("STRING", "STRING", "STRING", "STRING")
-    RETURN_NAMES = ("theme_analysis", "scene_analysis", "style_analysis", "combined_prompt")
+    RETURN_TYPES = ("STRING", "STRING", "STRING", "STRING", "STRING", "STRING")
+    RETURN_NAMES = ("theme_analysis", "scene_analysis", "style_analysis", "combined_prompt", "timings", "metrics")
     FUNCTION = "analyze"
     CATEGORY = "MiniCPM-o"
 
@@ -108,6 +119,10 @@ class MiniCPMImageAnalyzer:
     - Never label or separate elements in the final output
     """
 
+    # 启用前缀缓存时，COMBINE_PROMPT 中固定的说明部分作为 system 提示词，待整合的元素放在 user 消息中
+    COMBINE_ELEMENTS_PROMPT = COMBINE_PROMPT[COMBINE_PROMPT.index("    Elements to integrate:"):COMBINE_PROMPT.index("    Guidelines:")]
+    COMBINE_SYSTEM_PROMPT = COMBINE_PROMPT.replace(COMBINE_ELEMENTS_PROMPT, "")
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -124,82 +139,213 @@ class MiniCPMImageAnalyzer:
             },
             "optional": {
                 "user_prompt": ("STRING", {"default": "", "multiline": True}),
+                # 三项独立分析的执行方式：顺序、单次批量生成、线程池并发，或提交到共享推理调度器
+                # （并发模式下每项分析使用由 seed 确定的独立随机数生成器；模型未安装生成钩子时结果不可复现）
+                "execution_mode": (["Sequential", "Batched", "Concurrent", "Scheduler"], {"default": "Sequential"}),
+                "cache_mode": (CACHE_MODES, {"default": "Memory"}),
+                # 缓存同一图片的视觉编码结果，三项分析使用同一张图片时只编码一次
+                "vision_cache": ("BOOLEAN", {"default": True}),
+                # 将固定提示词放入 system 消息并复用其预填充的 KV 缓存（单条推理时生效）
+                "prefix_cache": ("BOOLEAN", {"default": False}),
+                # 对本次运行进行性能剖析
+                "profile": (PROFILE_MODES, {"default": "Off"}),
             }
         }
 
-    def process_image(self, image):
+    def process_image(self, image, max_pixels=0):
         """处理输入图像为PIL格式"""
-        if len(image.shape) == 4:
-            image = image[0]
-        image_np = (image.cpu().numpy() * 255).clip(0, 255).astype(np.uint8)
-        return Image.fromarray(image_np, 'RGB')
-
-    def get_analysis(self, model, tokenizer, image, prompt, temperature, top_p, max_new_tokens):
-        """获取单张图片的分析结果"""
-        messages = [
-            {
-                'role': 'user',
-                'content': [image, prompt]
-            }
-        ]
-        
-        response = model.chat(
-            msgs=messages,
+        return tensor_to_pil(image, max_pixels)
+
+    def chat(self, model, msgs, images, vision_cache, **kwargs):
+        """调用 model.chat，启用时复用视觉编码缓存"""
+        if vision_cache:
+            return VISION_CACHE.chat(model, msgs, images, **kwargs)
+        return model.chat(msgs=msgs, **kwargs)
+
+    def get_analysis(self, model, tokenizer, image, prompt, temperature, top_p, max_new_tokens, vision_cache=False,
+                     prefix_cache=False, seed=None):
+        """获取单张图片的分析结果；指定 seed 时使用独立的随机数生成器采样"""
+        messages = build_messages([image], prompt, prefix_cache)
+
+        params = dict(temperature=temperature, top_p=top_p, max_new_tokens=max_new_tokens)
+        if seed is not None:
+            params = seeded_sampling(model, seed, **params)
+        response = self.chat(model, messages, [image], vision_cache, tokenizer=tokenizer, **params)
+        return response
+
+    def get_analyses_batched(self, model, tokenizer, images, prompts, temperature, top_p, max_new_tokens, vision_cache=False,
+                             prefix_cache=False):
+        """将多项分析合并为一次批量 model.chat 调用"""
+        batch_msgs = [build_messages([image], prompt, prefix_cache) for image, prompt in zip(images, prompts)]
+        responses = self.chat(
+            model, batch_msgs, images, vision_cache,
             tokenizer=tokenizer,
             temperature=temperature,
             top_p=top_p,
             max_new_tokens=max_new_tokens
         )
-        return response
+        if not isinstance(responses, (list, tuple)) or len(responses) != len(batch_msgs):
+            raise ValueError("模型未返回批量结果")
+        return list(responses)
+
+    def run_analyses(self, model, tokenizer, names, images, prompts, temperature, top_p, max_new_tokens, execution_mode, timings, vision_cache=False,
+                     prefix_cache=False, seed=None):
+        """执行相互独立的分析，并记录每个阶段的耗时"""
+        def timed_analysis(name, image, prompt, call_seed=None):
+            start = time.perf_counter()
+            result = self.get_analysis(model, tokenizer, image, prompt, temperature, top_p, max_new_tokens, vision_cache,
+                                       prefix_cache, call_seed)
+            timings[name] = time.perf_counter() - start
+            return result
+
+        if not names:
+            return []
+
+        if execution_mode == "Scheduler":
+            # 由共享调度器与其他节点的请求一起合并批次（不使用视觉编码缓存）
+            start = time.perf_counter()
+            scheduler = get_scheduler(model, tokenizer)
+            futures = [
+                scheduler.submit(build_messages([image], prompt, prefix_cache), seed=seed,
+                                 temperature=temperature, top_p=top_p, max_new_tokens=max_new_tokens)
+                for image, prompt in zip(images, prompts)
+            ]
+            results = [future.result() for future in futures]
+            timings["scheduled_analyses"] = time.perf_counter() - start
+            return results
+
+        if execution_mode == "Batched" and len(names) > 1:
+            start = time.perf_counter()
+            try:
+                results = self.get_analyses_batched(model, tokenizer, images, prompts,
+                                                    temperature, top_p, max_new_tokens, vision_cache, prefix_cache)
+                timings["batched_analyses"] = time.perf_counter() - start
+                return results
+            except Exception as e:
+                # 模型不支持批量输入时退回并发执行
+                print(f"批量分析不可用，改为并发执行: {e}")
+                execution_mode = "Concurrent"
+
+        if execution_mode == "Concurrent" and len(names) > 1:
+            # 并发的生成共用全局随机数生成器，结果取决于线程调度；每项分析改用由 seed 确定的独立生成器
+            with ThreadPoolExecutor(max_workers=len(names)) as pool:
+                futures = [pool.submit(timed_analysis, name, image, prompt, seed)
+                           for name, image, prompt in zip(names, images, prompts)]
+                return [future.result() for future in futures]
+
+        return [timed_analysis(name, image, prompt) for name, image, prompt in zip(names, images, prompts)]
 
     def analyze(self, model, tokenizer, theme_image, scene_image, style_image, 
-               seed, temperature=0.7, top_p=0.9, max_new_tokens=512, user_prompt=""):
+               seed, temperature=0.7, top_p=0.9, max_new_tokens=512, user_prompt="", execution_mode="Sequential", cache_mode="Memory", vision_cache=True,
+               prefix_cache=False, profile="Off"):
         """分析图片并生成组合提示词"""
         try:
             # 设置随机种子
             torch.manual_seed(seed)
             torch.cuda.manual_seed(seed)
             
-            # 处理图片
-            theme_pil = self.process_image(theme_image)
-            scene_pil = self.process_image(scene_image)
-            style_pil = self.process_image(style_image)
-
-            # 获取各个方面的分析
-            theme_analysis = self.get_analysis(model, tokenizer, theme_pil, self.THEME_PROMPT, 
-                                            temperature, top_p, max_new_tokens)
-            scene_analysis = self.get_analysis(model, tokenizer, scene_pil, self.SCENE_PROMPT, 
-                                           temperature, top_p, max_new_tokens)
-            style_analysis = self.get_analysis(model, tokenizer, style_pil, self.STYLE_PROMPT, 
-                                           temperature, top_p, max_new_tokens)
-
-            # 直接在模板中包含用户提示词
-            combine_prompt = self.COMBINE_PROMPT.format(
-                theme_analysis=theme_analysis.strip(),
-                scene_analysis=scene_analysis.strip(),
-                style_analysis=style_analysis.strip(),
-                user_prompt=user_prompt.strip() if user_prompt.strip() else "none"
-            )
-
-            messages = [
-                {
-                    'role': 'user',
-                    'content': combine_prompt
-                }
-            ]
-            
-            combined_prompt = model.chat(
-                msgs=messages,
-                tokenizer=tokenizer,
-                temperature=temperature,
-                top_p=top_p,
-                max_new_tokens=max_new_tokens
-            )
+            with INSTRUMENTATION.call("MiniCPMImageAnalyzer", model, profile, execution_mode=execution_mode) as metrics:
+                timings = {}
+                total_start = time.perf_counter()
+
+                # 处理图片
+                start = time.perf_counter()
+                max_pixels = model_max_pixels(model)
+                theme_pil = self.process_image(theme_image, max_pixels)
+                scene_pil = self.process_image(scene_image, max_pixels)
+                style_pil = self.process_image(style_image, max_pixels)
+                timings["preprocess"] = time.perf_counter() - start
+
+                # 批量与并发模式下三个分析同时进行，按三倍批大小预留推理显存
+                start = time.perf_counter()
+                load_for_inference(model, crops=max(image_crops(model, *image.size) for image in (theme_pil, scene_pil, style_pil)),
+                                   max_new_tokens=max_new_tokens, batch_size=1 if execution_mode == "Sequential" else 3)
+                timings["model_load"] = time.perf_counter() - start
+
+                use_cache = cache_mode != "Off"
+                use_disk = cache_mode == "Memory + Disk"
+
+                # 获取各个方面的分析，已缓存的子分析直接复用
+                start = time.perf_counter()
+                names = ["theme", "scene", "style"]
+                images = [theme_pil, scene_pil, style_pil]
+                prompts = [self.THEME_PROMPT, self.SCENE_PROMPT, self.STYLE_PROMPT]
+                if prefix_cache:
+                    for prompt in prompts:
+                        PREFIX_CACHE.prepare(model, tokenizer, prompt)
+                    PREFIX_CACHE.prepare(model, tokenizer, self.COMBINE_SYSTEM_PROMPT)
+
+                # 消息格式会影响输出，需纳入缓存键
+                cache_extra = "prefix" if prefix_cache else None
+                keys = [
+                    RESPONSE_CACHE.make_key(model, [image], prompt, seed, temperature, top_p, max_new_tokens, extra=cache_extra)
+                    if use_cache else None
+                    for image, prompt in zip(images, prompts)
+                ]
+                results = [RESPONSE_CACHE.get(key, use_disk) if use_cache else None for key in keys]
+                missing = [i for i, result in enumerate(results) if result is None]
+
+                responses = self.run_analyses(
+                    model, tokenizer,
+                    [names[i] for i in missing],
+                    [images[i] for i in missing],
+                    [prompts[i] for i in missing],
+                    temperature, top_p, max_new_tokens, execution_mode, timings, vision_cache, prefix_cache, seed
+                )
+                for i, response in zip(missing, responses):
+                    results[i] = response
+                    if use_cache:
+                        RESPONSE_CACHE.put(keys[i], response, use_disk)
+                theme_analysis, scene_analysis, style_analysis = results
+                timings["analyses"] = time.perf_counter() - start
+
+                # 直接在模板中包含用户提示词
+                elements = dict(
+                    theme_analysis=theme_analysis.strip(),
+                    scene_analysis=scene_analysis.strip(),
+                    style_analysis=style_analysis.strip(),
+                    user_prompt=user_prompt.strip() if user_prompt.strip() else "none"
+                )
+
+                if prefix_cache:
+                    combine_prompt = self.COMBINE_ELEMENTS_PROMPT.format(**elements)
+                    messages = [
+                        {'role': 'system', 'content': self.COMBINE_SYSTEM_PROMPT},
+                        {'role': 'user', 'content': combine_prompt}
+                    ]
+                else:
+                    combine_prompt = self.COMBINE_PROMPT.format(**elements)
+                    messages = [
+                        {
+                            'role': 'user',
+                            'content': combine_prompt
+                        }
+                    ]
+
+                start = time.perf_counter()
+                combine_key = RESPONSE_CACHE.make_key(model, [], combine_prompt, seed, temperature, top_p, max_new_tokens,
+                                                      extra=cache_extra)
+                # 合并步骤只有一次调用，提交调度器时不必等待批次窗口
+                chat = partial(get_scheduler(model, tokenizer).chat, gather=False, seed=seed) \
+                    if execution_mode == "Scheduler" else model.chat
+                combined_prompt = RESPONSE_CACHE.cached_chat(cache_mode, combine_key, lambda: chat(
+                    msgs=messages,
+                    tokenizer=tokenizer,
+                    temperature=temperature,
+                    top_p=top_p,
+                    max_new_tokens=max_new_tokens
+                ))
+
+                timings["combine"] = time.perf_counter() - start
+                timings["total"] = time.perf_counter() - total_start
+            timings = {name: round(value, 4) for name, value in timings.items()}
+            timings_json = json.dumps(timings, ensure_ascii=False)
+            print(f"分析耗时: {timings_json}")
 
             # # 去掉结果中的引号
             # combined_prompt = combined_prompt.strip().strip('"').strip("'")
 
-            return (theme_analysis, scene_analysis, style_analysis, combined_prompt)
+            return (theme_analysis, scene_analysis, style_analysis, combined_prompt, timings_json, metrics.to_json())
 
         except Exception as e:
             raise e
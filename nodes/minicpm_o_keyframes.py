@@ -0,0 +1,126 @@
+import numpy as np
+
+
+def uniform_sample(l, n):
+    """从长度为 l 的序列中均匀采样 n 个位置"""
+    if n >= l:
+        return list(range(l))
+    else:
+        return [i * l // n + l // (2 * n) for i in range(n)]
+
+
+def color_histograms(frames, levels=4):
+    """计算每帧的量化颜色直方图，frames 为 (N, H, W, 3) uint8，返回归一化的 (N, levels^3)"""
+    n = frames.shape[0]
+    bins = levels ** 3
+    q = (frames.astype(np.uint16) * levels) >> 8
+    idx = (q[..., 0] * levels + q[..., 1]) * levels + q[..., 2]
+    idx = idx.reshape(n, -1) + (np.arange(n, dtype=np.int64) * bins)[:, None]
+    counts = np.bincount(idx.ravel(), minlength=n * bins).reshape(n, bins)
+    return counts / float(idx.shape[1])
+
+
+def difference_hashes(gray, hash_size=8):
+    """计算每帧的 dHash，gray 为 (N, H, W) 浮点灰度图，返回 (N, hash_size*hash_size) 布尔数组"""
+    n, h, w = gray.shape
+    rows = np.linspace(0, h - 1, hash_size).round().astype(np.int64)
+    cols = np.linspace(0, w - 1, hash_size + 1).round().astype(np.int64)
+    small = gray[:, rows][:, :, cols]
+    return (small[:, :, 1:] > small[:, :, :-1]).reshape(n, -1)
+
+
+def frame_scores(frames):
+    """对候选帧打分，返回 (scores, hist_dist, hashes, hists)
+
+    分数综合相邻候选帧之间的颜色直方图距离、像素差与感知哈希距离，
+    各项按全片最大值归一化；第一帧分数固定为 1。
+    """
+    n = frames.shape[0]
+    hists = color_histograms(frames)
+    gray = frames.astype(np.float32).mean(axis=-1)
+    hashes = difference_hashes(gray)
+
+    hist_dist = np.zeros(n, dtype=np.float32)
+    pixel_diff = np.zeros(n, dtype=np.float32)
+    hash_dist = np.zeros(n, dtype=np.float32)
+    if n > 1:
+        hist_dist[1:] = 0.5 * np.abs(hists[1:] - hists[:-1]).sum(axis=1)
+        pixel_diff[1:] = np.abs(gray[1:] - gray[:-1]).mean(axis=(1, 2)) / 255.0
+        hash_dist[1:] = (hashes[1:] != hashes[:-1]).mean(axis=1)
+
+    def normalize(values):
+        peak = values.max() if n else 0.0
+        return values / peak if peak > 0 else values
+
+    scores = (0.4 * normalize(hist_dist) + 0.3 * normalize(pixel_diff) + 0.3 * normalize(hash_dist))
+    if n:
+        scores[0] = 1.0
+    return scores, hist_dist, hashes, hists
+
+
+def deduplicate(hashes, hists, hash_threshold=4, hist_threshold=0.1):
+    """去除与上一保留帧几乎相同的候选帧，返回保留的位置列表"""
+    keep = []
+    last = None
+    for i in range(hashes.shape[0]):
+        if last is None:
+            keep.append(i)
+            last = i
+            continue
+        hamming = int(np.count_nonzero(hashes[i] != hashes[last]))
+        hist_change = 0.5 * float(np.abs(hists[i] - hists[last]).sum())
+        if hamming > hash_threshold or hist_change > hist_threshold:
+            keep.append(i)
+            last = i
+    return keep
+
+
+def select_keyframes(frames, budget, cut_threshold=0.4, hash_threshold=4):
+    """从候选帧中选出最有信息量的 budget 帧
+
+    先去重，再按直方图突变切分镜头；每个镜头至少分配一帧（预算允许时），
+    剩余预算按镜头内运动分数之和分配，镜头内取分数最高的帧。
+    返回 (选中的候选位置列表, 每个候选帧的分数数组)，位置按时间排序。
+    """
+    n = frames.shape[0]
+    if n == 0 or budget <= 0:
+        return [], np.zeros(n, dtype=np.float32)
+
+    scores, hist_dist, hashes, hists = frame_scores(frames)
+    kept = deduplicate(hashes, hists, hash_threshold=hash_threshold)
+    if len(kept) <= budget:
+        return kept, scores
+
+    # 按镜头切分
+    scenes = [[]]
+    for i in kept:
+        if scenes[-1] and hist_dist[i] > cut_threshold:
+            scenes.append([])
+        scenes[-1].append(i)
+
+    if len(scenes) >= budget:
+        # 镜头数多于预算时，保留切换最明显的镜头起点
+        starts = sorted((scene[0] for scene in scenes), key=lambda i: scores[i], reverse=True)[:budget]
+        return sorted(starts), scores
+
+    # 每个镜头先分配一帧，剩余预算按运动分数加权分配
+    allocation = np.ones(len(scenes), dtype=np.int64)
+    weights = np.array([scores[scene].sum() for scene in scenes], dtype=np.float64)
+    capacity = np.array([len(scene) for scene in scenes], dtype=np.int64) - 1
+    remaining = budget - len(scenes)
+    while remaining > 0 and capacity.sum() > 0:
+        share = np.where(capacity > 0, weights, 0.0)
+        if share.sum() <= 0:
+            share = (capacity > 0).astype(np.float64)
+        extra = np.minimum(np.floor(share / share.sum() * remaining).astype(np.int64), capacity)
+        if extra.sum() == 0:
+            extra[int(np.argmax(share))] = 1
+        allocation += extra
+        capacity -= extra
+        remaining -= int(extra.sum())
+
+    selected = []
+    for scene, count in zip(scenes, allocation):
+        ranked = sorted(scene[1:], key=lambda i: scores[i], reverse=True)[:count - 1]
+        selected.extend([scene[0], *ranked])
+    return sorted(selected), scores
@@ -0,0 +1,201 @@
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .minicpm_o_registry import MODEL_REGISTRY
+
+# 每个模态对应的子模块（权重前缀）
+MODALITY_MODULES = {
+    "vision": ["vpm", "resampler"],
+    "audio": ["apm", "audio_avg_pooler", "audio_projection_layer"],
+    "tts": ["tts"],
+}
+
+
+def load_checkpoint_tensors(model_path, prefixes):
+    """从模型目录中只读取指定前缀的权重"""
+    model_path = Path(model_path)
+    prefixes = tuple(f"{prefix}." for prefix in prefixes)
+    index_file = model_path / "model.safetensors.index.json"
+
+    if index_file.exists():
+        with open(index_file, encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        shards = {}
+        for name, shard in weight_map.items():
+            if name.startswith(prefixes):
+                shards.setdefault(shard, []).append(name)
+    else:
+        files = sorted(model_path.glob("*.safetensors"))
+        shards = {f.name: None for f in files}
+
+    tensors = {}
+    if shards:
+        from safetensors import safe_open
+        for shard, names in shards.items():
+            with safe_open(str(model_path / shard), framework="pt") as f:
+                for name in names if names is not None else f.keys():
+                    if name.startswith(prefixes):
+                        tensors[name] = f.get_tensor(name)
+        return tensors
+
+    for bin_file in sorted(model_path.glob("pytorch_model*.bin")):
+        state = torch.load(str(bin_file), map_location="cpu", mmap=True, weights_only=True)
+        tensors.update({name: tensor for name, tensor in state.items() if name.startswith(prefixes)})
+    return tensors
+
+
+def required_modalities(msgs, kwargs):
+    """根据消息内容与参数推断本次调用需要的模态"""
+    needed = set()
+    conversations = msgs if msgs and isinstance(msgs[0], list) else [msgs or []]
+    for conversation in conversations:
+        for message in conversation:
+            content = message.get("content") if isinstance(message, dict) else None
+            for item in content if isinstance(content, list) else [content]:
+                if isinstance(item, Image.Image):
+                    needed.add("vision")
+                elif isinstance(item, np.ndarray):
+                    needed.add("audio")
+    if kwargs.get("image") is not None or kwargs.get("vision_hidden_states") is not None:
+        needed.add("vision")
+    if kwargs.get("generate_audio") or kwargs.get("use_tts_template"):
+        needed.add("tts")
+    return needed
+
+
+class LazyModalityModel:
+    """延迟加载多模态子模块的模型句柄
+
+    语言模型主干在加载时即创建，视觉、音频和 TTS 子模块在第一次需要时才构建并读取权重，
+    每个子模块都可以单独卸载。其余属性与方法直接转发给底层模型。
+    """
+
+    def __init__(self, model, model_path):
+        object.__setattr__(self, "_model", model)
+        object.__setattr__(self, "_model_path", str(model_path))
+        object.__setattr__(self, "_lock", threading.RLock())
+        object.__setattr__(self, "_last_used", {})
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._model, name, value)
+
+    def __repr__(self):
+        return f"LazyModalityModel({self.loaded_modalities()})"
+
+    @property
+    def base_model(self):
+        return self._model
+
+    def loaded_modalities(self):
+        return [m for m, modules in MODALITY_MODULES.items() if getattr(self._model, modules[0], None) is not None]
+
+    def _target(self):
+        """新建子模块应放置的设备与 dtype，与语言模型主干的输入嵌入保持一致"""
+        embed = self._model.llm.get_input_embeddings().weight
+        dtype = embed.dtype if embed.dtype.is_floating_point else self._model.dtype
+        return embed.device, dtype
+
+    def _build(self, modality):
+        model = self._model
+        if modality == "vision":
+            model.vpm = model.init_vision_module()
+            model.vision_dim = model.vpm.embed_dim
+            model.resampler = model.init_resampler(model.embed_dim, model.vision_dim)
+        elif modality == "audio":
+            remote_module = sys.modules[type(model).__module__]
+            model.apm = model.init_audio_module()
+            audio_output_dim = int(model.apm.config.encoder_ffn_dim // 4)
+            model.audio_avg_pooler = torch.nn.AvgPool1d(model.config.audio_pool_step, stride=model.config.audio_pool_step)
+            model.audio_projection_layer = remote_module.MultiModalProjector(in_dim=audio_output_dim, out_dim=model.embed_dim)
+            model.audio_encoder_layer = -1
+        elif modality == "tts":
+            model.tts = model.init_tts_module()
+
+    def ensure(self, modality):
+        """确保指定模态已加载，返回本次加载耗时（已加载时为 0）"""
+        with self._lock:
+            self._last_used[modality] = time.monotonic()
+            if modality in self.loaded_modalities():
+                return 0.0
+
+            start = time.perf_counter()
+            print(f"正在加载 {modality} 子模块...")
+            # 显存不足时按最久未使用的顺序逐个卸载其他模态后重试
+            others = sorted((m for m in self.loaded_modalities() if m != modality),
+                            key=lambda m: self._last_used.get(m, 0.0))
+            while True:
+                try:
+                    self._attach(modality)
+                    break
+                except torch.cuda.OutOfMemoryError:
+                    if not others:
+                        raise
+                    self.unload(others.pop(0))
+            MODEL_REGISTRY.refresh_sizes()
+            elapsed = time.perf_counter() - start
+            print(f"{modality} 子模块加载完成，耗时 {elapsed:.2f}秒")
+            return elapsed
+
+    def _attach(self, modality):
+        model = self._model
+        device, dtype = self._target()
+        # 直接在目标设备上构建，避免在 CPU 上多保留一份随机初始化的权重
+        with torch.device(device):
+            self._build(modality)
+
+        prefixes = MODALITY_MODULES[modality]
+        tensors = load_checkpoint_tensors(self._model_path, prefixes)
+        for prefix in prefixes:
+            module = getattr(model, prefix, None)
+            if not isinstance(module, torch.nn.Module):
+                continue
+            state = {name[len(prefix) + 1:]: tensor for name, tensor in tensors.items() if name.startswith(prefix + ".")}
+            result = module.load_state_dict(state, strict=False)
+            if result.missing_keys:
+                # 不能留下随机初始化的子模块
+                self._detach(modality)
+                shown = ", ".join(f"{prefix}.{key}" for key in result.missing_keys[:5])
+                more = f" 等 {len(result.missing_keys)} 个" if len(result.missing_keys) > 5 else ""
+                raise RuntimeError(f"{modality} 子模块的权重不完整，缺少 {shown}{more}")
+            if result.unexpected_keys:
+                print(f"警告: {prefix} 忽略了 {len(result.unexpected_keys)} 个多余的权重")
+            module.to(device=device, dtype=dtype)
+            module.eval()
+
+        setattr(model, f"init_{modality}", True)
+        setattr(model.config, f"init_{modality}", True)
+
+    def unload(self, modality):
+        """卸载指定模态的子模块以释放内存"""
+        with self._lock:
+            if modality not in self.loaded_modalities():
+                return False
+            self._detach(modality)
+            self._last_used.pop(modality, None)
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            MODEL_REGISTRY.refresh_sizes()
+            print(f"已卸载 {modality} 子模块")
+            return True
+
+    def _detach(self, modality):
+        for prefix in MODALITY_MODULES[modality]:
+            if hasattr(self._model, prefix):
+                setattr(self._model, prefix, None)
+        setattr(self._model, f"init_{modality}", False)
+        setattr(self._model.config, f"init_{modality}", False)
+
+    def chat(self, msgs=None, **kwargs):
+        for modality in sorted(required_modalities(msgs, kwargs)):
+            self.ensure(modality)
+        return self._model.chat(msgs=msgs, **kwargs)
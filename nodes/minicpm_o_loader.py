@@ -1,16 +1,22 @@
-import os
 from pathlib import Path
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import folder_paths
-import shutil
-import sys
+from .minicpm_o_registry import MODEL_REGISTRY, process_rss_bytes
+from .minicpm_o_lazy import LazyModalityModel
+from .minicpm_o_metrics import INSTRUMENTATION, PROFILE_MODES
+from .minicpm_o_memory import free_memory_for_load
+from .minicpm_o_model_files import MODEL_FILES
+from .minicpm_o_streaming import install_generation_hooks
+from . import minicpm_o_replicas
+from .minicpm_o_replicas import ReplicatedModel, parse_replica_spec, spawn_cpu_replicas
+
+# 量化时保持精度的多模态子模块
+QUANT_SKIP_MODULES = ["vpm", "resampler", "apm", "audio_projection_layer", "tts"]
 
 class MiniCPMLoader:
     """MiniCPM 模型加载节点"""
     
-    RETURN_TYPES = ("MODEL", "TOKENIZER")
-    RETURN_NAMES = ("model", "tokenizer")
+    RETURN_TYPES = ("MODEL", "TOKENIZER", "STRING")
+    RETURN_NAMES = ("model", "tokenizer", "metrics")
     FUNCTION = "load_model"
     CATEGORY = "MiniCPM-o"
 
@@ -19,70 +25,207 @@ class MiniCPMLoader:
         return {
             "required": {
                 "model_name": (["MiniCPM-o-2_6"],),  # 直接使用固定的模型文件夹名称
-                "device": (["cuda", "cpu"], {"default": "cuda"}),
+                "device": (["cuda", "cpu", "auto"], {"default": "cuda"}),  # auto 按 max_memory 在 GPU/CPU 之间切分
                 "init_vision": ("BOOLEAN", {"default": True}),  # 是否启用视觉功能
                 "init_audio": ("BOOLEAN", {"default": False}),  # 是否启用音频功能
                 "init_tts": ("BOOLEAN", {"default": False}),    # 是否启用语音合成功能
+            },
+            "optional": {
+                # 模型注册表的内存预算，0 表示使用环境变量 MINICPM_MODEL_MEMORY_BUDGET_GB（未设置时不限制）；
+                # 多个加载节点设置了预算时取最小值
+                "memory_budget_gb": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1024.0, "step": 0.5}),
+                # 权重量化：bitsandbytes int8/int4 仅支持 CUDA，dynamic int8 为 CPU 上的线性层动态量化
+                "quantization": (["none", "int8", "int4", "dynamic int8 (CPU)"], {"default": "none"}),
+                "cpu_dtype": (["float32", "bfloat16"], {"default": "float32"}),
+                # device 为 auto 时每张 GPU 与 CPU 可使用的内存上限，0 表示不限制
+                "max_gpu_memory_gb": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1024.0, "step": 0.5}),
+                "max_cpu_memory_gb": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 4096.0, "step": 0.5}),
+                "low_cpu_mem_usage": ("BOOLEAN", {"default": True}),
+                # lazy: 仅加载语言模型主干，视觉/音频/TTS 在节点首次使用时加载，init_* 选项表示预加载
+                "modality_loading": (["eager", "lazy"], {"default": "eager"}),
+                # 对本次加载进行性能剖析
+                "profile": (PROFILE_MODES, {"default": "Off"}),
+                # 数据并行副本：如 "cuda:0,cuda:1,cuda:2,cuda:3" 在每张卡上各加载一份模型，
+                # "cpu*4" 为共 4 个 CPU 副本（其中 3 个在独立工作进程中）；留空表示不启用
+                "replicas": ("STRING", {"default": ""}),
             }
         }
-    
-    def load_model(self, model_name, device, attn_implementation="sdpa", init_vision=True, init_audio=False, init_tts=False):
+
+    def __init__(self):
+        self._registry_key = None
+
+    def load_model(self, model_name, device, attn_implementation="sdpa", init_vision=True, init_audio=False, init_tts=False, memory_budget_gb=0.0,
+                   quantization="none", cpu_dtype="float32", max_gpu_memory_gb=0.0, max_cpu_memory_gb=0.0, low_cpu_mem_usage=True,
+                   modality_loading="eager", profile="Off", replicas=""):
         """加载模型和tokenizer"""
         try:
+            import folder_paths
             model_path = Path(folder_paths.models_dir) / "MiniCPM" / model_name
             if not model_path.exists():
                 raise ValueError(f"本地模型未找到：{model_path}。请将模型文件放置在 ComfyUI/models/MiniCPM/MiniCPM-o-2_6 文件夹中。")
-            
-            print(f"正在加载模型：{model_path}")
-            
-            # 检测实际的 transformers 缓存目录
-            from transformers.utils import TRANSFORMERS_CACHE
-            actual_cache = Path(TRANSFORMERS_CACHE)
-            modules_cache = actual_cache.parent / "modules/transformers_modules" / model_name
-            
-            # 特别处理 image_processing_minicpmv.py 文件
-            source_file = model_path / "image_processing_minicpmv.py"
-            target_file = modules_cache / "image_processing_minicpmv.py"
-            
-            if source_file.exists():
-                try:
-                    # 确保目标目录存在
-                    target_file.parent.mkdir(parents=True, exist_ok=True)
-                    # 复制文件
-                    shutil.copy2(str(source_file), str(target_file))
-                except Exception as copy_error:
-                    # 如果复制失败，尝试使用备用路径
-                    backup_cache = Path(folder_paths.models_dir).parent / ".cache/huggingface/modules/transformers_modules" / model_name
-                    backup_target = backup_cache / "image_processing_minicpmv.py"
-                    
-                    backup_target.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copy2(str(source_file), str(backup_target))
-                    
-                    # 更新环境变量指向新位置
-                    os.environ["TRANSFORMERS_CACHE"] = str(backup_cache.parent.parent)
-                    os.environ["HF_HOME"] = str(backup_cache.parent.parent)
-                    os.environ["HF_MODULES_CACHE"] = str(backup_cache.parent)
-            
-            print("\n开始加载模型...")
-            model = AutoModelForCausalLM.from_pretrained(
-                str(model_path),
-                trust_remote_code=True,
-                attn_implementation=attn_implementation,
-                torch_dtype=torch.bfloat16 if device == "cuda" else torch.float32,
-                device_map=device,
-                init_vision=init_vision,
-                init_audio=init_audio,
-                init_tts=init_tts
-            )
-            
-            print("正在加载分词器...")
-            tokenizer = AutoTokenizer.from_pretrained(
-                str(model_path),
-                trust_remote_code=True
-            )
-            
-            return (model, tokenizer)
-        
+
+            # 以节点实例登记预算请求，改为 0 时撤销本节点之前的请求
+            MODEL_REGISTRY.request_memory_budget(id(self), int((memory_budget_gb or 0) * 1024 ** 3))
+
+            if quantization in ("int8", "int4") and device == "cpu":
+                raise ValueError("bitsandbytes 量化需要 CUDA，CPU 上请使用 dynamic int8 (CPU)")
+            if quantization == "dynamic int8 (CPU)" and device != "cpu":
+                raise ValueError("dynamic int8 (CPU) 量化仅支持 cpu 设备")
+
+            if device == "cpu":
+                # 动态量化需要 float32 权重
+                torch_dtype = torch.float32 if quantization == "dynamic int8 (CPU)" else getattr(torch, cpu_dtype)
+            else:
+                torch_dtype = torch.bfloat16
+            modalities = [name for name, enabled in (("vision", init_vision), ("audio", init_audio), ("tts", init_tts)) if enabled]
+            lazy = modality_loading == "lazy"
+            replica_devices, cpu_replicas = parse_replica_spec(replicas)
+            if cpu_replicas and device != "cpu":
+                raise ValueError("cpu*N 副本需要将 device 设置为 cpu")
+            load_options = self._load_options(device, quantization, max_gpu_memory_gb, max_cpu_memory_gb, low_cpu_mem_usage)
+            key = MODEL_REGISTRY.make_key(model_path, device, torch_dtype, attn_implementation, ["lazy"] if lazy else modalities,
+                                          options=(quantization, sorted(load_options.get("max_memory", {}).items()),
+                                                   low_cpu_mem_usage, replicas.replace(" ", "")))
+
+            def load_one(target_device, options):
+                # 检查模型目录并同步远程代码，目录未变化时只比较清单
+                with metrics.stage("model_files"):
+                    metrics.info["model_files"] = MODEL_FILES.prepare(
+                        model_path, model_name, Path(folder_paths.models_dir).parent / ".cache/huggingface/modules")
+                free_memory_for_load(model_path, target_device)
+                if lazy:
+                    model, tokenizer = self._load_from_disk(model_name, model_path, target_device, torch_dtype, attn_implementation,
+                                                            False, False, False, quantization, options)
+                    return LazyModalityModel(model, model_path), tokenizer
+                return self._load_from_disk(model_name, model_path, target_device, torch_dtype, attn_implementation,
+                                            init_vision, init_audio, init_tts, quantization, options)
+
+            def factory():
+                if replica_devices:
+                    # 每个设备各加载一份完整模型
+                    loaded = [load_one(d, self._load_options(d, quantization, max_gpu_memory_gb, max_cpu_memory_gb,
+                                                             low_cpu_mem_usage))
+                              for d in replica_devices]
+                    return ReplicatedModel([m for m, _ in loaded], replica_devices), loaded[0][1]
+                model, tokenizer = load_one(device, load_options)
+                if cpu_replicas > 1:
+                    print(f"正在启动 {cpu_replicas - 1} 个 CPU 工作进程...")
+                    workers = spawn_cpu_replicas(cpu_replicas - 1, minicpm_o_replicas.__file__, "load_pretrained", {
+                        "model_path": str(model_path),
+                        "torch_dtype": str(torch_dtype).replace("torch.", ""),
+                        "attn_implementation": attn_implementation,
+                        "init_vision": init_vision or lazy,
+                        "init_audio": init_audio,
+                        "init_tts": init_tts,
+                        "dynamic_int8": quantization == "dynamic int8 (CPU)",
+                    })
+                    labels = ["cpu:main"] + [f"cpu:worker{i + 1}" for i in range(len(workers))]
+                    return ReplicatedModel([model] + workers, labels), tokenizer
+                return model, tokenizer
+
+            rss_before = process_rss_bytes()
+            misses_before = MODEL_REGISTRY.stats()["misses"]
+            with INSTRUMENTATION.call("MiniCPMLoader", profile=profile, model_name=model_name, device=device,
+                                      quantization=quantization, modality_loading=modality_loading) as metrics:
+                with metrics.stage("load"):
+                    model, tokenizer = MODEL_REGISTRY.acquire(key, factory)
+                    # 回答缓存与数据集检查点以完整的加载键区分模型，量化、模态或副本不同的同一检查点输出可能不同
+                    model._minicpm_load_key = key
+                    if lazy:
+                        # 预加载所选模态，其余模态在首次使用时加载
+                        for modality in modalities:
+                            model.ensure(modality)
+                metrics.info["cold_load"] = MODEL_REGISTRY.stats()["misses"] != misses_before
+            self._report_memory(key, rss_before)
+
+            # 节点重新执行时释放上一次持有的引用
+            if self._registry_key is not None:
+                MODEL_REGISTRY.release(self._registry_key)
+            self._registry_key = key
+
+            stats = MODEL_REGISTRY.stats()
+            print(f"模型注册表: 命中={stats['hits']}, 未命中={stats['misses']}, 累计加载耗时={stats['total_load_time']:.2f}秒")
+
+            return (model, tokenizer, metrics.to_json())
+
         except Exception as e:
             print(f"\n详细错误信息: {str(e)}")
-            raise RuntimeError(f"加载模型时发生错误: {str(e)}") 
\ No newline at end of file
+            raise RuntimeError(f"加载模型时发生错误: {str(e)}")
+
+    def _load_options(self, device, quantization, max_gpu_memory_gb, max_cpu_memory_gb, low_cpu_mem_usage):
+        """构建 from_pretrained 的设备映射与低内存加载参数"""
+        options = {"device_map": device, "low_cpu_mem_usage": low_cpu_mem_usage}
+        if device == "auto":
+            max_memory = {}
+            if max_gpu_memory_gb and torch.cuda.is_available():
+                for index in range(torch.cuda.device_count()):
+                    max_memory[index] = f"{max_gpu_memory_gb}GiB"
+            if max_cpu_memory_gb:
+                max_memory["cpu"] = f"{max_cpu_memory_gb}GiB"
+            if max_memory:
+                options["max_memory"] = max_memory
+        if quantization in ("int8", "int4"):
+            from transformers import BitsAndBytesConfig
+            if quantization == "int8":
+                options["quantization_config"] = BitsAndBytesConfig(
+                    load_in_8bit=True,
+                    llm_int8_skip_modules=QUANT_SKIP_MODULES,
+                )
+            else:
+                options["quantization_config"] = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=torch.bfloat16,
+                    llm_int8_skip_modules=QUANT_SKIP_MODULES,
+                )
+        return options
+
+    def _report_memory(self, key, rss_before):
+        """输出当前加载模式的耗时与内存占用"""
+        entry = next((e for e in MODEL_REGISTRY.stats()["entries"] if e["key"] == key), None)
+        if entry is None:
+            return
+        rss_after = process_rss_bytes()
+        message = (f"加载耗时={entry['load_time']:.2f}秒, 模型权重={entry['size_bytes'] / 1024 ** 3:.2f}GB, "
+                   f"进程内存={rss_after / 1024 ** 3:.2f}GB (本次增加 {(rss_after - rss_before) / 1024 ** 3:.2f}GB)")
+        if torch.cuda.is_available():
+            message += f", 显存已分配={torch.cuda.memory_allocated() / 1024 ** 3:.2f}GB"
+        print(message)
+
+    def _load_from_disk(self, model_name, model_path, device, torch_dtype, attn_implementation, init_vision, init_audio, init_tts,
+                        quantization="none", load_options=None):
+        """从本地目录加载模型和tokenizer"""
+        print(f"正在加载模型：{model_path}")
+        
+        # 远程代码文件已由 MODEL_FILES.prepare 同步，transformers 在此之后才导入
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        print("\n开始加载模型...")
+        model = AutoModelForCausalLM.from_pretrained(
+            str(model_path),
+            trust_remote_code=True,
+            attn_implementation=attn_implementation,
+            torch_dtype=torch_dtype,
+            init_vision=init_vision,
+            init_audio=init_audio,
+            init_tts=init_tts,
+            **(load_options or {"device_map": device})
+        )
+
+        if quantization == "dynamic int8 (CPU)":
+            # 仅量化语言模型主干的线性层，视觉/音频部分保持 float32
+            print("正在对语言模型进行 int8 动态量化...")
+            target = getattr(model, "llm", model)
+            # 原地替换线性层，避免先深拷贝整个 float32 语言模型使峰值内存翻倍
+            torch.ao.quantization.quantize_dynamic(target, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        
+        # 流式生成提前停止或被中断时结束生成线程
+        install_generation_hooks(model)
+
+        print("正在加载分词器...")
+        tokenizer = AutoTokenizer.from_pretrained(
+            str(model_path),
+            trust_remote_code=True
+        )
+        
+        return (model, tokenizer)
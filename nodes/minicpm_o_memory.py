@@ -0,0 +1,381 @@
+import inspect
+import math
+import threading
+from pathlib import Path
+
+import torch
+
+from .minicpm_o_lazy import LazyModalityModel
+from .minicpm_o_replicas import ReplicatedModel
+
+# 推理显存估算之外的固定余量（CUDA 工作区、分配器碎片等）
+RESERVED_BYTES = 256 * 1024 ** 2
+ESTIMATE_MARGIN = 1.2
+
+
+def _config_value(config, name, default):
+    value = config.get(name) if isinstance(config, dict) else getattr(config, name, None)
+    return value or default
+
+
+def _slice_config(model):
+    slice_config = getattr(getattr(model, "config", None), "slice_config", None)
+    return (_config_value(slice_config, "scale_resolution", 448),
+            _config_value(slice_config, "max_slice_nums", 9))
+
+
+def image_crops(model, width, height):
+    """推算一张图像经 MiniCPM-o 切片后的子图数（含缩略图）"""
+    scale_resolution, max_slice_nums = _slice_config(model)
+    slices = min(max_slice_nums, math.ceil(width * height / scale_resolution ** 2))
+    return 1 if slices <= 1 else slices + 1
+
+
+def estimate_inference_memory(model, images=1, crops=None, max_new_tokens=512, batch_size=1, prompt_tokens=256):
+    """估算一次 model.chat 调用所需的推理显存（字节），不含模型权重
+
+    images 为每个对话的图像数，crops 为每张图像的子图数（默认取切片上限），prompt_tokens 为文本与音频 token 数；
+    主要由 KV 缓存、预填充激活与视觉编码激活组成，预填充与视觉编码不会同时达到峰值。
+    """
+    config = getattr(model, "config", None)
+    scale_resolution, max_slice_nums = _slice_config(model)
+    crops = crops or max_slice_nums + 1
+    dtype = getattr(model, "dtype", torch.bfloat16)
+    element = torch.finfo(dtype).bits // 8 if dtype.is_floating_point else 2
+
+    hidden = _config_value(config, "hidden_size", 3584)
+    layers = _config_value(config, "num_hidden_layers", 28)
+    heads = _config_value(config, "num_attention_heads", 28)
+    kv_heads = _config_value(config, "num_key_value_heads", 4)
+    intermediate = _config_value(config, "intermediate_size", 18944)
+    vocab = _config_value(config, "vocab_size", 151700)
+    query_num = _config_value(config, "query_num", 64)
+    vision_config = getattr(config, "vision_config", None)
+    vision_hidden = _config_value(vision_config, "hidden_size", 1152)
+    vision_intermediate = _config_value(vision_config, "intermediate_size", 4304)
+    patch_size = _config_value(vision_config, "patch_size", 14)
+
+    # 每个子图经重采样后为 query_num 个 token，另加图像起止标记
+    prompt_length = images * crops * (query_num + 4) + prompt_tokens
+    sequence = prompt_length + max_new_tokens
+    kv_cache = 2 * layers * kv_heads * (hidden // heads) * sequence * batch_size * element
+    prefill = batch_size * prompt_length * (hidden * 4 + intermediate * 2) * element
+    # 视觉编码器一次处理批内所有子图
+    patches = (scale_resolution // patch_size) ** 2
+    vision = batch_size * images * crops * patches * (vision_hidden * 6 + vision_intermediate * 2) * element if images else 0
+    # 采样时的 float32 logits 与 softmax
+    logits = batch_size * vocab * 4 * 2
+    return int((kv_cache + max(prefill, vision) + logits) * ESTIMATE_MARGIN) + RESERVED_BYTES
+
+
+def _module_bytes(module):
+    return sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+
+
+def _decoder_layers(model):
+    """返回语言模型的解码层列表，显存不足时这些层按需在设备间搬运"""
+    llm = getattr(model, "llm", model)
+    layers = getattr(getattr(llm, "model", None), "layers", None)
+    return list(layers) if isinstance(layers, torch.nn.ModuleList) else []
+
+
+def _move_tensors(module, device):
+    """只移动模块自身的参数与缓冲区，不递归子模块"""
+    for param in module._parameters.values():
+        if param is not None and param.device != device:
+            param.data = param.data.to(device)
+    for name, buffer in module._buffers.items():
+        if buffer is not None and buffer.device != device:
+            module._buffers[name] = buffer.to(device)
+
+
+class _LayerStreamer:
+    """逐层搬运留在卸载设备上的解码层
+
+    卸载设备上的权重是主副本（CUDA 可用时放在锁页内存中），前向前拷贝到计算设备、前向后直接丢弃该副本，
+    不再回拷。执行一层时预取下一个卸载层（最后一层预取第一层，供下一个 token 使用），
+    CUDA 上预取在独立的流中进行，与当前层的计算重叠；计算设备上因此同时最多有两层的副本。
+    """
+
+    def __init__(self, layers, device, offload_device):
+        self.layers = list(layers)
+        self.device = device
+        self._next = {id(layer): self.layers[(i + 1) % len(self.layers)] for i, layer in enumerate(self.layers)}
+        self._prefetched = {}
+        self._active = {}
+        self._stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        self.transfers = 0
+        self.prefetch_hits = 0
+        pin = self._stream is not None and offload_device.type == "cpu"
+        for layer in self.layers:
+            layer.to(offload_device)
+            if pin:
+                for store, name in self._tensors(layer):
+                    self._assign(store, name, store[name].data.pin_memory())
+            layer._minicpm_stream_hooks = (layer.register_forward_pre_hook(self._pre),
+                                           layer.register_forward_hook(self._post))
+
+    @staticmethod
+    def _tensors(layer):
+        return [(store, name) for module in layer.modules() for store in (module._parameters, module._buffers)
+                for name, tensor in store.items() if tensor is not None]
+
+    @staticmethod
+    def _assign(store, name, tensor):
+        # 参数只替换数据，保持 Parameter 对象不变
+        if isinstance(store[name], torch.nn.Parameter):
+            store[name].data = tensor
+        else:
+            store[name] = tensor
+
+    def _copy(self, layer):
+        self.transfers += 1
+        entries = self._tensors(layer)
+        if self._stream is None:
+            return [(store, name, store[name].data.to(self.device)) for store, name in entries], None
+        with torch.cuda.stream(self._stream):
+            copies = [(store, name, store[name].data.to(self.device, non_blocking=True)) for store, name in entries]
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        return copies, event
+
+    def _pre(self, layer, args):
+        prefetched = self._prefetched.pop(id(layer), None)
+        if prefetched is not None:
+            self.prefetch_hits += 1
+        copies, event = prefetched or self._copy(layer)
+        if event is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            for _, _, copy in copies:
+                copy.record_stream(current)
+        self._active[id(layer)] = [(store, name, store[name].data) for store, name, _ in copies]
+        for store, name, copy in copies:
+            self._assign(store, name, copy)
+        following = self._next[id(layer)]
+        if following is not layer and id(following) not in self._prefetched:
+            self._prefetched[id(following)] = self._copy(following)
+
+    def _post(self, layer, args, output):
+        for store, name, master in self._active.pop(id(layer), ()):
+            self._assign(store, name, master)
+
+    def remove(self):
+        """移除钩子并释放计算设备上的副本，权重恢复为卸载设备上的主副本"""
+        for layer in self.layers:
+            self._post(layer, None, None)
+            for handle in getattr(layer, "_minicpm_stream_hooks", None) or ():
+                handle.remove()
+            layer._minicpm_stream_hooks = None
+        self._prefetched.clear()
+
+
+def place_modules(model, device, offload_device, budget=None):
+    """按显存预算放置模型，返回在 device 上占用的权重字节数
+
+    解码层之外的部分（嵌入、视觉/音频编码器、输出层）始终放在 device 上，
+    解码层按顺序放入直到用完预算，其余层留在 offload_device 上逐层搬运执行，
+    并为逐层搬运预留两层的显存（当前层与预取层）。budget 为 None 时全部放在 device 上。
+    """
+    device, offload_device = torch.device(device), torch.device(offload_device)
+    streamer = getattr(model, "_minicpm_layer_streamer", None)
+    if streamer is not None:
+        streamer.remove()
+        model._minicpm_layer_streamer = None
+
+    layers = _decoder_layers(model)
+    layer_modules = {id(m) for layer in layers for m in layer.modules()}
+    resident = 0
+    for module in model.modules():
+        if id(module) in layer_modules:
+            continue
+        _move_tensors(module, device)
+        resident += sum(t.numel() * t.element_size() for t in list(module._parameters.values()) +
+                        list(module._buffers.values()) if t is not None)
+
+    sizes = [_module_bytes(layer) for layer in layers]
+    keep = len(layers)
+    reserve = 0
+    if budget is not None and device != offload_device and resident + sum(sizes) > budget:
+        reserve = 2 * max(sizes)
+        keep = 0
+        while keep < len(layers) and resident + sum(sizes[:keep + 1]) + reserve <= budget:
+            keep += 1
+    for layer in layers[:keep]:
+        layer.to(device)
+    streamed = layers[keep:]
+    if streamed:
+        model._minicpm_layer_streamer = _LayerStreamer(streamed, device, offload_device)
+        print(f"显存不足，{len(streamed)}/{len(layers)} 个解码层留在 {offload_device} 上逐层执行")
+    return resident + sum(sizes[:keep]) + (reserve if streamed else 0)
+
+
+def managed_module(model):
+    """返回可交给 ComfyUI 管理的 nn.Module，不支持时返回 None
+
+    多副本、量化或按 device_map 切分到多个设备的模型由各自的加载方式固定位置，不参与管理。
+    """
+    if isinstance(model, ReplicatedModel):
+        return None
+    base = model.base_model if isinstance(model, LazyModalityModel) else model
+    if not isinstance(base, torch.nn.Module):
+        return None
+    if getattr(base, "is_quantized", False) or getattr(base, "is_loaded_in_8bit", False) \
+            or getattr(base, "is_loaded_in_4bit", False):
+        return None
+    device_map = getattr(base, "hf_device_map", None)
+    if device_map and len(set(map(str, device_map.values()))) > 1:
+        return None
+    return base
+
+
+_patcher_class = None
+_patcher_lock = threading.Lock()
+
+# MiniCPMModelPatcher 覆盖的 ModelPatcher 方法及其依赖的参数名，ComfyUI 版本不一致时不接管显存
+PATCHER_OVERRIDES = {
+    "load": ("device_to", "lowvram_model_memory", "full_load"),
+    "partially_load": ("device_to", "extra_memory"),
+    "partially_unload": ("device_to", "memory_to_free"),
+    "unpatch_model": ("device_to", "unpatch_weights"),
+    "model_size": (),
+    "loaded_size": (),
+    "current_loaded_device": (),
+    "model_dtype": (),
+}
+
+
+def patcher_compatible(base):
+    """检查 ModelPatcher 是否提供 MiniCPMModelPatcher 覆盖的方法与参数"""
+    for name, params in PATCHER_OVERRIDES.items():
+        method = getattr(base, name, None)
+        if method is None:
+            return False
+        try:
+            signature = inspect.signature(method).parameters
+        except (TypeError, ValueError):
+            return False
+        if any(param not in signature for param in params):
+            return False
+    return True
+
+
+def _get_patcher_class():
+    """按需定义 ModelPatcher 子类，ComfyUI 不可用时返回 None"""
+    global _patcher_class
+    if _patcher_class is not None:
+        return _patcher_class
+    try:
+        import comfy.model_patcher
+    except ImportError:
+        return None
+    if not patcher_compatible(comfy.model_patcher.ModelPatcher):
+        print("警告: 当前 ComfyUI 的 ModelPatcher 接口与 MiniCPM 显存管理不兼容，模型保持在加载设备上")
+        return None
+
+    class MiniCPMModelPatcher(comfy.model_patcher.ModelPatcher):
+        """MiniCPM-o 的 ModelPatcher
+
+        ComfyUI 的部分加载依赖 comfy.ops 的权重转换，这里改为按解码层放置：
+        显存不足时一部分解码层留在卸载设备上逐层搬运执行。
+        """
+
+        def model_size(self):
+            # 延迟加载的模态会在运行中增加权重
+            self.size = _module_bytes(self.model)
+            return self.size
+
+        def loaded_size(self):
+            return self.model.model_loaded_weight_memory
+
+        def current_loaded_device(self):
+            return self.load_device if self.model.model_loaded_weight_memory > 0 else self.offload_device
+
+        def model_dtype(self):
+            return self.model.dtype
+
+        def _place(self, device, budget):
+            loaded = place_modules(self.model, device, self.offload_device, budget)
+            self.model.model_loaded_weight_memory = loaded if device != self.offload_device else 0
+            self.model.model_lowvram = getattr(self.model, "_minicpm_layer_streamer", None) is not None
+            return loaded
+
+        def load(self, device_to=None, lowvram_model_memory=0, force_patch_weights=False, full_load=False, **kwargs):
+            budget = None if full_load or lowvram_model_memory == 0 else lowvram_model_memory
+            self._place(device_to or self.load_device, budget)
+
+        def partially_load(self, device_to, extra_memory=0, force_patch_weights=False, **kwargs):
+            before = self.model.model_loaded_weight_memory
+            return self._place(device_to, before + extra_memory) - before
+
+        def partially_unload(self, device_to, memory_to_free=0, **kwargs):
+            before = self.model.model_loaded_weight_memory
+            return before - self._place(self.load_device, max(0, before - memory_to_free))
+
+        def unpatch_model(self, device_to=None, unpatch_weights=True, **kwargs):
+            if hasattr(self, "eject_model"):
+                self.eject_model()
+            if unpatch_weights and device_to is not None:
+                self._place(device_to, None)
+
+    _patcher_class = MiniCPMModelPatcher
+    return _patcher_class
+
+
+def get_patcher(model):
+    """返回模型对应的 ModelPatcher（首次调用时创建），不支持时返回 None"""
+    module = managed_module(model)
+    if module is None:
+        return None
+    patcher = getattr(module, "_minicpm_patcher", None)
+    if patcher is not None:
+        return patcher
+    with _patcher_lock:
+        patcher = getattr(module, "_minicpm_patcher", None)
+        if patcher is not None:
+            return patcher
+        patcher_class = _get_patcher_class()
+        if patcher_class is None:
+            return None
+        import comfy.model_management
+        device = next(module.parameters()).device
+        if device.type != "cuda":
+            return None
+        # 加载节点已把权重放在显卡上，按已加载记账，避免 ComfyUI 为其重复腾出显存
+        size = _module_bytes(module)
+        module.model_loaded_weight_memory = size
+        module.model_lowvram = False
+        patcher = patcher_class(module, load_device=device,
+                                offload_device=comfy.model_management.text_encoder_offload_device(), size=size)
+        module._minicpm_patcher = patcher
+        return patcher
+
+
+def load_for_inference(model, images=1, crops=None, max_new_tokens=512, batch_size=1, prompt_tokens=256):
+    """推理前通过 comfy.model_management 加载模型并预留推理显存
+
+    与扩散模型等共同参与 ComfyUI 的显存调度：显存不足时先卸载其他空闲模型，
+    仍不足时部分解码层留在内存中逐层执行，而不是直接 OOM。不在 ComfyUI 中运行时不做任何事。
+    """
+    patcher = get_patcher(model)
+    if patcher is None:
+        return 0
+    import comfy.model_management
+    memory_required = estimate_inference_memory(model, images, crops, max_new_tokens, batch_size, prompt_tokens)
+    comfy.model_management.load_models_gpu([patcher], memory_required=memory_required)
+    print(f"推理显存预估: {memory_required / 1024 ** 3:.2f}GB, "
+          f"模型已加载 {patcher.loaded_size() / 1024 ** 3:.2f}/{patcher.model_size() / 1024 ** 3:.2f}GB")
+    return memory_required
+
+
+def free_memory_for_load(model_path, device):
+    """从磁盘加载到显卡前，请 ComfyUI 按权重文件大小腾出显存"""
+    if not str(device).startswith("cuda") or not torch.cuda.is_available():
+        return
+    try:
+        import comfy.model_management
+    except ImportError:
+        return
+    size = sum(f.stat().st_size for f in Path(model_path).glob("*.safetensors"))
+    if size:
+        comfy.model_management.free_memory(size, torch.device(device))
@@ -0,0 +1,306 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+
+from .minicpm_o_registry import process_rss_bytes
+from .minicpm_o_lazy import LazyModalityModel
+
+PROFILE_MODES = ["Off", "torch.profiler", "cProfile"]
+
+# 视觉 / 音频编码子模块，前向耗时分别计入对应阶段
+ENCODER_STAGES = {
+    "vpm": "vision_encode",
+    "resampler": "vision_encode",
+    "apm": "audio_encode",
+}
+
+
+class CallMetrics:
+    """一次节点调用的性能记录
+
+    各阶段耗时累加到 stages；语言模型的预填充与逐 token 解码由模型钩子自动记录，
+    生成 token 数按解码步数乘批大小统计（批内已结束的序列也计入）。
+    """
+
+    def __init__(self, node, info=None, sample_interval=0.05):
+        self.node = node
+        self.info = dict(info or {})
+        self.stages = {}
+        self.tokens = 0
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._last_step = None
+        self._sample_interval = sample_interval
+        self._stop = threading.Event()
+        self._sampler = None
+        self.peak_ram = process_rss_bytes()
+        self.peak_vram = 0
+        self.total_time = None
+        self.profile = None
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timed_iter(self, iterable, name):
+        """迭代 iterable，并把等待每个元素的时间计入 name 阶段"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add(name, time.perf_counter() - start)
+            yield item
+
+    def _llm_step(self, batch, length):
+        """语言模型每次前向前调用：length > 1 为预填充，否则为一步解码"""
+        now = time.perf_counter()
+        kind = "prefill" if length > 1 else "decode"
+        with self._lock:
+            last = self._last_step
+            if last is not None:
+                last_kind, last_start, last_end = last
+                # 解码步紧接在上一步之后，间隔内包含采样；新的预填充之前的间隔不属于生成
+                end = now if kind == "decode" and last_end is not None else (last_end or now)
+                self.stages[last_kind] = self.stages.get(last_kind, 0.0) + max(0.0, end - last_start)
+            self._last_step = [kind, now, None]
+            self.tokens += batch
+
+    def _llm_step_done(self):
+        with self._lock:
+            if self._last_step is not None:
+                self._last_step[2] = time.perf_counter()
+
+    def _flush_steps(self):
+        with self._lock:
+            if self._last_step is not None:
+                kind, start, end = self._last_step
+                self.stages[kind] = self.stages.get(kind, 0.0) + max(0.0, (end or time.perf_counter()) - start)
+                self._last_step = None
+
+    def _sample_memory(self):
+        while not self._stop.wait(self._sample_interval):
+            self.peak_ram = max(self.peak_ram, process_rss_bytes())
+
+    def _begin(self):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._sampler = threading.Thread(target=self._sample_memory, name="minicpm-metrics", daemon=True)
+        self._sampler.start()
+
+    def _finish(self):
+        self._flush_steps()
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join(timeout=1)
+        self.peak_ram = max(self.peak_ram, process_rss_bytes())
+        if torch.cuda.is_available():
+            self.peak_vram = torch.cuda.max_memory_allocated()
+        self.total_time = time.perf_counter() - self._start
+
+    def as_dict(self):
+        decode_time = self.stages.get("decode", 0.0)
+        record = {
+            "node": self.node,
+            "timestamp": round(self.started, 3),
+            **self.info,
+            "total_time": round(self.total_time, 4) if self.total_time is not None else None,
+            "stages": {name: round(value, 4) for name, value in self.stages.items()},
+            "tokens": self.tokens,
+            "tokens_per_sec": round(self.tokens / decode_time, 2) if decode_time > 0 else None,
+            "peak_ram_mb": round(self.peak_ram / 1024 ** 2, 1),
+            "peak_vram_mb": round(self.peak_vram / 1024 ** 2, 1),
+        }
+        if self.profile:
+            record["profile"] = self.profile
+        return record
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), ensure_ascii=False)
+
+
+def _sequence_shape(args, kwargs):
+    """从语言模型前向参数中取出 (批大小, 序列长度)"""
+    for name in ("inputs_embeds", "input_ids"):
+        tensor = kwargs.get(name)
+        if tensor is not None:
+            return tensor.shape[0], tensor.shape[1] if tensor.dim() > 1 else 1
+    if args and hasattr(args[0], "shape") and args[0].dim() > 1:
+        return args[0].shape[0], args[0].shape[1]
+    return 1, 1
+
+
+class Instrumentation:
+    """记录节点调用的阶段耗时、token 数与峰值内存
+
+    call() 期间在模型上注册前向钩子（只注册一次），视觉编码、预填充和解码耗时由钩子计入
+    当前线程的记录；在生成线程或调度器线程中执行时计入唯一一个进行中的记录。
+    每条记录追加写入 JSONL 日志，可通过环境变量 MINICPM_METRICS_LOG 指定路径，设为 0 时不写日志。
+    """
+
+    def __init__(self, log_path=None):
+        self._log_path = log_path or os.environ.get("MINICPM_METRICS_LOG")
+        self._local = threading.local()
+        self._active = []
+        self._lock = threading.Lock()
+
+    def _get_log_path(self):
+        if self._log_path is None:
+            try:
+                import folder_paths
+                self._log_path = str(Path(folder_paths.get_output_directory()) / "minicpm_metrics" / "calls.jsonl")
+            except ImportError:
+                self._log_path = "0"
+        return None if self._log_path == "0" else Path(self._log_path)
+
+    def current(self):
+        record = getattr(self._local, "record", None)
+        if record is not None:
+            return record
+        with self._lock:
+            return self._active[0] if len(self._active) == 1 else None
+
+    def instrument(self, model):
+        """在模型的语言模型主干与编码器上注册计时钩子，已注册的子模块会跳过"""
+        if model is None:
+            return
+        base = model.base_model if isinstance(model, LazyModalityModel) else model
+        llm = getattr(base, "llm", None)
+        if isinstance(llm, torch.nn.Module) and not getattr(llm, "_minicpm_metrics_hooked", False):
+            def llm_pre(module, args, kwargs):
+                record = self.current()
+                if record is not None:
+                    record._llm_step(*_sequence_shape(args, kwargs))
+
+            def llm_post(module, args, output):
+                record = self.current()
+                if record is not None:
+                    record._llm_step_done()
+
+            llm.register_forward_pre_hook(llm_pre, with_kwargs=True)
+            llm.register_forward_hook(llm_post)
+            llm._minicpm_metrics_hooked = True
+
+        for name, stage in ENCODER_STAGES.items():
+            module = getattr(base, name, None)
+            if not isinstance(module, torch.nn.Module) or getattr(module, "_minicpm_metrics_hooked", False):
+                continue
+            self._hook_encoder(module, stage)
+            module._minicpm_metrics_hooked = True
+
+    def _hook_encoder(self, module, stage):
+        starts = threading.local()
+
+        def pre(module, args):
+            starts.value = time.perf_counter()
+
+        def post(module, args, output):
+            record = self.current()
+            start = getattr(starts, "value", None)
+            if record is None or start is None:
+                return
+            # 编码器每次调用只执行一次，同步后的耗时才准确
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            record.add(stage, time.perf_counter() - start)
+
+        module.register_forward_pre_hook(pre)
+        module.register_forward_hook(post)
+
+    @contextmanager
+    def call(self, node, model=None, profile="Off", **info):
+        """记录一次节点调用，返回 CallMetrics；profile 可选 torch.profiler 或 cProfile"""
+        record = CallMetrics(node, info)
+        self.instrument(model)
+        previous = getattr(self._local, "record", None)
+        self._local.record = record
+        with self._lock:
+            self._active.append(record)
+        record._begin()
+        try:
+            with profile_run(profile, node, record):
+                yield record
+        finally:
+            # 延迟加载的编码器可能在本次调用中才创建
+            self.instrument(model)
+            record._finish()
+            self._local.record = previous
+            with self._lock:
+                self._active.remove(record)
+            self.write(record)
+            print(f"性能记录: {record.to_json()}")
+
+    def write(self, record):
+        path = self._get_log_path()
+        if path is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with self._lock, open(path, "a", encoding="utf-8") as f:
+                f.write(record.to_json() + "\n")
+        except OSError as e:
+            print(f"无法写入性能日志 {path}: {e}")
+
+
+def _profile_path(node, suffix):
+    try:
+        import folder_paths
+        directory = Path(folder_paths.get_output_directory()) / "minicpm_metrics"
+    except ImportError:
+        directory = Path.cwd() / "minicpm_metrics"
+    directory.mkdir(parents=True, exist_ok=True)
+    name = "".join(c if c.isalnum() else "_" for c in node)
+    return directory / f"profile_{name}_{time.strftime('%Y%m%d_%H%M%S')}{suffix}"
+
+
+@contextmanager
+def profile_run(mode, node, record=None):
+    """按需对一次运行进行性能剖析，结果写入输出目录下的 minicpm_metrics"""
+    if mode == "torch.profiler":
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities, profile_memory=True) as profiler:
+            yield
+        path = _profile_path(node, ".json")
+        profiler.export_chrome_trace(str(path))
+        print(profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=15))
+    elif mode == "cProfile":
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+        path = _profile_path(node, ".prof")
+        profiler.dump_stats(str(path))
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+    else:
+        yield
+        return
+    print(f"性能剖析结果已保存: {path}")
+    if record is not None:
+        record.profile = str(path)
+
+
+# 进程级单例
+INSTRUMENTATION = Instrumentation()
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+# 需要放入 transformers 远程代码模块缓存的文件（模型代码在运行时才导入它，transformers 不会自动复制）
+REMOTE_CODE_FILES = ("image_processing_minicpmv.py",)
+MANIFEST_NAME = "minicpm_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def hf_modules_cache():
+    """按 transformers 的规则推算远程代码模块缓存目录，无需导入 transformers"""
+    if os.environ.get("HF_MODULES_CACHE"):
+        return Path(os.environ["HF_MODULES_CACHE"])
+    hf_home = os.environ.get("HF_HOME") or Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "huggingface"
+    return Path(hf_home) / "modules"
+
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def directory_signature(model_path):
+    """模型目录顶层文件的 (名称, 大小, 修改时间)，文件有增删改时签名随之变化"""
+    entries = []
+    for entry in os.scandir(model_path):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append([entry.name, stat.st_size, stat.st_mtime_ns])
+    return sorted(entries)
+
+
+def validate_model_dir(model_path):
+    """检查加载所需的文件是否齐全，返回问题列表"""
+    model_path = Path(model_path)
+    config_path = model_path / "config.json"
+    if not config_path.exists():
+        return ["缺少 config.json"]
+    problems = []
+    try:
+        with open(config_path, encoding="utf-8") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        return [f"无法读取 config.json: {e}"]
+
+    # auto_map 中引用的远程代码模块
+    for reference in (config.get("auto_map") or {}).values():
+        for ref in reference if isinstance(reference, list) else [reference]:
+            if not ref:
+                continue
+            module_file = ref.split("--")[-1].rsplit(".", 1)[0] + ".py"
+            if not (model_path / module_file).exists():
+                problems.append(f"缺少远程代码 {module_file}")
+
+    index_path = model_path / "model.safetensors.index.json"
+    if index_path.exists():
+        try:
+            with open(index_path, encoding="utf-8") as f:
+                shards = set(json.load(f)["weight_map"].values())
+        except (OSError, ValueError, KeyError) as e:
+            return problems + [f"无法读取 {index_path.name}: {e}"]
+        problems.extend(f"缺少权重分片 {shard}" for shard in sorted(shards) if not (model_path / shard).exists())
+    elif not any(model_path.glob("*.safetensors")) and not any(model_path.glob("pytorch_model*.bin")):
+        problems.append("缺少模型权重文件")
+
+    if not (model_path / "tokenizer_config.json").exists():
+        problems.append("缺少 tokenizer_config.json")
+    return sorted(set(problems))
+
+
+def _sync_file(source, target, digest):
+    """目标文件内容与源文件不同时才复制，返回是否复制"""
+    if target.exists() and target.stat().st_size == source.stat().st_size and file_digest(target) == digest:
+        return False
+    target.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy2(str(source), str(target))
+    return True
+
+
+class ModelFiles:
+    """加载前的模型目录检查与远程代码同步
+
+    第一次检查通过后把目录签名与远程代码哈希写入模块缓存目录下的清单，之后的加载（包括重启后）
+    只需对目录做一次 stat 比较；远程代码文件只在内容哈希变化时才复制。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prepared = {}
+
+    def prepare(self, model_path, model_name, fallback_modules_dir=None):
+        """检查模型目录并同步远程代码，返回 "memory" / "manifest" / "validated" 表示走了哪条路径"""
+        model_path = Path(model_path)
+        with self._lock:
+            signature = directory_signature(model_path)
+            if self._prepared.get(str(model_path)) == signature:
+                return "memory"
+
+            modules_dir = hf_modules_cache() / "transformers_modules" / model_name
+            manifest_path = modules_dir / MANIFEST_NAME
+            manifest = self._read_manifest(manifest_path)
+            if (manifest.get("version") == MANIFEST_VERSION and manifest.get("model_path") == str(model_path)
+                    and manifest.get("signature") == signature
+                    and all((modules_dir / name).exists() for name in manifest.get("remote_code", {}))):
+                self._prepared[str(model_path)] = signature
+                return "manifest"
+
+            problems = validate_model_dir(model_path)
+            if problems:
+                raise ValueError(f"模型目录不完整 {model_path}: " + "; ".join(problems))
+
+            remote_code = {name: file_digest(model_path / name) for name in REMOTE_CODE_FILES
+                           if (model_path / name).exists()}
+            try:
+                copied = [name for name, digest in remote_code.items()
+                          if _sync_file(model_path / name, modules_dir / name, digest)]
+            except OSError as e:
+                if fallback_modules_dir is None:
+                    raise
+                print(f"无法写入模块缓存 {modules_dir}: {e}，改用 {fallback_modules_dir}")
+                modules_dir = self._use_fallback(Path(fallback_modules_dir), model_name)
+                manifest_path = modules_dir / MANIFEST_NAME
+                copied = [name for name, digest in remote_code.items()
+                          if _sync_file(model_path / name, modules_dir / name, digest)]
+            if copied:
+                print(f"已更新远程代码: {', '.join(copied)}")
+
+            self._write_manifest(manifest_path, {
+                "version": MANIFEST_VERSION,
+                "model_path": str(model_path),
+                "signature": signature,
+                "remote_code": remote_code,
+            })
+            self._prepared[str(model_path)] = signature
+            return "validated"
+
+    @staticmethod
+    def _use_fallback(fallback_modules_dir, model_name):
+        """默认模块缓存不可写时改用备用目录
+
+        transformers 在导入时读取这些环境变量，加载节点把 transformers 的导入推迟到此之后，
+        因此只在确实需要时修改，且同一进程中只改一次。
+        """
+        os.environ["HF_HOME"] = str(fallback_modules_dir.parent)
+        os.environ["HF_MODULES_CACHE"] = str(fallback_modules_dir)
+        return fallback_modules_dir / "transformers_modules" / model_name
+
+    @staticmethod
+    def _read_manifest(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_manifest(path, manifest):
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"无法写入模型清单 {path}: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._prepared.clear()
+
+
+# 进程级单例
+MODEL_FILES = ModelFiles()
@@ -0,0 +1,153 @@
+import copy
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+
+import torch
+
+_SPLIT_MARKER = "\u0000MINICPM_PREFIX_SPLIT\u0000"
+
+
+def build_messages(content, instruction, use_prefix):
+    """构建单轮对话消息
+
+    use_prefix 为 True 时把固定的指令放入 system 消息，使其位于图像之前、构成可复用的前缀；
+    否则沿用原有格式，将图像与指令一起放在 user 消息中。
+    """
+    if use_prefix:
+        return [
+            {'role': 'system', 'content': instruction},
+            {'role': 'user', 'content': list(content)},
+        ]
+    return [{'role': 'user', 'content': [*content, instruction]}]
+
+
+class _PrefixEntry:
+    def __init__(self, embeds, past_key_values):
+        self.embeds = embeds
+        self.past_key_values = past_key_values
+        self.length = embeds.shape[0]
+
+
+class PrefixKVCache:
+    """固定提示词前缀的 KV 缓存
+
+    每个已加载模型、每个 system 提示词只预填充一次，得到前缀的 KV 状态；之后 llm.generate
+    的输入嵌入若以该前缀开头，就传入其副本作为 past_key_values，跳过前缀的重复编码。
+    缓存按模型弱引用保存，模型被释放或提示词改变时自动失效。
+    """
+
+    def __init__(self, max_prefixes_per_model=8):
+        self.max_prefixes_per_model = max_prefixes_per_model
+        self._entries = weakref.WeakKeyDictionary()
+        self._disabled = weakref.WeakSet()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.last_error = None
+
+    @staticmethod
+    def _prefix_ids(tokenizer, instruction):
+        """计算 system 消息及 user 消息开头对应的 token 序列"""
+        text = tokenizer.apply_chat_template(
+            [{'role': 'system', 'content': instruction}, {'role': 'user', 'content': _SPLIT_MARKER}],
+            tokenize=False, add_generation_prompt=True
+        )
+        prefix_text = text.split(_SPLIT_MARKER)[0]
+        ids = tokenizer(prefix_text, add_special_tokens=False, return_tensors="pt")["input_ids"][0]
+        # 去掉最后一个 token，避免与后续的图像占位符合并分词导致边界不一致
+        return ids[:-1]
+
+    def prepare(self, model, tokenizer, instruction):
+        """确保指定提示词的前缀已预填充"""
+        llm = getattr(model, "llm", None)
+        if llm is None or not instruction:
+            return False
+        self._install(llm)
+        if llm in self._disabled:
+            return False
+
+        key = hashlib.sha256(instruction.encode()).hexdigest()
+        with self._lock:
+            entries = self._entries.setdefault(llm, OrderedDict())
+            if key in entries:
+                entries.move_to_end(key)
+                return True
+
+            embed_layer = llm.get_input_embeddings()
+            ids = self._prefix_ids(tokenizer, instruction).to(embed_layer.weight.device)
+            with torch.no_grad():
+                embeds = embed_layer(ids.unsqueeze(0))
+                output = llm(inputs_embeds=embeds, use_cache=True)
+            past_key_values = output.past_key_values
+            if isinstance(past_key_values, tuple):
+                from transformers import DynamicCache
+                past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+            entries[key] = _PrefixEntry(embeds[0], past_key_values)
+            while len(entries) > self.max_prefixes_per_model:
+                entries.popitem(last=False)
+            print(f"已预填充提示词前缀: {ids.shape[0]} tokens")
+            return True
+
+    def _match(self, llm, inputs_embeds):
+        """查找与输入嵌入开头完全一致的前缀"""
+        if inputs_embeds is None or inputs_embeds.dim() != 3 or inputs_embeds.shape[0] != 1:
+            return None
+        with self._lock:
+            entries = self._entries.get(llm)
+            if not entries:
+                return None
+            for entry in entries.values():
+                if inputs_embeds.shape[1] > entry.length and \
+                        torch.equal(inputs_embeds[0, :entry.length], entry.embeds):
+                    return entry
+        return None
+
+    def _install(self, llm):
+        """包装 llm.generate，在输入以已缓存前缀开头时注入 past_key_values"""
+        if getattr(llm, "_minicpm_prefix_cache_installed", False):
+            return
+        original = llm.generate
+        cache = self
+
+        def generate(*args, **kwargs):
+            entry = None
+            if "past_key_values" not in kwargs and llm not in cache._disabled:
+                entry = cache._match(llm, kwargs.get("inputs_embeds"))
+            if entry is None:
+                with cache._lock:
+                    cache.misses += 1
+                return original(*args, **kwargs)
+
+            with cache._lock:
+                cache.hits += 1
+            try:
+                return original(*args, past_key_values=copy.deepcopy(entry.past_key_values), **kwargs)
+            except (TypeError, ValueError, RuntimeError, IndexError) as e:
+                # 当前 transformers 版本不支持以 inputs_embeds 续接缓存时关闭该模型的前缀复用，改为完整预填充
+                with cache._lock:
+                    cache._disabled.add(llm)
+                    cache.hits -= 1
+                    cache.misses += 1
+                    cache.last_error = f"{type(e).__name__}: {e}"
+                print(f"警告: 前缀 KV 复用失败，已对该模型关闭，之后的请求将完整预填充。原因: {cache.last_error}")
+                return original(*args, **kwargs)
+
+        llm.generate = generate
+        llm._minicpm_prefix_cache_installed = True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "models": len(self._entries),
+                "prefixes": sum(len(entries) for entries in self._entries.values()),
+                "disabled_models": len(self._disabled),
+                "last_error": self.last_error,
+            }
+
+
+# 进程级单例
+PREFIX_CACHE = PrefixKVCache()
@@ -0,0 +1,68 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+
+def model_max_pixels(model, default_scale_resolution=448, default_max_slice_nums=9):
+    """根据模型切片配置推算预处理后最多保留的像素数
+
+    MiniCPM-o 的图像处理器会把图像缩放到最多 max_slice_nums 个 scale_resolution 见方的子图，
+    超出该面积的像素最终都会被缩小，因此可以在转换为 PIL 之前就在 tensor 上完成缩放。
+    """
+    slice_config = getattr(getattr(model, "config", None), "slice_config", None)
+    if isinstance(slice_config, dict):
+        scale_resolution = slice_config.get("scale_resolution")
+        max_slice_nums = slice_config.get("max_slice_nums")
+    else:
+        scale_resolution = getattr(slice_config, "scale_resolution", None)
+        max_slice_nums = getattr(slice_config, "max_slice_nums", None)
+    scale_resolution = scale_resolution or default_scale_resolution
+    max_slice_nums = max_slice_nums or default_max_slice_nums
+    return int(scale_resolution) ** 2 * int(max_slice_nums)
+
+
+def _target_size(height, width, max_pixels):
+    if not max_pixels or height * width <= max_pixels:
+        return height, width
+    scale = math.sqrt(max_pixels / (height * width))
+    return max(1, int(height * scale)), max(1, int(width * scale))
+
+
+def images_to_uint8(images, max_pixels=0, chunk_size=8):
+    """将 NHWC float 图像批次转换为 uint8 tensor 列表
+
+    每个分块只产生一个 float 临时张量：乘 255、裁剪和类型转换在同一张量上原地完成，
+    超出 max_pixels 的图像先在 tensor 上（可在 GPU 上）缩放，再以 uint8 拷回 CPU。
+    """
+    if images.dim() == 3:
+        images = images.unsqueeze(0)
+    height, width = images.shape[1:3]
+    target_height, target_width = _target_size(height, width, max_pixels)
+
+    results = []
+    with torch.no_grad():
+        for start in range(0, images.shape[0], chunk_size):
+            chunk = images[start:start + chunk_size]
+            if (target_height, target_width) != (height, width):
+                chunk = F.interpolate(chunk.permute(0, 3, 1, 2).float(), size=(target_height, target_width),
+                                      mode="bicubic", antialias=True, align_corners=False)
+                chunk = chunk.permute(0, 2, 3, 1).mul_(255)
+            else:
+                chunk = chunk.float().mul(255)
+            chunk = chunk.clamp_(0, 255).to(torch.uint8).cpu()
+            results.extend(chunk.unbind(0))
+    return results
+
+
+def tensor_batch_to_pil(images, max_pixels=0, chunk_size=8):
+    """将 NHWC float 图像批次转换为 PIL Image 列表"""
+    return [Image.fromarray(image.contiguous().numpy(), 'RGB') for image in images_to_uint8(images, max_pixels, chunk_size)]
+
+
+def tensor_to_pil(image, max_pixels=0):
+    """将单张 HWC（或 NHWC 的第一张）图像转换为 PIL Image"""
+    if image.dim() == 4:
+        image = image[:1]
+    return tensor_batch_to_pil(image, max_pixels, chunk_size=1)[0]
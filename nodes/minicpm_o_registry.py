@@ -0,0 +1,227 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_model_bytes(model):
+    """估算模型参数与缓冲区占用的字节数
+
+    动态量化后的线性层把权重打包在 _packed_params 中，不属于参数或缓冲区，需要单独计入。
+    多副本模型计入全部副本，工作进程中的副本使用其加载后报告的 size_bytes。
+    """
+    pool = getattr(model, "replica_pool", None)
+    if pool is not None:
+        return sum(estimate_model_bytes(replica) for replica in pool.replicas)
+    size_bytes = getattr(model, "size_bytes", None)
+    if isinstance(size_bytes, int):
+        return size_bytes
+    total = 0
+    try:
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            total += tensor.numel() * tensor.element_size()
+        for module in model.modules():
+            packed = getattr(module, "_packed_params", None)
+            if packed is not None and hasattr(packed, "_weight_bias"):
+                for tensor in packed._weight_bias():
+                    if tensor is not None:
+                        total += tensor.numel() * tensor.element_size()
+    except Exception:
+        return 0
+    return total
+
+
+class _RegistryEntry:
+    """注册表中的一个常驻模型"""
+
+    def __init__(self, key, model, tokenizer, size_bytes, load_time):
+        self.key = key
+        self.model = model
+        self.tokenizer = tokenizer
+        self.size_bytes = size_bytes
+        self.load_time = load_time
+        self.refcount = 0
+
+
+class ModelRegistry:
+    """进程级模型注册表
+
+    以 (模型路径, 设备, dtype, attn_implementation, 启用的模态) 为键缓存已加载的
+    模型与分词器。键相同时直接返回常驻实例。设置了内存预算时，超出预算才按 LRU 淘汰引用计数为 0 的条目；
+    未设置预算时只保留最近释放的一个空闲模型，在两组加载选项之间来回切换时不必重新加载，
+    更早的空闲模型立即移除。
+
+    内存预算由进程级默认值（MINICPM_MODEL_MEMORY_BUDGET_GB）与各加载节点登记的请求组成，
+    存在请求时取其中的最小值，结果与节点的执行顺序无关。
+    """
+
+    def __init__(self, memory_budget_bytes=None):
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._key_locks = {}
+        self._default_budget = memory_budget_bytes or None
+        self._budget_requests = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_load_time = 0.0
+
+    @staticmethod
+    def make_key(model_path, device, dtype, attn_implementation, modalities, options=()):
+        """构建注册表键，modalities 为已启用模态名称的可迭代对象，options 为其他加载选项"""
+        return (str(model_path), str(device), str(dtype), str(attn_implementation),
+                tuple(sorted(modalities)), tuple(str(option) for option in options))
+
+    @property
+    def memory_budget_bytes(self):
+        """当前生效的内存预算（字节），None 表示不限制"""
+        with self._lock:
+            if self._budget_requests:
+                return min(self._budget_requests.values())
+            return self._default_budget
+
+    def set_memory_budget(self, memory_budget_bytes):
+        """设置进程级默认内存预算（字节），None 或 0 表示不限制；加载节点登记的请求优先"""
+        with self._lock:
+            self._default_budget = memory_budget_bytes or None
+            self._evict()
+
+    def request_memory_budget(self, owner, memory_budget_bytes):
+        """登记 owner（加载节点）请求的内存预算，None 或 0 表示撤销该请求"""
+        with self._lock:
+            if memory_budget_bytes:
+                self._budget_requests[owner] = memory_budget_bytes
+            else:
+                self._budget_requests.pop(owner, None)
+            self._evict()
+
+    def acquire(self, key, factory):
+        """获取模型，未命中时调用 factory() -> (model, tokenizer) 加载，并增加引用计数"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                entry.refcount += 1
+                self._entries.move_to_end(key)
+                return entry.model, entry.tokenizer
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # 同一键只允许一个线程加载，其他线程等待后复用结果
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    entry.refcount += 1
+                    self._entries.move_to_end(key)
+                    return entry.model, entry.tokenizer
+                self.misses += 1
+
+            start = time.perf_counter()
+            model, tokenizer = factory()
+            load_time = time.perf_counter() - start
+
+            with self._lock:
+                entry = _RegistryEntry(key, model, tokenizer, estimate_model_bytes(model), load_time)
+                entry.refcount = 1
+                self._entries[key] = entry
+                self.total_load_time += load_time
+                self._key_locks.pop(key, None)
+                self._evict()
+                return model, tokenizer
+
+    def release(self, key):
+        """释放一次引用，引用计数归零后该模型才可被淘汰"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refcount = max(0, entry.refcount - 1)
+            self._evict()
+
+    def evict(self, key):
+        """强制移除指定模型（不检查引用计数）"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.evictions += 1
+            return entry is not None
+
+    def clear(self):
+        """清空注册表"""
+        with self._lock:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+
+    def refresh_sizes(self):
+        """重新估算各模型的内存占用（延迟加载的模态挂载或卸载后调用），并按新的占用检查预算"""
+        with self._lock:
+            for entry in self._entries.values():
+                entry.size_bytes = estimate_model_bytes(entry.model)
+            self._evict()
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(entry.size_bytes for entry in self._entries.values())
+
+    def _evict(self):
+        """按 LRU 顺序淘汰空闲模型，直到满足内存预算；未设置预算时只保留最近使用的一个空闲模型"""
+        budget = self.memory_budget_bytes
+        idle = [key for key, entry in self._entries.items() if entry.refcount == 0]
+        if budget is None:
+            idle = idle[:-1]
+        for key in idle:
+            if budget is not None and self.resident_bytes() <= budget:
+                break
+            del self._entries[key]
+            self.evictions += 1
+
+    def stats(self):
+        """返回命中/未命中/加载耗时等统计信息"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "total_load_time": self.total_load_time,
+                "resident_models": len(self._entries),
+                "resident_bytes": self.resident_bytes(),
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "entries": [
+                    {
+                        "key": entry.key,
+                        "refcount": entry.refcount,
+                        "size_bytes": entry.size_bytes,
+                        "load_time": entry.load_time,
+                    }
+                    for entry in self._entries.values()
+                ],
+            }
+
+
+def process_rss_bytes():
+    """返回当前进程的常驻内存（字节），无法获取时返回 0"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def _budget_from_env():
+    value = os.environ.get("MINICPM_MODEL_MEMORY_BUDGET_GB")
+    if not value:
+        return None
+    try:
+        return int(float(value) * 1024 ** 3)
+    except ValueError:
+        return None
+
+
+# 进程级单例
+MODEL_REGISTRY = ModelRegistry(memory_budget_bytes=_budget_from_env())
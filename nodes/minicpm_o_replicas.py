@@ -0,0 +1,375 @@
+"""数据并行的模型副本
+
+本模块不使用包内相对导入：CPU 工作进程以脚本方式运行本文件（python minicpm_o_replicas.py --worker），
+在独立进程中加载模型副本，通过 multiprocessing.connection 接收 model.chat 调用。
+"""
+import importlib.util
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import Future
+
+STOP = object()
+# 批量对话按副本数的这一倍数切分，先完成的副本才有剩余的块可以窃取
+CHUNKS_PER_REPLICA = 4
+
+
+def parse_replica_spec(spec):
+    """解析副本配置
+
+    "cuda:0,cuda:1" 表示在每个设备上各加载一个进程内副本；"cpu*4" 表示共 4 个 CPU 副本，
+    其中一个在当前进程，其余在独立的工作进程中。空字符串表示不启用。
+    返回 (设备列表, CPU 副本数)。
+    """
+    spec = (spec or "").replace(" ", "")
+    if not spec:
+        return [], 0
+    if spec.startswith("cpu*"):
+        count = int(spec[4:])
+        if count < 1:
+            raise ValueError(f"CPU 副本数必须大于 0: {spec}")
+        return [], count
+    devices = [device for device in spec.split(",") if device]
+    if any(device == "cpu" for device in devices) and len(devices) > 1:
+        raise ValueError("CPU 多副本请使用 cpu*N 形式")
+    return devices, 0
+
+
+class ReplicaPool:
+    """带工作窃取队列的副本池
+
+    每个副本有一个工作线程和一个本地任务队列。map 先把任务按连续区间分配到各队列，
+    工作线程从自己队列的头部取任务，本地队列为空时从最长队列的尾部窃取，
+    速度不同的设备（或负载不均的任务）也能保持全部副本繁忙。
+    """
+
+    def __init__(self, replicas, labels=None):
+        self.replicas = list(replicas)
+        self.labels = list(labels or [str(i) for i in range(len(self.replicas))])
+        self._queues = [deque() for _ in self.replicas]
+        self._cond = threading.Condition()
+        self._closed = False
+        self.completed = [0] * len(self.replicas)
+        self.stolen = [0] * len(self.replicas)
+        self._threads = [
+            threading.Thread(target=self._worker, args=(i,), name=f"minicpm-replica-{self.labels[i]}", daemon=True)
+            for i in range(len(self.replicas))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def _next_task(self, index):
+        with self._cond:
+            while True:
+                if self._queues[index]:
+                    return self._queues[index].popleft()
+                victim = max(range(len(self._queues)), key=lambda i: len(self._queues[i]))
+                if self._queues[victim]:
+                    self.stolen[index] += 1
+                    return self._queues[victim].pop()
+                if self._closed:
+                    return STOP
+                self._cond.wait()
+
+    def _worker(self, index):
+        replica = self.replicas[index]
+        while True:
+            task = self._next_task(index)
+            if task is STOP:
+                return
+            fn, future = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(replica))
+            except BaseException as e:
+                future.set_exception(e)
+            with self._cond:
+                self.completed[index] += 1
+
+    def submit(self, fn):
+        """提交 fn(replica)，由最先空闲的副本执行"""
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("副本池已关闭")
+            index = min(range(len(self._queues)), key=lambda i: len(self._queues[i]))
+            self._queues[index].append((fn, future))
+            self._cond.notify_all()
+        return future
+
+    def map(self, fn, items):
+        """对每个元素执行 fn(replica, item)，按原顺序返回结果"""
+        items = list(items)
+        futures = [Future() for _ in items]
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("副本池已关闭")
+            count = len(self._queues)
+            for i, (item, future) in enumerate(zip(items, futures)):
+                # 连续区间分配给同一副本，空闲副本再从其他队列尾部窃取
+                self._queues[i * count // max(1, len(items))].append(
+                    (lambda replica, item=item: fn(replica, item), future))
+            self._cond.notify_all()
+        return [future.result() for future in futures]
+
+    def stats(self):
+        with self._cond:
+            return {
+                label: {"completed": completed, "stolen": stolen, "queued": len(queue)}
+                for label, completed, stolen, queue in zip(self.labels, self.completed, self.stolen, self._queues)
+            }
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        for replica in self.replicas:
+            if isinstance(replica, ProcessReplica):
+                replica.close()
+
+
+class ReplicatedModel:
+    """把多个模型副本包装为一个模型
+
+    属性访问转发给主副本（第一个副本），因此现有节点无需修改即可使用；model.chat 收到
+    批量对话时切分为副本数 CHUNKS_PER_REPLICA 倍的小块并行执行、按原顺序合并结果，
+    收到单个对话时交给最先空闲的副本。
+    视觉编码缓存依赖单一设备上的隐藏状态，对多副本模型不启用。
+    """
+
+    # 这些属性只对单个副本有意义，不对外暴露
+    _HIDDEN = ("get_vllm_embedding",)
+
+    def __init__(self, replicas, labels=None):
+        object.__setattr__(self, "_primary", replicas[0])
+        object.__setattr__(self, "_pool", ReplicaPool(replicas, labels))
+        weakref.finalize(self, self._pool.close)
+
+    def __getattr__(self, name):
+        if name in self._HIDDEN:
+            raise AttributeError(name)
+        return getattr(self._primary, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._primary, name, value)
+
+    def __repr__(self):
+        return f"ReplicatedModel({self._pool.labels})"
+
+    @property
+    def primary(self):
+        return self._primary
+
+    @property
+    def replica_pool(self):
+        return self._pool
+
+    @property
+    def replica_count(self):
+        return len(self._pool)
+
+    def chat(self, msgs=None, **kwargs):
+        batched = bool(msgs) and isinstance(msgs[0], list)
+        if not batched or len(msgs) == 1 or len(self._pool) == 1:
+            return self._pool.submit(lambda replica: replica.chat(msgs=msgs, **kwargs)).result()
+
+        count = min(len(self._pool) * CHUNKS_PER_REPLICA, len(msgs))
+        bounds = [len(msgs) * i // count for i in range(count + 1)]
+        chunks = [msgs[bounds[i]:bounds[i + 1]] for i in range(count)]
+
+        def run(replica, chunk):
+            result = replica.chat(msgs=chunk, **kwargs)
+            if len(chunk) == 1 and isinstance(result, str):
+                return [result]
+            if not isinstance(result, (list, tuple)) or len(result) != len(chunk):
+                raise TypeError("模型副本不支持批量输入")
+            return list(result)
+
+        return [response for chunk in self._pool.map(run, chunks) for response in chunk]
+
+    def close(self):
+        self._pool.close()
+
+
+def replica_count(model):
+    """模型的副本数，普通模型为 1"""
+    return getattr(model, "replica_count", 1) if isinstance(model, ReplicatedModel) else 1
+
+
+class ProcessReplica:
+    """在独立 Python 进程中运行的模型副本
+
+    工作进程启动后在本机随机端口监听，并把端口写到标准输出的第一行；之后的输出转到标准错误。
+    factory_path 中的 factory_name(**factory_kwargs) 返回模型或 (模型, 分词器)。
+    调用 chat 时分词器使用工作进程自己的实例，流式结果在工作进程中拼接为完整文本。
+    size_bytes 为工作进程加载后报告的模型占用，供注册表计入内存预算。
+    """
+
+    def __init__(self, factory_path, factory_name, factory_kwargs=None, env=None, threads=None):
+        from multiprocessing.connection import Client
+
+        authkey = secrets.token_bytes(16)
+        # 认证密钥通过环境变量传递，不出现在进程命令行中
+        worker_env = dict(os.environ, **(env or {}), MINICPM_REPLICA_AUTHKEY=authkey.hex())
+        if threads:
+            worker_env["OMP_NUM_THREADS"] = str(threads)
+        self._process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--worker"],
+            stdout=subprocess.PIPE, env=worker_env
+        )
+        line = self._process.stdout.readline().decode().strip()
+        if not line:
+            self._process.wait()
+            raise RuntimeError(f"模型工作进程启动失败，退出码 {self._process.returncode}")
+        self._conn = Client(("127.0.0.1", int(line)), authkey=authkey)
+        self._lock = threading.Lock()
+        self.size_bytes = self._call("init", str(factory_path), factory_name, factory_kwargs or {}, threads)
+
+    def _call(self, *message):
+        with self._lock:
+            self._conn.send(message)
+            status, value = self._conn.recv()
+        if status == "error":
+            raise value
+        return value
+
+    def chat(self, msgs=None, **kwargs):
+        # 分词器、停止条件与 logits_processor 无法（或无需）跨进程传递
+        kwargs.pop("tokenizer", None)
+        kwargs.pop("stopping_criteria", None)
+        kwargs.pop("logits_processor", None)
+        return self._call("chat", msgs, kwargs)
+
+    def close(self):
+        if self._process.poll() is None:
+            try:
+                with self._lock:
+                    self._conn.send(("close",))
+                self._process.wait(timeout=10)
+            except Exception:
+                self._process.kill()
+        self._conn.close()
+
+
+def spawn_cpu_replicas(count, factory_path, factory_name, factory_kwargs=None):
+    """并行启动 count 个 CPU 工作进程副本，平均分配 CPU 线程"""
+    threads = max(1, (os.cpu_count() or 1) // max(1, count + 1))
+    env = {"CUDA_VISIBLE_DEVICES": ""}
+    replicas = [None] * count
+    errors = []
+
+    def start(index):
+        try:
+            replicas[index] = ProcessReplica(factory_path, factory_name, factory_kwargs, env, threads)
+        except Exception as e:
+            errors.append(e)
+
+    starters = [threading.Thread(target=start, args=(i,)) for i in range(count)]
+    for thread in starters:
+        thread.start()
+    for thread in starters:
+        thread.join()
+    if errors:
+        for replica in replicas:
+            if replica is not None:
+                replica.close()
+        raise errors[0]
+    return replicas
+
+
+def load_pretrained(model_path, torch_dtype="float32", attn_implementation="sdpa", init_vision=True,
+                    init_audio=False, init_tts=False, dynamic_int8=False):
+    """在工作进程中从本地目录加载模型与分词器（CPU）"""
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    model = AutoModelForCausalLM.from_pretrained(
+        str(model_path),
+        trust_remote_code=True,
+        attn_implementation=attn_implementation,
+        torch_dtype=getattr(torch, torch_dtype),
+        init_vision=init_vision,
+        init_audio=init_audio,
+        init_tts=init_tts,
+        device_map="cpu",
+    )
+    model.eval()
+    if dynamic_int8:
+        torch.ao.quantization.quantize_dynamic(model.llm, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    tokenizer = AutoTokenizer.from_pretrained(str(model_path), trust_remote_code=True)
+    return model, tokenizer
+
+
+def _load_factory(factory_path, factory_name):
+    if os.path.abspath(factory_path) == os.path.abspath(__file__):
+        return globals()[factory_name]
+    spec = importlib.util.spec_from_file_location(f"_minicpm_replica_factory_{secrets.token_hex(4)}", factory_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    sys.path.insert(0, os.path.dirname(os.path.abspath(factory_path)))
+    spec.loader.exec_module(module)
+    return getattr(module, factory_name)
+
+
+def _worker_main(authkey):
+    from multiprocessing.connection import Listener
+
+    listener = Listener(("127.0.0.1", 0), authkey=authkey)
+    sys.stdout.write(f"{listener.address[1]}\n")
+    sys.stdout.flush()
+    # 端口之后的输出（包括模型加载日志）写到标准错误，避免填满父进程未读取的管道
+    sys.stdout = sys.stderr
+    conn = listener.accept()
+    model = tokenizer = None
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        command = message[0]
+        if command == "close":
+            return
+        try:
+            if command == "init":
+                _, factory_path, factory_name, factory_kwargs, threads = message
+                if threads:
+                    import torch
+                    torch.set_num_threads(threads)
+                loaded = _load_factory(factory_path, factory_name)(**factory_kwargs)
+                model, tokenizer = loaded if isinstance(loaded, tuple) else (loaded, None)
+                # 注册表模块不使用相对导入，可按文件路径加载
+                estimate = _load_factory(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      "minicpm_o_registry.py"), "estimate_model_bytes")
+                result = estimate(model)
+            elif command == "chat":
+                _, msgs, kwargs = message
+                result = model.chat(msgs=msgs, tokenizer=tokenizer, **kwargs)
+                if not isinstance(result, (str, list, tuple)):
+                    # 流式生成器无法跨进程传递，拼接为完整文本
+                    result = "".join(result)
+            else:
+                raise ValueError(f"未知命令: {command}")
+            conn.send(("ok", result))
+        except Exception as e:
+            try:
+                conn.send(("error", e))
+            except Exception:
+                # 异常对象无法序列化时只传递描述
+                conn.send(("error", RuntimeError(f"{type(e).__name__}: {e}")))
+
+
+if __name__ == "__main__" and sys.argv[1:] == ["--worker"]:
+    _worker_main(bytes.fromhex(os.environ.pop("MINICPM_REPLICA_AUTHKEY")))
@@ -0,0 +1,286 @@
+import threading
+import time
+import weakref
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList
+
+# MiniCPM-o chat 在 sampling=True 时的默认采样参数
+SAMPLING_DEFAULTS = {"temperature": 0.7, "top_p": 0.8, "top_k": 100}
+
+
+def _samples(params):
+    """请求是否使用随机采样（sampling=False 时 MiniCPM-o 改用束搜索）"""
+    return params.get("sampling", True) and params.get("do_sample", True)
+
+
+class _Request:
+    def __init__(self, msgs, params, gather=True, seed=None):
+        self.msgs = msgs
+        self.params = params
+        self.gather = gather
+        self.seed = seed
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+    def group(self, per_request):
+        """批次分组键；per_request 时采样参数与种子由逐行采样器处理，不参与分组"""
+        if per_request and _samples(self.params):
+            params = {name: value for name, value in self.params.items() if name not in SAMPLING_DEFAULTS}
+        else:
+            params = dict(self.params, seed=self.seed)
+        return tuple(sorted((name, repr(value)) for name, value in params.items()))
+
+
+class RequestSampler(LogitsProcessor):
+    """按行使用各请求自己的 temperature/top_p/top_k 与随机数生成器采样
+
+    返回只保留所选 token 的分数，其后的内置采样步骤只能选中该 token；
+    因此每个请求的输出只取决于它自己的参数与种子，与同批的其他请求无关。
+    """
+
+    def __init__(self, params, seeds):
+        self.settings = [{name: row.get(name, default) for name, default in SAMPLING_DEFAULTS.items()} for row in params]
+        self.seeds = list(seeds)
+        self.generators = None
+
+    def _generators(self, device):
+        generators = []
+        for seed in self.seeds:
+            generator = torch.Generator(device=device)
+            if seed is None:
+                generator.seed()
+            else:
+                generator.manual_seed(int(seed))
+            generators.append(generator)
+        return generators
+
+    def __call__(self, input_ids, scores):
+        if self.generators is None:
+            self.generators = self._generators(scores.device)
+        chosen = torch.full_like(scores, float("-inf"))
+        for row, (settings, generator) in enumerate(zip(self.settings, self.generators)):
+            logits = scores[row].float() / max(settings["temperature"], 1e-5)
+            top_k = settings["top_k"]
+            if top_k and top_k < logits.numel():
+                logits[logits < torch.topk(logits, top_k).values[-1]] = float("-inf")
+            top_p = settings["top_p"]
+            if top_p < 1.0:
+                ordered, order = torch.sort(logits, descending=True)
+                cumulative = torch.softmax(ordered, dim=-1).cumsum(dim=-1)
+                # 保留累计概率首次达到 top_p 的 token 及其之前的全部 token
+                drop = cumulative - torch.softmax(ordered, dim=-1) >= top_p
+                logits[order[drop]] = float("-inf")
+            token = torch.multinomial(torch.softmax(logits, dim=-1), 1, generator=generator)
+            chosen[row, token] = 0.0
+        return chosen
+
+
+def seeded_sampling(model, seed, **params):
+    """单次 model.chat 使用独立随机数生成器采样时的参数
+
+    模型已安装生成钩子时返回附带 RequestSampler 的参数，结果只取决于 seed，不受其他线程中同时进行的生成影响；
+    否则原样返回 params，采样仍使用全局随机数生成器。
+    """
+    if not getattr(model, "_minicpm_generation_hooks", False) or not _samples(params):
+        return params
+    sampler = RequestSampler([params], [seed])
+    return dict(params, temperature=1.0, top_p=1.0, logits_processor=LogitsProcessorList([sampler]))
+
+
+class InferenceScheduler:
+    """进程内推理调度器
+
+    各节点通过 submit 提交单个对话，调度器在 max_wait_ms 窗口内收集可合并的请求，
+    合并为一次批量 model.chat 调用，结果通过 Future 返回。模型已安装生成钩子时，
+    temperature/top_p/top_k 与种子不同的请求也可合并，由 RequestSampler 逐行采样；
+    否则只合并参数与种子都相同的请求，并在调度线程中设置种子。调用方没有其他并发请求时以 gather=False 提交，
+    只与已在队列中的请求合并，不再等待窗口。空闲超过 idle_timeout 秒后工作线程退出，
+    下次提交时自动重启。
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=8, max_wait_ms=20, idle_timeout=60.0):
+        try:
+            self._model_ref = weakref.ref(model)
+        except TypeError:
+            self._model_ref = lambda: model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.idle_timeout = idle_timeout
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self.batch_sizes = Counter()
+        self.completed = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self.total_latency = 0.0
+        self._started = time.perf_counter()
+
+    def submit(self, msgs, gather=True, seed=None, **params):
+        """提交一个对话，返回 Future；params 为 model.chat 的采样参数，seed 为该请求的随机种子
+
+        多个独立请求应全部 submit 后再收集结果；gather=False 表示不会有同批的后续请求，不必等待窗口。
+        """
+        # 分词器固定使用调度器绑定的分词器，不参与批次分组
+        params.pop("tokenizer", None)
+        request = _Request(msgs, params, gather, seed)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("推理调度器已关闭")
+            self._queue.append(request)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name="minicpm-scheduler", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return request.future
+
+    def chat(self, msgs, gather=True, seed=None, **params):
+        """同步接口，与 model.chat 一致；单独的同步请求应传 gather=False"""
+        return self.submit(msgs, gather, seed, **params).result()
+
+    def shutdown(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._queue)
+
+    def _per_request(self, model):
+        """能否逐行采样：需要生成钩子传入 logits_processor；多副本模型会切分批次，行号对不上"""
+        return getattr(model, "_minicpm_generation_hooks", False) and getattr(model, "replica_pool", None) is None
+
+    def _next_batch(self):
+        """取出队首请求，并在等待窗口内收集可合并的请求"""
+        model = self._model_ref()
+        per_request = model is not None and self._per_request(model)
+        del model
+        with self._cond:
+            idle_deadline = time.perf_counter() + self.idle_timeout
+            while not self._queue:
+                if self._stopped:
+                    return None
+                remaining = idle_deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._thread = None
+                    return None
+                self._cond.wait(remaining)
+
+            first = self._queue.popleft()
+            batch = [first]
+            group = first.group(per_request)
+            deadline = first.submitted + (self.max_wait if first.gather else 0.0)
+            while len(batch) < self.max_batch_size:
+                matched = [r for r in self._queue if r.group(per_request) == group]
+                for request in matched[:self.max_batch_size - len(batch)]:
+                    self._queue.remove(request)
+                    batch.append(request)
+                # 批次中有不等待窗口的请求时立即执行，不让它陪其他请求等待
+                remaining = deadline - time.perf_counter() if all(r.gather for r in batch) else 0.0
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return batch
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._run(batch)
+
+    def _run(self, batch):
+        model = self._model_ref()
+        if model is None:
+            for request in batch:
+                request.future.set_exception(RuntimeError("模型已被释放"))
+            return
+
+        start = time.perf_counter()
+        per_request = self._per_request(model) and _samples(batch[0].params)
+
+        def call(requests):
+            params = dict(requests[0].params, tokenizer=self.tokenizer)
+            if per_request:
+                # 内置的 temperature/top_p 采样步骤置为恒等，实际采样由 RequestSampler 完成
+                sampler = RequestSampler([request.params for request in requests], [request.seed for request in requests])
+                params.update(temperature=1.0, top_p=1.0, logits_processor=LogitsProcessorList([sampler]))
+            elif requests[0].seed is not None:
+                # 生成在调度线程中执行，种子须在这里设置
+                torch.manual_seed(requests[0].seed)
+            if len(requests) == 1:
+                return model.chat(msgs=requests[0].msgs, **params)
+            return model.chat(msgs=[request.msgs for request in requests], **params)
+
+        results = None
+        if len(batch) > 1:
+            try:
+                responses = call(batch)
+                if isinstance(responses, (list, tuple)) and len(responses) == len(batch):
+                    results = [(True, response) for response in responses]
+            except Exception as e:
+                print(f"批量推理失败，改为逐个推理: {e}")
+
+        if results is None:
+            results = []
+            for request in batch:
+                try:
+                    results.append((True, call([request])))
+                except Exception as e:
+                    results.append((False, e))
+
+        finished = time.perf_counter()
+        with self._cond:
+            self.batch_sizes[len(batch)] += 1
+            self.busy_time += finished - start
+            for request, (ok, _) in zip(batch, results):
+                self.total_latency += finished - request.submitted
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+        for request, (ok, value) in zip(batch, results):
+            if ok:
+                request.future.set_result(value)
+            else:
+                request.future.set_exception(value)
+
+    def stats(self):
+        """返回队列深度、批大小分布与吞吐量"""
+        with self._cond:
+            elapsed = time.perf_counter() - self._started
+            finished = self.completed + self.failed
+            return {
+                "queue_depth": len(self._queue),
+                "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+                "completed": self.completed,
+                "failed": self.failed,
+                "throughput_per_sec": self.completed / elapsed if elapsed > 0 else 0.0,
+                "busy_throughput_per_sec": self.completed / self.busy_time if self.busy_time > 0 else 0.0,
+                "mean_latency": self.total_latency / finished if finished else 0.0,
+            }
+
+
+_SCHEDULERS = weakref.WeakKeyDictionary()
+_SCHEDULERS_LOCK = threading.Lock()
+
+
+def get_scheduler(model, tokenizer, max_batch_size=8, max_wait_ms=20):
+    """返回绑定到指定模型的共享调度器"""
+    with _SCHEDULERS_LOCK:
+        scheduler = _SCHEDULERS.get(model)
+        if scheduler is None or scheduler._stopped:
+            scheduler = InferenceScheduler(model, tokenizer, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+            _SCHEDULERS[model] = scheduler
+        scheduler.max_batch_size = max_batch_size
+        scheduler.max_wait = max_wait_ms / 1000.0
+        return scheduler
@@ -0,0 +1,211 @@
+import re
+import threading
+import time
+
+# 英文句末标点需后接空白，避免把小数点当作句末
+SENTENCE_END = re.compile(r"[.!?](?=\s)|[。！？]")
+
+
+def parse_stop_strings(text):
+    """解析每行一个的停止字符串，支持 \\n 转义"""
+    return [line.replace("\\n", "\n") for line in text.splitlines() if line]
+
+
+def stream_cache_extra(extra, stream_options):
+    """停止条件会截断输出，流式输出时将其追加到缓存键附加项；非流式时原样返回"""
+    if stream_options is None:
+        return extra
+    suffix = f"stop:{stream_options['stop_strings']}:{stream_options['max_sentences']}"
+    return suffix if extra is None else f"{extra}:{suffix}"
+
+
+def _find_stop(text, stop_strings, max_sentences):
+    """返回应截断的位置，未触发停止条件时返回 None"""
+    cut = None
+    for stop in stop_strings:
+        pos = text.find(stop)
+        if pos != -1 and (cut is None or pos < cut):
+            cut = pos
+    if max_sentences > 0:
+        for count, match in enumerate(SENTENCE_END.finditer(text), start=1):
+            if count == max_sentences:
+                if cut is None or match.end() < cut:
+                    cut = match.end()
+                break
+    return cut
+
+
+class _StopFlag:
+    """供 generate 使用的停止标志，被置位后在下一个 token 处结束生成"""
+
+    def __init__(self):
+        self.stopped = False
+
+
+def _stopping_criteria(flag):
+    try:
+        from transformers import StoppingCriteria, StoppingCriteriaList
+    except ImportError:
+        return None
+
+    class FlagCriteria(StoppingCriteria):
+        def __call__(self, input_ids, scores, **kwargs):
+            import torch
+            return torch.full((input_ids.shape[0],), flag.stopped, dtype=torch.bool, device=input_ids.device)
+
+    return StoppingCriteriaList([FlagCriteria()])
+
+
+# 调用线程中暂存的生成参数（stopping_criteria、logits_processor），由 _decode/_decode_stream 取出
+_ACTIVE = threading.local()
+GENERATION_HOOK_KEYS = ("stopping_criteria", "logits_processor")
+
+
+def install_generation_hooks(model):
+    """使 model.chat 的 stopping_criteria 与 logits_processor 参数真正传到生成
+
+    MiniCPM-o 的 chat 只把已知的采样参数传给生成，其余参数会被丢弃；流式生成又在后台线程中运行，
+    读取端停止后生成仍会持续到 max_new_tokens。这里在调用线程中暂存这些参数，
+    由（同样在调用线程中执行、负责调用或启动生成的）_decode 与 _decode_stream 注入生成参数。返回是否已安装。
+    """
+    if getattr(model, "_minicpm_generation_hooks", False):
+        return True
+    decode_stream = getattr(model, "_decode_stream", None)
+    if decode_stream is None:
+        return False
+    chat = model.chat
+
+    def hooked_chat(*args, **kwargs):
+        previous = getattr(_ACTIVE, "kwargs", None)
+        _ACTIVE.kwargs = {key: kwargs.pop(key) for key in GENERATION_HOOK_KEYS if kwargs.get(key) is not None}
+        try:
+            return chat(*args, **kwargs)
+        finally:
+            _ACTIVE.kwargs = previous
+
+    def inject(decode):
+        def hooked_decode(*args, **kwargs):
+            for key, value in (getattr(_ACTIVE, "kwargs", None) or {}).items():
+                kwargs.setdefault(key, value)
+            return decode(*args, **kwargs)
+        return hooked_decode
+
+    model.chat = hooked_chat
+    model._decode_stream = inject(decode_stream)
+    decode = getattr(model, "_decode", None)
+    if decode is not None:
+        model._decode = inject(decode)
+    model._minicpm_generation_hooks = True
+    return True
+
+
+def interrupted():
+    try:
+        import comfy.model_management
+        return comfy.model_management.processing_interrupted()
+    except Exception:
+        return False
+
+
+def is_interrupt_exception(e):
+    """是否为 ComfyUI 的用户取消异常；节点应原样抛出，而不是包装为错误"""
+    try:
+        import comfy.model_management
+        return isinstance(e, comfy.model_management.InterruptProcessingException)
+    except Exception:
+        return False
+
+
+def send_progress_text(text, node_id):
+    if node_id is None:
+        return
+    try:
+        from server import PromptServer
+        send = getattr(PromptServer.instance, "send_progress_text", None)
+        if send is not None:
+            send(text, node_id)
+    except Exception:
+        pass
+
+
+def progress_bar(total):
+    try:
+        import comfy.utils
+        return comfy.utils.ProgressBar(total)
+    except Exception:
+        return None
+
+
+def stream_chat(chat, tokenizer, max_new_tokens, node_id=None, stop_strings=(), max_sentences=0):
+    """以流式方式调用 chat，返回 (完整文本, 性能指标)
+
+    chat 为接受 model.chat 关键字参数的可调用对象。生成过程中逐块推送部分文本到
+    ComfyUI 界面，在 token 之间响应中断，并在命中停止字符串或句数上限时提前结束。
+    模型需已通过 install_generation_hooks 安装钩子，停止时生成线程才会在下一个 token 处结束。
+    """
+    flag = _StopFlag()
+    kwargs = {"stream": True, "tokenizer": tokenizer, "max_new_tokens": max_new_tokens}
+    criteria = _stopping_criteria(flag)
+    if criteria is not None:
+        kwargs["stopping_criteria"] = criteria
+
+    progress = progress_bar(max_new_tokens)
+    start = time.perf_counter()
+    first_token_time = None
+    chunk_count = 0
+    text = ""
+    stopped_by = None
+    cancelled = False
+
+    result = chat(**kwargs)
+    if isinstance(result, str):
+        # 模型不支持流式输出时直接返回完整结果
+        chunks = [result]
+    else:
+        chunks = result
+
+    for chunk in chunks:
+        if first_token_time is None:
+            first_token_time = time.perf_counter() - start
+        text += chunk
+        chunk_count += 1
+
+        cut = _find_stop(text, stop_strings, max_sentences)
+        if cut is not None:
+            text = text[:cut]
+            stopped_by = "stop_condition"
+        if interrupted():
+            stopped_by = "interrupted"
+            cancelled = True
+
+        send_progress_text(text, node_id)
+        if progress is not None:
+            progress.update_absolute(min(chunk_count, max_new_tokens), max_new_tokens)
+
+        if stopped_by is not None:
+            flag.stopped = True
+            break
+
+    if hasattr(chunks, "close"):
+        chunks.close()
+
+    elapsed = time.perf_counter() - start
+    try:
+        tokens = len(tokenizer.encode(text, add_special_tokens=False))
+    except Exception:
+        tokens = len(text.split())
+    decode_time = elapsed - (first_token_time or 0.0)
+    metrics = {
+        "time_to_first_token": first_token_time,
+        "total_time": elapsed,
+        "tokens": tokens,
+        "tokens_per_sec": tokens / decode_time if decode_time > 0 else None,
+        "stopped_by": stopped_by,
+    }
+    print(f"流式生成: 首 token 延迟={first_token_time or 0:.3f}秒, "
+          f"tokens={tokens}, 速度={metrics['tokens_per_sec'] or 0:.2f} tokens/秒")
+
+    if cancelled:
+        import comfy.model_management
+        comfy.model_management.throw_exception_if_processing_interrupted()
+    return text, metrics
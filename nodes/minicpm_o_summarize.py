@@ -0,0 +1,125 @@
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .minicpm_o_cache import RESPONSE_CACHE
+from .minicpm_o_streaming import stream_chat, stream_cache_extra
+
+
+def auto_slice_count(duration, slice_seconds=0, max_slices=64, base_seconds=10.0):
+    """确定 Map-Reduce 模式下的片段数
+
+    slice_seconds > 0 时按固定时长切分；为 0 时片段数随时长的平方根增长
+    （1 分钟约 3 段，30 分钟约 14 段），使生成的 token 总量随视频长度亚线性增长。
+    """
+    if duration <= 0:
+        return 1
+    if slice_seconds > 0:
+        count = math.ceil(duration / slice_seconds)
+    else:
+        count = math.ceil(math.sqrt(duration / base_seconds))
+    return max(1, min(int(count), max_slices))
+
+
+def partition_by_time(indices, total_frames, num_windows, max_per_window):
+    """按帧所在的时间窗口把采样帧分组，每组不超过 max_per_window 帧"""
+    windows = [[] for _ in range(max(1, num_windows))]
+    for index in sorted(indices):
+        windows[min(index * len(windows) // max(1, total_frames), len(windows) - 1)].append(index)
+    slices = []
+    for window in windows:
+        for start in range(0, len(window), max_per_window):
+            slices.append(window[start:start + max_per_window])
+    return slices
+
+
+def format_timestamp(seconds):
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+def format_parts(parts):
+    """把 (起始秒, 结束秒, 文本) 列表格式化为带时间戳的分段文本"""
+    return "\n\n".join(f"[{format_timestamp(start)}-{format_timestamp(end)}] {text.strip()}"
+                       for start, end, text in parts)
+
+
+def ordered_map(fn, items, max_workers=1):
+    """按原顺序返回 fn(item) 的结果，max_workers > 1 时并发执行"""
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(fn, items))
+
+
+def bounded_ordered_map(fn, iterable, max_workers=1):
+    """逐个读取 iterable 并发执行 fn，按原顺序产出结果
+
+    同时进行中的任务不超过 max_workers 个，iterable 为流式解码的帧时内存占用仍有上限。
+    """
+    if max_workers <= 1:
+        for item in iterable:
+            yield fn(item)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def reduce_hierarchically(parts, combine, fan_in=4, max_workers=1):
+    """分层归并分段描述
+
+    每轮把相邻的 fan_in 段合并为一段（combine(group, final=False)），直到不超过 fan_in 段，
+    最后一次调用 combine(group, final=True) 得到最终描述。每次调用的输入长度都以 fan_in 为上限。
+    返回 (最终文本, 各轮段数)。
+    """
+    fan_in = max(2, int(fan_in))
+    rounds = [len(parts)]
+    while len(parts) > fan_in:
+        groups = [parts[i:i + fan_in] for i in range(0, len(parts), fan_in)]
+
+        def merge(group):
+            # 落单的一段无需合并
+            if len(group) == 1:
+                return group[0]
+            return group[0][0], group[-1][1], combine(group, False)
+
+        parts = ordered_map(merge, groups, max_workers)
+        rounds.append(len(parts))
+    return combine(parts, True), rounds
+
+
+def chat_text(model, tokenizer, text, seed, temperature, top_p, max_new_tokens, cache_mode,
+              stream_options=None, scheduler=None, gather=True):
+    """纯文本对话，用于合并分段描述，并按文本内容缓存回答；gather 为 False 表示没有可与之合并批次的并发请求"""
+    def run():
+        messages = [{'role': 'user', 'content': text}]
+        if stream_options is not None:
+            result, _ = stream_chat(
+                lambda **kwargs: model.chat(msgs=messages, temperature=temperature, top_p=top_p, **kwargs),
+                tokenizer, max_new_tokens, **stream_options
+            )
+            return result
+        chat = partial(scheduler.chat, gather=gather, seed=seed) if scheduler is not None else model.chat
+        return chat(
+            msgs=messages,
+            tokenizer=tokenizer,
+            temperature=temperature,
+            top_p=top_p,
+            max_new_tokens=max_new_tokens
+        )
+
+    cache_extra = stream_cache_extra("text", stream_options)
+    cache_key = RESPONSE_CACHE.make_key(model, [], text, seed, temperature, top_p, max_new_tokens,
+                                        extra=cache_extra) \
+        if cache_mode != "Off" else None
+    return RESPONSE_CACHE.cached_chat(cache_mode, cache_key, run)
@@ -1,17 +1,26 @@
 import torch
 from PIL import Image
 import numpy as np
-import os
-import tempfile
-from pathlib import Path
-from decord import VideoReader, cpu  # 使用 decord 替代 OpenCV
-import comfy.model_management
+from functools import partial
+from .minicpm_o_cache import RESPONSE_CACHE, CACHE_MODES
+from .minicpm_o_video_stream import (FrameSliceStream, model_frame_max_side, fit_resolution, open_video,
+                                    video_frame_size)
+from .minicpm_o_memory import load_for_inference, image_crops
+from .minicpm_o_keyframes import uniform_sample, select_keyframes
+from .minicpm_o_streaming import stream_chat, parse_stop_strings, stream_cache_extra, is_interrupt_exception
+from .minicpm_o_scheduler import get_scheduler
+from .minicpm_o_prefix_cache import PREFIX_CACHE, build_messages
+from .minicpm_o_metrics import INSTRUMENTATION, PROFILE_MODES
+from .minicpm_o_summarize import (auto_slice_count, partition_by_time, format_parts, reduce_hierarchically,
+                                  bounded_ordered_map, chat_text)
+from .minicpm_o_replicas import replica_count
+import json
 
 class MiniCPMVideoInference:
     """MiniCPM 视频推理节点"""
     
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("response",)
+    RETURN_TYPES = ("STRING", "STRING", "STRING")
+    RETURN_NAMES = ("response", "frame_info", "metrics")
     FUNCTION = "generate"
     CATEGORY = "MiniCPM-o"
 
@@ -28,6 +37,25 @@ class MiniCPMVideoInference:
 
 请确保描述基于视频中可见的信息，避免推测。描述应足够详细和准确，以便生成与原始视频高度相似的内容。以连续段落格式编写所有内容，不使用分节符或特殊格式。"""
 
+    # Map-Reduce 模式：每个片段的简短描述提示词
+    SLICE_PROMPT = "简要描述这段视频片段：出现的主要人物和物体、发生的动作以及场景变化。只描述可见内容，不超过三句话，输出为纯文本。"
+
+    # Map-Reduce 模式：合并相邻片段描述的提示词
+    REDUCE_PROMPT = """以下是同一段视频中连续片段按时间顺序排列的描述：
+
+{parts}
+
+请将它们合并为一段连贯、简洁的描述，保留关键人物、动作和场景变化的先后顺序，去除重复内容，输出为纯文本。"""
+
+    # Map-Reduce 模式：最后一轮合并，按用户提示词生成最终描述
+    FINAL_REDUCE_PROMPT = """以下是同一段视频按时间顺序排列的分段描述：
+
+{parts}
+
+请把整段视频作为一个整体，根据这些描述完成下面的要求，不要逐段复述：
+
+{prompt}"""
+
     @classmethod
     def INPUT_TYPES(s):
         return {
@@ -44,106 +72,267 @@ class MiniCPMVideoInference:
                 "max_frames": ("INT", {"default": 16, "min": 1, "max": 64, "step": 1}),
                 "sample_fps_divisor": ("INT", {"default": 1, "min": 1, "max": 10, "step": 1}),
                 "max_slice_nums": ("INT", {"default": 2, "min": 1, "max": 4, "step": 1}),
+            },
+            "optional": {
+                "cache_mode": (CACHE_MODES, {"default": "Memory"}),
+                # 解码预读的帧预算，限制峰值内存
+                "frame_budget": ("INT", {"default": 64, "min": 1, "max": 1024, "step": 1}),
+                # 解码后帧的最长边，0 表示根据模型切片配置自动确定，-1 表示保持原始分辨率
+                "frame_max_side": ("INT", {"default": 0, "min": -1, "max": 8192, "step": 8}),
+                # 帧采样方式：固定间隔均匀采样，或基于镜头切换与运动的关键帧选择
+                "sampling_mode": (["Uniform", "Keyframe"], {"default": "Uniform"}),
+                # 流式输出：逐块推送部分文本，可在 token 之间中断，并支持提前停止
+                "streaming": ("BOOLEAN", {"default": False}),
+                "stop_strings": ("STRING", {"multiline": True, "default": ""}),
+                "max_sentences": ("INT", {"default": 0, "min": 0, "max": 100}),
+                # 通过共享调度器提交请求，与其他节点的请求合并为动态批次
+                "use_scheduler": ("BOOLEAN", {"default": False}),
+                # 将提示词放入 system 消息并复用其预填充的 KV 缓存
+                "prefix_cache": ("BOOLEAN", {"default": False}),
+                # 汇总方式：逐片段回答后直接拼接，或先为每个片段生成简短描述再分层合并为一段描述
+                "summary_mode": (["Concatenate", "Map-Reduce"], {"default": "Concatenate"}),
+                # Map-Reduce 模式下每个片段的时长（秒），0 表示按视频时长自动确定片段数
+                "slice_seconds": ("INT", {"default": 0, "min": 0, "max": 3600, "step": 1}),
+                "slice_max_new_tokens": ("INT", {"default": 96, "min": 16, "max": 512}),
+                # 每轮合并的片段数
+                "reduce_fan_in": ("INT", {"default": 4, "min": 2, "max": 16}),
+                # 对本次运行进行性能剖析
+                "profile": (PROFILE_MODES, {"default": "Off"}),
+            },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
             }
         }
 
-    def generate(self, model, tokenizer, video, prompt_mode, prompt, seed, temperature=0.7, top_p=0.9, max_new_tokens=512, max_frames=16, sample_fps_divisor=1, max_slice_nums=2):
+    def sample_frame_indices(self, total_frames, max_frames, sample_fps_divisor, max_slice_nums):
+        """按固定间隔采样帧，超过帧数上限时再均匀采样"""
+        # 计算采样帧
+        sample_interval = sample_fps_divisor
+        sampled_indices = list(range(0, total_frames, sample_interval))
+
+        # 如果采样后的帧数仍然太多，进一步均匀采样
+        if len(sampled_indices) > max_frames * max_slice_nums:
+            sampled_indices = uniform_sample(len(sampled_indices), max_frames * max_slice_nums)
+            sampled_indices = [i * sample_interval for i in sampled_indices]
+
+        # 确保不超过视频总帧数
+        return [i for i in sampled_indices if i < total_frames]
+
+    def select_keyframe_indices(self, video, vr, total_frames, max_frames, sample_fps_divisor, max_slice_nums,
+                                analysis_side=64, decode_batch=64, frame_size=None):
+        """在低分辨率候选帧上打分，将帧预算分配给信息量最大的帧
+
+        返回 (选中的帧索引, 每个选中帧的分数)。
+        """
+        budget = max_frames * max_slice_nums
+        candidates = list(range(0, total_frames, sample_fps_divisor))
+        # 候选帧过多时先均匀抽取，打分开销与视频长度无关
+        max_candidates = max(budget * 8, 256)
+        if len(candidates) > max_candidates:
+            candidates = [candidates[i] for i in uniform_sample(len(candidates), max_candidates)]
+
+        width, height = frame_size or video_frame_size(video, vr)
+        small_width, small_height = fit_resolution(width, height, analysis_side)
+        small_vr = open_video(video, small_width, small_height)
+        frames = np.concatenate([
+            small_vr.get_batch(candidates[i:i + decode_batch]).asnumpy()
+            for i in range(0, len(candidates), decode_batch)
+        ]) if candidates else np.zeros((0, small_height, small_width, 3), dtype=np.uint8)
+        del small_vr
+
+        positions, scores = select_keyframes(frames, budget)
+        indices = [candidates[i] for i in positions]
+        return indices, [round(float(scores[i]), 4) for i in positions]
+
+    def chat_slice(self, model, tokenizer, frames, final_prompt, seed, temperature, top_p, max_new_tokens, cache_mode,
+                   stream_options=None, scheduler=None, prefix_cache=False):
+        """对一个片段的帧调用 model.chat，并按帧内容缓存回答；stream_options 不为 None 时流式生成"""
+        def run():
+            # 转换为PIL图像列表
+            pil_frames = [Image.fromarray(frame) for frame in frames]
+
+            # 构建消息
+            messages = build_messages(pil_frames, final_prompt, prefix_cache)
+
+            if stream_options is not None:
+                text, _ = stream_chat(
+                    lambda **kwargs: model.chat(msgs=messages, temperature=temperature, top_p=top_p, **kwargs),
+                    tokenizer, max_new_tokens, **stream_options
+                )
+                return text
+
+            # 生成回答
+            chat = partial(scheduler.chat, seed=seed) if scheduler is not None else model.chat
+            return chat(
+                msgs=messages,
+                tokenizer=tokenizer,
+                temperature=temperature,
+                top_p=top_p,
+                max_new_tokens=max_new_tokens
+            )
+
+        # 以帧内容为键缓存每个片段的回答，消息格式与停止条件会影响输出，需纳入缓存键
+        cache_extra = stream_cache_extra("prefix" if prefix_cache else None, stream_options)
+        cache_key = RESPONSE_CACHE.make_key(model, [frames], final_prompt, seed, temperature, top_p, max_new_tokens,
+                                            extra=cache_extra) \
+            if cache_mode != "Off" else None
+        return RESPONSE_CACHE.cached_chat(cache_mode, cache_key, run)
+
+    def map_reduce(self, model, tokenizer, stream, slice_times, final_prompt, seed, temperature, top_p,
+                   max_new_tokens, cache_mode, slice_max_new_tokens, reduce_fan_in, stream_options=None,
+                   scheduler=None, prefix_cache=False, metrics=None):
+        """为每个片段生成简短描述，再按 reduce_fan_in 分层合并为一段描述
+
+        启用调度器或模型有多个副本时，片段描述与每轮合并并发提交；
+        同时描述的片段数为 stream.consumers，解码帧占用的内存仍然在帧预算之内。
+        返回 (最终描述, 各片段描述, 各轮段数)。
+        """
+        workers = max(scheduler.max_batch_size if scheduler is not None else 1, replica_count(model))
+
+        def caption(item):
+            i, (slice_indices, frames) = item
+            print(f"描述视频片段 {i+1}/{len(slice_times)}, 帧数: {len(slice_indices)}")
+            return self.chat_slice(model, tokenizer, frames, self.SLICE_PROMPT, seed, temperature, top_p,
+                                   slice_max_new_tokens, cache_mode, None, scheduler, prefix_cache)
+
+        with stream:
+            frames_iter = metrics.timed_iter(stream, "video_io") if metrics is not None else stream
+            captions = list(bounded_ordered_map(caption, enumerate(frames_iter), stream.consumers))
+
+        # 合并轮次的生成长度：中间结果保持简短，最后一轮使用完整的 max_new_tokens
+        reduce_max_new_tokens = min(max_new_tokens, slice_max_new_tokens * 2)
+
+        def combine(parts, final):
+            if final:
+                text = self.FINAL_REDUCE_PROMPT.format(parts=format_parts(parts), prompt=final_prompt)
+                # 最后一轮只有一次调用，提交调度器时不必等待批次窗口
+                return chat_text(model, tokenizer, text, seed, temperature, top_p, max_new_tokens,
+                                 cache_mode, stream_options, scheduler, gather=False)
+            text = self.REDUCE_PROMPT.format(parts=format_parts(parts))
+            return chat_text(model, tokenizer, text, seed, temperature, top_p, reduce_max_new_tokens,
+                             cache_mode, None, scheduler)
+
+        parts = [(start, end, text) for (start, end), text in zip(slice_times, captions)]
+        response, rounds = reduce_hierarchically(parts, combine, reduce_fan_in, workers)
+        print(f"分层合并完成: 各轮段数 {rounds}")
+        return response, captions, rounds
+
+    def generate(self, model, tokenizer, video, prompt_mode, prompt, seed, temperature=0.7, top_p=0.9, max_new_tokens=512, max_frames=16, sample_fps_divisor=1, max_slice_nums=2, cache_mode="Memory", frame_budget=64, frame_max_side=0, sampling_mode="Uniform",
+                 streaming=False, stop_strings="", max_sentences=0, use_scheduler=False, prefix_cache=False,
+                 summary_mode="Concatenate", slice_seconds=0, slice_max_new_tokens=96, reduce_fan_in=4,
+                 profile="Off", unique_id=None):
         """生成回答"""
         try:
             # 设置随机种子
             torch.manual_seed(seed)
             torch.cuda.manual_seed(seed)
+
+            with INSTRUMENTATION.call("MiniCPMVideoInference", model, profile, summary_mode=summary_mode) as metrics:
+                # 加载视频
+                print(f"加载视频: {video}")
+                with metrics.stage("video_io"):
+                    vr = open_video(video)
+                    width, height = video_frame_size(video, vr)
             
-            # 确保模型在推理前已加载到GPU
-            if hasattr(model, 'to') and torch.cuda.is_available():
-                device = torch.device("cuda")
-                # 计算推理所需的内存
-                inference_memory = 1024 * 1024 * 1024  # 假设需要1GB内存用于推理
-                # 确保有足够的显存用于推理
-                comfy.model_management.free_memory(inference_memory, device)
-            
-            # 视频采样函数
-            def uniform_sample(l, n):
-                if n >= l:
-                    return list(range(l))
-                else:
-                    return [i * l // n + l // (2 * n) for i in range(n)]
-            
-            # 加载视频
-            print(f"加载视频: {video}")
-            vr = VideoReader(video, ctx=cpu(0))
-            
-            # 获取视频信息
-            total_frames = len(vr)
-            fps = vr.get_avg_fps()
-            duration = total_frames / fps
-            
-            print(f"视频信息: 总帧数={total_frames}, FPS={fps}, 时长={duration:.2f}秒")
-            
-            # 计算采样帧
-            sample_interval = sample_fps_divisor
-            sampled_indices = list(range(0, total_frames, sample_interval))
-            
-            # 如果采样后的帧数仍然太多，进一步均匀采样
-            if len(sampled_indices) > max_frames * max_slice_nums:
-                sampled_indices = uniform_sample(len(sampled_indices), max_frames * max_slice_nums)
-                sampled_indices = [i * sample_interval for i in sampled_indices]
-            
-            # 确保不超过视频总帧数
-            sampled_indices = [i for i in sampled_indices if i < total_frames]
-            
-            print(f"采样后帧数: {len(sampled_indices)}")
-            
-            # 将采样帧分成多个片段
-            slice_size = min(max_frames, len(sampled_indices) // max_slice_nums + 1)
-            frame_slices = [sampled_indices[i:i+slice_size] for i in range(0, len(sampled_indices), slice_size)]
-            
-            # 根据选择使用模板提示词或用户输入的提示词
-            final_prompt = self.TEMPLATE_PROMPT if prompt_mode == "Use System Preset" else prompt
-            
-            all_responses = []
+                # 获取视频信息
+                total_frames = len(vr)
+                fps = vr.get_avg_fps()
+                if total_frames == 0 or not fps:
+                    raise ValueError(f"视频中没有可解码的帧: {video}")
+                duration = total_frames / fps
             
-            for i, slice_indices in enumerate(frame_slices):
-                print(f"处理视频片段 {i+1}/{len(frame_slices)}, 帧数: {len(slice_indices)}")
-                
-                # 获取该片段的帧
-                frames = vr.get_batch(slice_indices).asnumpy()
-                
-                # 转换为PIL图像列表
-                pil_frames = [Image.fromarray(frame) for frame in frames]
-                
-                # 构建消息
-                messages = [
-                    {
-                        'role': 'user', 
-                        'content': [*pil_frames, final_prompt]
-                    }
-                ]
-                
-                # 生成回答
-                response = model.chat(
-                    msgs=messages,
-                    tokenizer=tokenizer,
-                    temperature=temperature,
-                    top_p=top_p,
-                    max_new_tokens=max_new_tokens
-                )
-                
-                all_responses.append(response)
+                print(f"视频信息: 总帧数={total_frames}, FPS={fps}, 时长={duration:.2f}秒, 分辨率={width}x{height}")
+
+                map_reduce = summary_mode == "Map-Reduce"
+                if map_reduce:
+                    # 片段数由视频时长决定，取代手动设置的 max_slice_nums
+                    max_slice_nums = auto_slice_count(duration, slice_seconds)
+                    print(f"Map-Reduce 模式: {max_slice_nums} 个时间片段")
+
+                with metrics.stage("frame_sampling"):
+                    if sampling_mode == "Keyframe":
+                        sampled_indices, frame_scores = self.select_keyframe_indices(
+                            video, vr, total_frames, max_frames, sample_fps_divisor, max_slice_nums,
+                            frame_size=(width, height))
+                    else:
+                        sampled_indices = self.sample_frame_indices(total_frames, max_frames, sample_fps_divisor, max_slice_nums)
+                        frame_scores = None
             
-            # 合并所有回答
-            final_response = "\n\n".join(all_responses)
+                print(f"采样后帧数: {len(sampled_indices)}")
+                if not sampled_indices:
+                    raise ValueError(f"未能从视频中采样到帧（总帧数 {total_frames}，采样间隔 {sample_fps_divisor}）: {video}")
             
-            # 推理完成后，可以考虑释放一些显存
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+                # 将采样帧分成多个片段
+                if map_reduce:
+                    # 按时间窗口切分，每个片段对应视频中连续的一段
+                    frame_slices = partition_by_time(sampled_indices, total_frames, max_slice_nums, max_frames)
+                else:
+                    slice_size = min(max_frames, len(sampled_indices) // max_slice_nums + 1)
+                    frame_slices = [sampled_indices[i:i+slice_size] for i in range(0, len(sampled_indices), slice_size)]
+                info = {"sampling_mode": sampling_mode, "indices": sampled_indices, "scores": frame_scores}
             
-            return (final_response,)
+                # 根据选择使用模板提示词或用户输入的提示词
+                final_prompt = self.TEMPLATE_PROMPT if prompt_mode == "Use System Preset" else prompt
+
+                # 帧在解码时按最长边缩放
+                max_side = model_frame_max_side(model) if frame_max_side == 0 else max(frame_max_side, 0)
+
+                # 按每个片段的帧数与切片数预留推理显存，由 ComfyUI 加载模型并在需要时卸载其他模型
+                with metrics.stage("model_load"):
+                    load_for_inference(model, images=max(len(s) for s in frame_slices),
+                                       crops=image_crops(model, *fit_resolution(width, height, max_side)),
+                                       max_new_tokens=max(max_new_tokens, slice_max_new_tokens if map_reduce else 0),
+                                       batch_size=get_scheduler(model, tokenizer).max_batch_size if use_scheduler else 1)
+
+                all_responses = []
+                stream_options = {
+                    "node_id": unique_id,
+                    "stop_strings": parse_stop_strings(stop_strings),
+                    "max_sentences": max_sentences,
+                } if streaming else None
+                scheduler = get_scheduler(model, tokenizer) if use_scheduler else None
+                if prefix_cache:
+                    PREFIX_CACHE.prepare(model, tokenizer, self.SLICE_PROMPT if map_reduce else final_prompt)
+
+                # 启用调度器或模型有多个副本时各片段并发推理，流式输出时逐段顺序执行；
+                # 并发推理的片段同样占用帧预算，并发数以帧预算能容纳的片段数为上限
+                workers = max(scheduler.max_batch_size if scheduler is not None else 1, replica_count(model)) \
+                    if map_reduce or stream_options is None else 1
+                largest_slice = max(len(s) for s in frame_slices)
+                consumers = max(1, min(workers, frame_budget // largest_slice))
+
+                # 后台线程解码并缩放帧，与推理重叠
+                stream = FrameSliceStream(video, frame_slices, max_side=max_side, frame_budget=frame_budget, reader=vr,
+                                          consumers=consumers, frame_size=(width, height))
+                del vr
+
+                if map_reduce:
+                    slice_times = [(s[0] / fps, (s[-1] + 1) / fps) for s in frame_slices]
+                    final_response, captions, rounds = self.map_reduce(
+                        model, tokenizer, stream, slice_times, final_prompt, seed, temperature, top_p, max_new_tokens,
+                        cache_mode, slice_max_new_tokens, reduce_fan_in, stream_options, scheduler, prefix_cache, metrics)
+                    info.update({"summary_mode": summary_mode, "slice_times": [[round(a, 2), round(b, 2)] for a, b in slice_times],
+                                 "slice_captions": captions, "reduce_rounds": rounds})
+                else:
+                    def answer(item):
+                        i, (slice_indices, frames) = item
+                        print(f"处理视频片段 {i+1}/{len(frame_slices)}, 帧数: {len(slice_indices)}")
+                        return self.chat_slice(model, tokenizer, frames, final_prompt, seed, temperature, top_p,
+                                               max_new_tokens, cache_mode, stream_options, scheduler,
+                                               prefix_cache)
+
+                    with stream:
+                        frames_iter = metrics.timed_iter(stream, "video_io")
+                        all_responses.extend(bounded_ordered_map(answer, enumerate(frames_iter), stream.consumers))
+
+                    # 合并所有回答
+                    final_response = "\n\n".join(all_responses)
+
+            return (final_response, json.dumps(info, ensure_ascii=False), metrics.to_json())
             
         except Exception as e:
-            # 发生错误时确保清理资源
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+            if is_interrupt_exception(e):
+                raise
             raise RuntimeError(f"处理视频时发生错误: {str(e)}")
 
     @classmethod
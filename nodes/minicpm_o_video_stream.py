@@ -0,0 +1,144 @@
+import queue
+import threading
+
+
+def open_video(video, width=-1, height=-1):
+    """用 decord 打开视频，width/height 大于 0 时按该分辨率解码
+
+    decord 在首次打开视频时才导入，ComfyUI 启动时不加载解码库。
+    """
+    from decord import VideoReader, cpu
+    return VideoReader(video, ctx=cpu(0), width=width, height=height)
+
+
+def video_frame_size(video, reader=None):
+    """返回视频帧的 (宽, 高)，不解码画面
+
+    依次使用读取器自身的 width/height 属性、PyAV 读取的容器元数据（ComfyUI 自带 av），
+    两者都不可用时才解码第一帧。
+    """
+    width, height = getattr(reader, "width", None), getattr(reader, "height", None)
+    if width and height:
+        return int(width), int(height)
+    try:
+        import av
+        with av.open(str(video)) as container:
+            codec = container.streams.video[0].codec_context
+            if codec.width and codec.height:
+                return codec.width, codec.height
+    except ImportError:
+        pass
+    except Exception as e:
+        print(f"读取视频元数据失败，改为解码第一帧获取尺寸: {e}")
+    reader = reader if reader is not None else open_video(video)
+    height, width = reader[0].shape[:2]
+    return width, height
+
+
+def fit_resolution(width, height, max_side):
+    """按最长边缩放，保持宽高比；max_side <= 0 时不缩放"""
+    if max_side <= 0 or max(width, height) <= max_side:
+        return width, height
+    scale = max_side / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def model_frame_max_side(model, default=448 * 3):
+    """根据模型的切片配置推算帧的最长边
+
+    MiniCPM-o 默认最多将一张图切为 3x3 个 scale_resolution 大小的子图，
+    超出该尺寸的像素在模型预处理时会被缩小，因此在解码时直接缩放到该尺寸。
+    """
+    slice_config = getattr(getattr(model, "config", None), "slice_config", None)
+    scale_resolution = getattr(slice_config, "scale_resolution", None)
+    if scale_resolution is None and isinstance(slice_config, dict):
+        scale_resolution = slice_config.get("scale_resolution")
+    return int(scale_resolution) * 3 if scale_resolution else default
+
+
+class _StreamEnd:
+    pass
+
+
+class FrameSliceStream:
+    """后台线程按片段解码视频帧
+
+    解码时直接缩放到目标分辨率，并通过信号量限制已解码、尚未用完的片段数，
+    使第 N+1 个片段的解码与第 N 个片段的推理重叠，峰值内存只取决于 frame_budget。
+    consumers 为同时推理的片段数（如 bounded_ordered_map 的并发数），它们同样计入帧预算。
+    """
+
+    def __init__(self, video, frame_slices, max_side=0, frame_budget=64, reader=None, consumers=1, frame_size=None):
+        self.video = video
+        self.reader = reader
+        self.frame_size = frame_size
+        self.frame_slices = frame_slices
+        self.max_side = max_side
+        self.consumers = max(1, consumers)
+        largest_slice = max((len(s) for s in frame_slices), default=1)
+        # 解码中、排队中与最近取出的片段共 slots 个，另有 consumers - 1 个片段仍在推理，总帧数不超过帧预算
+        self.slots = frame_budget // max(1, largest_slice) - (self.consumers - 1)
+        if self.slots < 1:
+            print(f"警告: 帧预算 {frame_budget} 小于 {self.consumers} 个片段的帧数（每个最多 {largest_slice} 帧），"
+                  f"峰值将达到 {largest_slice * self.consumers} 帧，且解码与推理不再重叠")
+            self.slots = 1
+        self._slots = threading.Semaphore(self.slots)
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def open_reader(self):
+        """打开视频，必要时以缩小后的分辨率解码"""
+        vr = self.reader if self.reader is not None else open_video(self.video)
+        width, height = self.frame_size or video_frame_size(self.video, vr)
+        target_width, target_height = fit_resolution(width, height, self.max_side)
+        if (target_width, target_height) != (width, height):
+            print(f"解码分辨率: {width}x{height} -> {target_width}x{target_height}")
+            vr = open_video(self.video, target_width, target_height)
+        return vr
+
+    def _acquire_slot(self):
+        while not self._stop.is_set():
+            if self._slots.acquire(timeout=0.1):
+                return True
+        return False
+
+    def _worker(self):
+        try:
+            vr = self.open_reader()
+            for slice_indices in self.frame_slices:
+                if not self._acquire_slot():
+                    return
+                frames = vr.get_batch(slice_indices).asnumpy()
+                self._queue.put((slice_indices, frames))
+            self._queue.put(_StreamEnd)
+        except Exception as e:
+            self._queue.put(e)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._worker, name="minicpm-video-decode", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def __iter__(self):
+        taken = False
+        while True:
+            # 取下一个片段时上一个片段才算用完，释放其名额
+            if taken:
+                self._slots.release()
+            item = self._queue.get()
+            if item is _StreamEnd:
+                return
+            if isinstance(item, Exception):
+                raise item
+            taken = True
+            yield item
@@ -0,0 +1,141 @@
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+from .minicpm_o_cache import hash_image, model_identity
+
+
+class VisionEmbeddingCache:
+    """视觉编码结果缓存
+
+    以图像内容哈希为键缓存 vision tower + resampler 的输出（vision_hidden_states），
+    同一张图片配合不同提示词再次调用 model.chat 时直接传入缓存结果，跳过视觉编码。
+    超出内存预算时按 LRU 淘汰；显存紧张时缓存结果保存在 CPU 上，使用时再搬回设备。
+    """
+
+    def __init__(self, max_bytes=1024 * 1024 * 1024, offload_free_vram_bytes=2 * 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.offload_free_vram_bytes = offload_free_vram_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, image):
+        return f"{model_identity(model)}:{hash_image(image)}"
+
+    def _install(self, model):
+        """包装模型的 get_vllm_embedding，以便在当前线程捕获视觉编码结果"""
+        if getattr(model, "_minicpm_vision_cache_installed", False):
+            return True
+        original = getattr(model, "get_vllm_embedding", None)
+        if original is None:
+            return False
+
+        local = self._local
+
+        def get_vllm_embedding(data):
+            result = original(data)
+            captured = getattr(local, "captured", None)
+            if captured is not None and isinstance(result, tuple) and len(result) == 2:
+                captured.append(result[1])
+            return result
+
+        model.get_vllm_embedding = get_vllm_embedding
+        model._minicpm_vision_cache_installed = True
+        return True
+
+    def _should_offload(self, tensor):
+        if not tensor.is_cuda:
+            return False
+        try:
+            free, _ = torch.cuda.mem_get_info(tensor.device)
+        except Exception:
+            return False
+        return free < self.offload_free_vram_bytes
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, hidden_states, device):
+        if not isinstance(hidden_states, torch.Tensor):
+            return
+        hidden_states = hidden_states.detach()
+        if self._should_offload(hidden_states):
+            hidden_states = hidden_states.to("cpu", non_blocking=True)
+        with self._lock:
+            self._entries[key] = (hidden_states, device)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        while self._entries and self.resident_bytes() > self.max_bytes:
+            self._entries.popitem(last=False)
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(t.numel() * t.element_size() for t, _ in self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "resident_bytes": self.resident_bytes(),
+            }
+
+    def chat(self, model, msgs, images, **kwargs):
+        """调用 model.chat，复用已缓存的视觉编码
+
+        msgs 可以是单个对话或对话列表（批量）；images 为每个对话中唯一的那张图片。
+        含多张图片的对话不适用本缓存，应直接调用 model.chat。
+        """
+        if not self._install(model):
+            return model.chat(msgs=msgs, **kwargs)
+
+        keys = [self.make_key(model, image) for image in images]
+        cached = [self.get(key) for key in keys]
+
+        if all(entry is not None for entry in cached):
+            hidden_states = [tensor.to(device, non_blocking=True) for tensor, device in cached]
+            try:
+                return model.chat(msgs=msgs, vision_hidden_states=hidden_states, **kwargs)
+            except TypeError:
+                # 模型的 chat 不接受 vision_hidden_states 时正常推理
+                return model.chat(msgs=msgs, **kwargs)
+
+        self._local.captured = []
+        try:
+            response = model.chat(msgs=msgs, **kwargs)
+            captured = self._local.captured
+        finally:
+            self._local.captured = None
+
+        # 仅在一次 get_vllm_embedding 调用覆盖全部对话时写入缓存
+        if len(captured) == 1 and isinstance(captured[0], (list, tuple)) and len(captured[0]) == len(keys):
+            for key, hidden_states in zip(keys, captured[0]):
+                if isinstance(hidden_states, torch.Tensor):
+                    self.put(key, hidden_states, hidden_states.device)
+        return response
+
+
+# 进程级单例
+VISION_CACHE = VisionEmbeddingCache(
+    max_bytes=int(float(os.environ.get("MINICPM_VISION_CACHE_MB", "1024")) * 1024 * 1024),
+)
@@ -0,0 +1,19 @@
+"""测试使用 benchmarks/standins.py 中的替身模型，在没有 ComfyUI、GPU 与模型权重的环境中运行"""
+import os
+import sys
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+from standins import install_runtime_standins  # noqa: E402
+
+os.environ.setdefault("MINICPM_METRICS_LOG", "0")
+install_runtime_standins()
+
+# 与基准相同，以独立的包名加载节点模块
+if "minicpm_o_nodes" not in sys.modules:
+    _package = types.ModuleType("minicpm_o_nodes")
+    _package.__path__ = [str(ROOT / "nodes")]
+    sys.modules["minicpm_o_nodes"] = _package
@@ -0,0 +1,29 @@
+import json
+
+from standins import StandInModel, StandInTokenizer, synthetic_audio
+
+from minicpm_o_nodes.minicpm_o_audio import MiniCPMAudioInference, join_text, stitch_overlap
+from minicpm_o_nodes.minicpm_o_scheduler import get_scheduler
+
+
+def test_stitch_overlap_removes_repeated_words():
+    assert stitch_overlap("the quick brown fox jumps over", "Fox jumps over the lazy dog") == "the lazy dog"
+    assert stitch_overlap("今天天气很好我们去公园", "我们去公园散步吧") == "散步吧"
+    assert stitch_overlap("one two three", "four five six") == "four five six"
+    assert join_text("你好", "world") == "你好world"
+    assert join_text("hello", "world") == "hello world"
+
+
+def test_map_reduce_through_the_scheduler(tmp_path):
+    audio = synthetic_audio(tmp_path / "talk.wav", 240, 16000, 1)
+    model = StandInModel(latency_ms=1, token_ms=0)
+    text, segments, _ = MiniCPMAudioInference().generate(
+        model, StandInTokenizer(), audio, "Describe", "", 1, cache_mode="Off", summary_mode="Map-Reduce",
+        use_scheduler=True)
+    segments = json.loads(segments)
+    assert text
+    assert sum(s["silent"] for s in segments["segments"]) == 2
+    # 窗口描述合并为批次，调用次数少于窗口数与合并次数之和
+    histogram = get_scheduler(model, StandInTokenizer()).stats()["batch_size_histogram"]
+    assert max(histogram) > 1
+    assert model.calls < len(segments["segments"])
@@ -0,0 +1,68 @@
+import wave
+
+import numpy as np
+import pytest
+
+from minicpm_o_nodes import minicpm_o_audio_stream as audio_stream
+from minicpm_o_nodes.minicpm_o_audio_stream import AudioWindowStream, _resampled, iter_windows, open_audio
+
+RATE = 16000
+
+
+def _write_wav(path, samples, width, rate=RATE):
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(width)
+        f.setframerate(rate)
+        if width == 3:
+            ints = np.round(samples * (2 ** 23 - 1)).astype("<i4")
+            data = ints.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+        elif width == 1:
+            data = np.round(samples * 127 + 128).astype(np.uint8).tobytes()
+        else:
+            data = np.round(samples * (2 ** (width * 8 - 1) - 1)).astype({2: "<i2", 4: "<i4"}[width]).tobytes()
+        f.writeframes(data)
+    return str(path)
+
+
+@pytest.mark.parametrize("width", [1, 2, 3, 4])
+def test_pcm_widths_decode_with_wave(tmp_path, width):
+    samples = 0.5 * np.sin(np.linspace(0, 200, RATE * 2)).astype(np.float32)
+    blocks, backend = open_audio(_write_wav(tmp_path / f"a{width}.wav", samples, width), 1.0)
+    assert backend == "wave"
+    decoded = np.concatenate(list(blocks))
+    assert len(decoded) == len(samples)
+    assert np.abs(decoded - samples).max() < 2.0 / 2 ** (width * 8 - 1) + 1e-6
+
+
+def test_unsupported_wav_falls_through(tmp_path, monkeypatch):
+    path = _write_wav(tmp_path / "a.wav", np.zeros(RATE, dtype=np.float32), 2)
+    monkeypatch.setattr(audio_stream, "WAVE_SAMPLE_WIDTHS", (1,))
+    monkeypatch.setattr(audio_stream.shutil, "which", lambda name: None)
+    _, backend = open_audio(path)
+    assert backend != "wave"
+
+
+def test_resampler_is_continuous_across_blocks():
+    pytest.importorskip("soxr")
+    x = np.random.default_rng(0).standard_normal(100000).astype(np.float32)
+    one = np.concatenate(list(_resampled([x], 44100, RATE)))
+    streamed = np.concatenate(list(_resampled(np.array_split(x, 7), 44100, RATE)))
+    assert len(one) == len(streamed) == round(len(x) * RATE / 44100)
+    assert np.abs(one - streamed).max() < 1e-5
+
+
+def test_windows_overlap_and_cover_the_tail():
+    blocks = [np.ones(RATE * 25, dtype=np.float32)] * 3
+    windows = list(iter_windows(iter(blocks), RATE * 30, RATE * 27, RATE // 2))
+    assert [start // RATE for start, _, _ in windows] == [0, 27, 54]
+    assert len(windows[-1][1]) == RATE * 21
+
+
+def test_window_stream(tmp_path):
+    samples = np.concatenate([np.zeros(RATE * 30), 0.3 * np.ones(RATE * 40)]).astype(np.float32)
+    with AudioWindowStream(_write_wav(tmp_path / "s.wav", samples, 2), 30, 3) as stream:
+        windows = list(stream)
+    assert stream.backend == "wave"
+    assert [(round(a), round(b)) for a, b, _, _ in windows] == [(0, 30), (27, 57), (54, 70)]
+    assert windows[0][3] < -90 < windows[1][3]
@@ -0,0 +1,52 @@
+import sqlite3
+
+from minicpm_o_nodes.minicpm_o_cache import ResponseCache
+
+
+def _rows(path):
+    with sqlite3.connect(str(path)) as conn:
+        return conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+def test_disk_layer_is_trimmed_to_its_limit(tmp_path):
+    path = tmp_path / "responses.sqlite"
+    cache = ResponseCache(max_memory_entries=4, max_disk_entries=5, disk_path=path)
+    for i in range(12):
+        cache.put(f"k{i}", f"v{i}", use_disk=True)
+    # 覆盖写入不增加行数
+    cache.put("k11", "again", use_disk=True)
+    assert _rows(path) == 5
+    assert cache.stats()["disk_entries"] == 5
+    assert cache.get("k11", use_disk=True) == "again"
+    assert cache.get("k0", use_disk=True) is None
+
+
+def test_disk_count_is_restored_on_reopen(tmp_path):
+    path = tmp_path / "responses.sqlite"
+    first = ResponseCache(max_disk_entries=3, disk_path=path)
+    for i in range(3):
+        first.put(f"k{i}", f"v{i}", use_disk=True)
+
+    second = ResponseCache(max_disk_entries=3, disk_path=path)
+    second.put("k3", "v3", use_disk=True)
+    assert _rows(path) == 3
+    assert second.stats()["disk_entries"] == 3
+
+
+def test_identity_separates_load_options():
+    from standins import StandInModel
+
+    from minicpm_o_nodes.minicpm_o_cache import model_identity
+    from minicpm_o_nodes.minicpm_o_registry import ModelRegistry
+
+    plain, quantized, untagged = StandInModel(), StandInModel(), StandInModel()
+    # dynamic int8 与 float32 模型的 dtype 相同，只有加载键不同
+    plain._minicpm_load_key = ModelRegistry.make_key("/models/MiniCPM-o-2_6", "cpu", "torch.float32", "sdpa",
+                                                     ["vision"], options=("none", [], True, ""))
+    quantized._minicpm_load_key = ModelRegistry.make_key("/models/MiniCPM-o-2_6", "cpu", "torch.float32", "sdpa",
+                                                         ["vision"], options=("dynamic int8 (CPU)", [], True, ""))
+    identities = {model_identity(plain), model_identity(quantized), model_identity(untagged)}
+    assert len(identities) == 3
+    assert model_identity(plain) == model_identity(plain)
+    keys = {ResponseCache.make_key(model, [], "describe", 0, 0.7, 0.9, 64) for model in (plain, quantized)}
+    assert len(keys) == 2
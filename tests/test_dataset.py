@@ -0,0 +1,119 @@
+import json
+import os
+
+import numpy as np
+from PIL import Image
+from standins import StandInModel, StandInTokenizer
+
+from minicpm_o_nodes.minicpm_o_dataset import (CaptionState, MiniCPMDatasetCaptioner, list_images, run_hash,
+                                               sidecar_paths, write_sidecar)
+
+
+def _image(path, value=0):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.fromarray(np.full((8, 8, 3), value, dtype=np.uint8)).save(path)
+    return path
+
+
+def test_run_hash_covers_prefix_cache():
+    model = StandInModel()
+    plain = run_hash(model, "describe", 0, 0.7, 0.9, 512)
+    assert run_hash(model, "describe", 0, 0.7, 0.9, 512, prefix_cache=False) == plain
+    assert run_hash(model, "describe", 0, 0.7, 0.9, 512, prefix_cache=True) != plain
+
+
+def test_manifest_paths_are_relative_to_the_manifest(tmp_path):
+    absolute = _image(tmp_path / "elsewhere" / "c.png")
+    manifest = tmp_path / "set" / "manifest.jsonl"
+    manifest.parent.mkdir()
+    manifest.write_text("\n".join([
+        json.dumps({"file": "a.png"}),
+        "",
+        json.dumps({"image": "sub/b.jpg"}),
+        json.dumps({"path": str(absolute)}),
+        json.dumps({"caption": "no image field"}),
+    ]), encoding="utf-8")
+
+    files, root = list_images(str(manifest))
+    assert root == manifest.parent
+    assert files == [manifest.parent / "a.png", manifest.parent / "sub" / "b.jpg", absolute]
+
+
+def test_directory_and_glob_sources(tmp_path):
+    a = _image(tmp_path / "a.png")
+    b = _image(tmp_path / "sub" / "b.jpg")
+    (tmp_path / "notes.txt").write_text("not an image")
+
+    assert list_images(str(tmp_path)) == ([a, b], tmp_path)
+    files, root = list_images(str(tmp_path / "**" / "*.jpg"))
+    assert files == [b]
+    assert root == b.parent
+
+
+def test_checkpoint_resume_and_skip(tmp_path):
+    image = _image(tmp_path / "a.png")
+    checkpoint = tmp_path / "captions.jsonl"
+    state = CaptionState(checkpoint)
+    size, mtime = CaptionState._signature(image)
+    record = {"file": "a.png", "caption": "first", "hash": "h1", "size": size, "mtime": mtime}
+    state.append([record])
+    state.append([dict(record, caption="second")])
+    state.close(compact=False)
+    # 崩溃时留下的不完整的最后一行被忽略
+    with open(checkpoint, "a", encoding="utf-8") as f:
+        f.write('{"file": "b.png", "capt')
+
+    resumed = CaptionState(checkpoint)
+    assert resumed.records["a.png"]["caption"] == "second"
+    assert "b.png" not in resumed.records
+    assert resumed.is_done("a.png", image, "h1")
+    assert not resumed.is_done("a.png", image, "h2")
+    assert not resumed.is_done("b.png", image, "h1")
+
+    # 图像修改后重新描述
+    os.utime(image, (mtime + 10, mtime + 10))
+    assert not resumed.is_done("a.png", image, "h1")
+
+    resumed.close()
+    lines = checkpoint.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["caption"] for line in lines] == ["second"]
+
+
+def test_sidecars_do_not_collide(tmp_path):
+    png, jpg, other = tmp_path / "a.png", tmp_path / "a.JPG", tmp_path / "b.png"
+    sidecars = sidecar_paths([png, jpg, other])
+    assert sidecars == {png: tmp_path / "a.png.txt", jpg: tmp_path / "a.JPG.txt", other: tmp_path / "b.txt"}
+
+    write_sidecar(sidecars[png], "one")
+    write_sidecar(sidecars[jpg], "two")
+    assert (tmp_path / "a.png.txt").read_text(encoding="utf-8") == "one"
+    assert (tmp_path / "a.JPG.txt").read_text(encoding="utf-8") == "two"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.JPG.txt", "a.png.txt"]
+
+
+def test_second_run_skips_completed_images(tmp_path):
+    for i, name in enumerate(["a.png", "a.jpg", "b.png"]):
+        _image(tmp_path / name, value=40 * i)
+    model = StandInModel(latency_ms=0, token_ms=0)
+    node = MiniCPMDatasetCaptioner()
+
+    def run(**kwargs):
+        summary, = node.caption(model, StandInTokenizer(), str(tmp_path), "Use System Preset", "", 1,
+                                batch_size=2, cache_mode="Off", **kwargs)
+        return json.loads(summary)
+
+    first = run()
+    assert (first["captioned"], first["skipped"]) == (3, 0)
+    assert sorted(p.name for p in tmp_path.glob("*.txt")) == ["a.jpg.txt", "a.png.txt", "b.txt"]
+    records = CaptionState(tmp_path / "captions.jsonl").records
+    assert sorted(records) == ["a.jpg", "a.png", "b.png"]
+    assert (tmp_path / "b.txt").read_text(encoding="utf-8") == records["b.png"]["caption"]
+
+    calls = model.calls
+    second = run()
+    assert (second["captioned"], second["skipped"]) == (0, 3)
+    assert model.calls == calls
+
+    # 采样参数改变后运行哈希不同，全部重新描述
+    third = run(temperature=0.5)
+    assert (third["captioned"], third["skipped"]) == (3, 0)
@@ -0,0 +1,21 @@
+import json
+
+from standins import StandInModel, StandInTokenizer, synthetic_images
+
+from minicpm_o_nodes.minicpm_o_image_analyzer import MiniCPMImageAnalyzer
+from minicpm_o_nodes.minicpm_o_streaming import install_generation_hooks
+
+
+def test_concurrent_analyses_use_seeded_samplers():
+    model = StandInModel(latency_ms=1, token_ms=0)
+    install_generation_hooks(model)
+    images = synthetic_images(3, 64, 64).split(1)
+    *results, timings, metrics = MiniCPMImageAnalyzer().analyze(
+        model, StandInTokenizer(), *images, 5, execution_mode="Concurrent", cache_mode="Off", vision_cache=False)
+    assert all(results)
+    # 三项分析各自带有由 seed 确定的采样器，合并步骤在主线程中使用全局随机数生成器
+    samplers = [kwargs["logits_processor"][0] for kwargs in model.decode_kwargs if "logits_processor" in kwargs]
+    assert len(samplers) == 3
+    assert all(sampler.seeds == [5] for sampler in samplers)
+    assert "metrics" not in json.loads(timings)
+    assert isinstance(json.loads(metrics), dict)
@@ -0,0 +1,29 @@
+import comfy.model_management
+import pytest
+from standins import StandInModel, StandInTokenizer, synthetic_audio, synthetic_video
+
+from minicpm_o_nodes.minicpm_o_audio import MiniCPMAudioInference
+from minicpm_o_nodes.minicpm_o_video import MiniCPMVideoInference
+
+
+@pytest.fixture
+def interrupted(monkeypatch):
+    def throw():
+        raise comfy.model_management.InterruptProcessingException()
+
+    monkeypatch.setattr(comfy.model_management, "processing_interrupted", lambda: True)
+    monkeypatch.setattr(comfy.model_management, "throw_exception_if_processing_interrupted", throw)
+
+
+def test_video_interrupt_is_not_wrapped(interrupted):
+    with pytest.raises(comfy.model_management.InterruptProcessingException):
+        MiniCPMVideoInference().generate(StandInModel(latency_ms=0, token_ms=0), StandInTokenizer(),
+                                         synthetic_video(64, 64, 30), "Use System Preset", "", 1,
+                                         cache_mode="Off", streaming=True)
+
+
+def test_audio_interrupt_is_not_wrapped(interrupted, tmp_path):
+    audio = synthetic_audio(tmp_path / "speech.wav", 60, 16000, 1, silence_every=0)
+    with pytest.raises(comfy.model_management.InterruptProcessingException):
+        MiniCPMAudioInference().generate(StandInModel(latency_ms=0, token_ms=0), StandInTokenizer(), audio,
+                                         "Transcribe", "", 1, cache_mode="Off")
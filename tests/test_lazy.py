@@ -0,0 +1,54 @@
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from minicpm_o_nodes.minicpm_o_lazy import LazyModalityModel
+from minicpm_o_nodes.minicpm_o_registry import MODEL_REGISTRY
+
+
+class _Config:
+    init_tts = False
+
+
+class _Model(torch.nn.Module):
+    """只有语言模型主干、TTS 子模块延迟构建的最小模型"""
+
+    def __init__(self):
+        super().__init__()
+        self.llm = torch.nn.Module()
+        self.llm.embed_tokens = torch.nn.Embedding(16, 8)
+        self.llm.get_input_embeddings = lambda: self.llm.embed_tokens
+        self.config = _Config()
+        self.tts = None
+
+    def init_tts_module(self):
+        return torch.nn.Linear(8, 32)
+
+
+def _lazy(tmp_path, tensors):
+    save_file(tensors, str(tmp_path / "model.safetensors"))
+    return LazyModalityModel(_Model(), tmp_path)
+
+
+def test_attach_loads_weights_and_updates_registry_size(tmp_path):
+    weight, bias = torch.randn(32, 8), torch.randn(32)
+    model = _lazy(tmp_path, {"tts.weight": weight, "tts.bias": bias})
+    MODEL_REGISTRY.acquire("lazy-test", lambda: (model, None))
+    try:
+        before = MODEL_REGISTRY.stats()["entries"][-1]["size_bytes"]
+        model.ensure("tts")
+        assert torch.equal(model.tts.weight, weight)
+        assert MODEL_REGISTRY.stats()["entries"][-1]["size_bytes"] == before + (32 * 8 + 32) * 4
+
+        model.unload("tts")
+        assert MODEL_REGISTRY.stats()["entries"][-1]["size_bytes"] == before
+    finally:
+        MODEL_REGISTRY.evict("lazy-test")
+
+
+def test_missing_weights_raise_and_leave_nothing_attached(tmp_path):
+    model = _lazy(tmp_path, {"tts.weight": torch.randn(32, 8), "llm.x": torch.zeros(1)})
+    with pytest.raises(RuntimeError, match="tts.bias"):
+        model.ensure("tts")
+    assert model.loaded_modalities() == []
+    assert model.config.init_tts is False
@@ -0,0 +1,95 @@
+import pytest
+import torch
+
+transformers = pytest.importorskip("transformers")
+
+from minicpm_o_nodes.minicpm_o_memory import _get_patcher_class, _module_bytes, patcher_compatible  # noqa: E402
+
+# 测试环境没有显卡：以带序号的 cpu:0 作为计算设备，与卸载设备 cpu 区分，放置与记账逻辑和显卡上相同
+LOAD = torch.device("cpu", 0)
+OFFLOAD = torch.device("cpu")
+INPUT = torch.tensor([[3, 9, 14, 27, 5, 11]])
+
+
+class _Model(torch.nn.Module):
+    """与 MiniCPM-o 相同，语言模型位于 llm 属性，解码层为 llm.model.layers"""
+
+    def __init__(self, layers=4):
+        super().__init__()
+        torch.manual_seed(0)
+        config = transformers.Qwen2Config(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=layers,
+                                          num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=64)
+        self.llm = transformers.Qwen2ForCausalLM(config).eval()
+
+    @property
+    def dtype(self):
+        return torch.float32
+
+    def logits(self):
+        with torch.no_grad():
+            return self.llm(INPUT).logits
+
+
+@pytest.fixture
+def patched():
+    model = _Model()
+    reference = model.logits()
+    size = _module_bytes(model)
+    model.model_loaded_weight_memory = size
+    patcher = _get_patcher_class()(model, load_device=LOAD, offload_device=OFFLOAD, size=size)
+    layer = _module_bytes(model.llm.model.layers[0])
+    resident = size - 4 * layer
+    return model, patcher, reference, resident, layer
+
+
+def test_lowvram_load_streams_layers_and_keeps_output(patched):
+    model, patcher, reference, resident, layer = patched
+    # 预算可放下一个解码层与两层搬运余量
+    patcher.load(LOAD, lowvram_model_memory=resident + 3 * layer)
+    streamer = model._minicpm_layer_streamer
+    assert len(streamer.layers) == 3
+    assert patcher.loaded_size() == resident + 3 * layer
+    assert patcher.current_loaded_device() == LOAD
+    assert model.model_lowvram
+
+    for _ in range(3):
+        assert torch.equal(model.logits(), reference)
+    # 每次前向每个卸载层只拷贝一次，不回拷；第一次之后的拷贝全部来自预取
+    assert streamer.transfers == 3 * 3 + 1
+    assert streamer.prefetch_hits == 3 * 3 - 1
+
+
+def test_partial_unload_and_load_update_bookkeeping(patched):
+    model, patcher, reference, resident, layer = patched
+    patcher.load(LOAD, full_load=True)
+    assert patcher.loaded_size() == resident + 4 * layer
+    assert not model.model_lowvram
+
+    freed = patcher.partially_unload(OFFLOAD, memory_to_free=2 * layer)
+    assert freed >= 2 * layer
+    assert patcher.loaded_size() == resident + 4 * layer - freed
+    assert model.model_lowvram
+    assert torch.equal(model.logits(), reference)
+
+    gained = patcher.partially_load(LOAD, extra_memory=freed)
+    assert gained == freed
+    assert model._minicpm_layer_streamer is None
+    assert not model.model_lowvram
+    assert torch.equal(model.logits(), reference)
+
+    patcher.unpatch_model(OFFLOAD, unpatch_weights=True)
+    assert patcher.loaded_size() == 0
+    assert patcher.current_loaded_device() == OFFLOAD
+    assert torch.equal(model.logits(), reference)
+
+
+def test_incompatible_model_patcher_is_not_overridden():
+    class _OldPatcher:
+        def load(self, device_to=None, lowvram_model_memory=0, force_patch_weights=False, full_load=False):
+            pass
+
+        def partially_unload(self, device_to, extra_memory=0):
+            pass
+
+    assert not patcher_compatible(_OldPatcher)
+    assert patcher_compatible(_get_patcher_class().__mro__[1])
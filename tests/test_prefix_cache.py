@@ -0,0 +1,83 @@
+import warnings
+
+import pytest
+import torch
+
+transformers = pytest.importorskip("transformers")
+
+from minicpm_o_nodes.minicpm_o_prefix_cache import PrefixKVCache  # noqa: E402
+
+PREFIX = torch.arange(3, 13)
+FULL = torch.cat([PREFIX, torch.tensor([20, 21, 22, 23, 24, 25])])
+
+
+class _Model:
+    """只有 llm 属性的替身，llm 为随机初始化的小型 Qwen2（MiniCPM-o 的语言模型结构）"""
+
+    def __init__(self):
+        torch.manual_seed(0)
+        config = transformers.Qwen2Config(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                          num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=128)
+        self.llm = transformers.Qwen2ForCausalLM(config).eval()
+        self.prefill_lengths = []
+        self.llm.model.register_forward_pre_hook(self._record, with_kwargs=True)
+
+    def _record(self, module, args, kwargs):
+        embeds = kwargs.get("inputs_embeds")
+        self.prefill_lengths.append(embeds.shape[1] if embeds is not None else kwargs["input_ids"].shape[1])
+
+    def generate(self):
+        """与 MiniCPM-o 相同，以 inputs_embeds 与 attention_mask 调用 llm.generate，返回 (输出, 预填充长度)"""
+        self.prefill_lengths.clear()
+        embeds = self.llm.get_input_embeddings()(FULL.unsqueeze(0)).detach()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            output = self.llm.generate(inputs_embeds=embeds, attention_mask=torch.ones(1, len(FULL), dtype=torch.long),
+                                       max_new_tokens=5, do_sample=False, pad_token_id=0)
+        return output, self.prefill_lengths[0]
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = PrefixKVCache()
+    monkeypatch.setattr(cache, "_prefix_ids", lambda tokenizer, instruction: PREFIX)
+    return cache
+
+
+def test_hit_shortens_prefill_and_keeps_output(cache):
+    model = _Model()
+    reference, full_length = model.generate()
+    assert full_length == len(FULL)
+
+    assert cache.prepare(model, None, "system prompt")
+    for _ in range(2):
+        output, length = model.generate()
+        assert length == len(FULL) - len(PREFIX)
+        assert torch.equal(output, reference)
+    assert cache.stats()["hits"] == 2
+
+
+def test_failure_disables_with_a_warning(cache, capsys):
+    model = _Model()
+    reference, _ = model.generate()
+    cache.prepare(model, None, "system prompt")
+    generate = model.llm.generate
+
+    def reject_cache(*args, past_key_values=None, **kwargs):
+        if past_key_values is not None:
+            raise ValueError("inputs_embeds with a cache is not supported")
+        return generate(*args, **kwargs)
+
+    # 模拟不支持续接缓存的 transformers 版本
+    model.llm.generate = reject_cache
+    del model.llm._minicpm_prefix_cache_installed
+    cache._install(model.llm)
+
+    output, length = model.generate()
+    assert torch.equal(output, reference)
+    assert length == len(FULL)
+    assert "警告" in capsys.readouterr().out
+    stats = cache.stats()
+    assert stats["disabled_models"] == 1
+    assert "ValueError" in stats["last_error"]
+    assert stats["hits"] == 0
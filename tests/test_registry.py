@@ -0,0 +1,98 @@
+import warnings
+
+import torch
+
+from minicpm_o_nodes.minicpm_o_registry import ModelRegistry, estimate_model_bytes
+
+
+class _Model(torch.nn.Module):
+    def __init__(self, width=256):
+        super().__init__()
+        self.llm = torch.nn.Sequential(torch.nn.Linear(width, width), torch.nn.Linear(width, width))
+
+
+def test_estimate_counts_dynamic_int8_weights():
+    model = _Model()
+    float_bytes = estimate_model_bytes(model)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        llm = model.llm
+        torch.ao.quantization.quantize_dynamic(model.llm, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    assert model.llm is llm
+    quantized_bytes = estimate_model_bytes(model)
+    # int8 权重约为 float32 的四分之一，偏置仍为 float32
+    weights = 2 * 256 * 256
+    assert quantized_bytes >= weights
+    assert quantized_bytes < float_bytes / 3
+
+
+def test_registry_size_reflects_quantization():
+    registry = ModelRegistry()
+
+    def factory():
+        model = _Model()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            torch.ao.quantization.quantize_dynamic(model.llm, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        return model, None
+
+    registry.acquire("q", factory)
+    assert registry.stats()["entries"][0]["size_bytes"] >= 2 * 256 * 256
+
+
+def _factory(size):
+    return lambda: (torch.nn.Linear(size, size, bias=False), None)
+
+
+def test_only_the_latest_idle_model_is_kept_without_budget():
+    registry = ModelRegistry()
+    registry.acquire("a", _factory(8))
+    registry.acquire("a", _factory(8))
+    registry.release("a")
+    registry.release("a")
+    assert registry.stats()["resident_models"] == 1
+
+    # 加载节点在 A、B 两组选项之间切换：先获取新模型再释放旧模型
+    registry.acquire("b", _factory(8))
+    registry.acquire("a", _factory(8))
+    registry.release("b")
+    assert registry.stats()["misses"] == 2
+
+    registry.acquire("c", _factory(8))
+    registry.release("a")
+    assert [entry["key"] for entry in registry.stats()["entries"]] == ["a", "c"]
+    assert registry.stats()["evictions"] == 1
+
+
+def test_budget_keeps_idle_models_until_exceeded():
+    registry = ModelRegistry(memory_budget_bytes=3 * 64 * 64 * 4)
+    for key in ("a", "b"):
+        registry.acquire(key, _factory(64))
+        registry.release(key)
+    assert registry.stats()["resident_models"] == 2
+
+    registry.acquire("c", _factory(64))
+    registry.acquire("d", _factory(64))
+    assert [entry["key"] for entry in registry.stats()["entries"]] == ["b", "c", "d"]
+
+    # 预算改回 0 表示不限制，只保留最近的空闲模型
+    registry.acquire("e", _factory(64))
+    registry.release("e")
+    registry.set_memory_budget(0)
+    assert registry.memory_budget_bytes is None
+    assert [entry["key"] for entry in registry.stats()["entries"]] == ["c", "d", "e"]
+
+
+def test_node_budget_requests_take_the_minimum():
+    registry = ModelRegistry(memory_budget_bytes=100)
+    registry.request_memory_budget("loader1", 300)
+    registry.request_memory_budget("loader2", 200)
+    assert registry.memory_budget_bytes == 200
+    # 再次执行的节点不会覆盖另一个节点的设置
+    registry.request_memory_budget("loader1", 300)
+    assert registry.memory_budget_bytes == 200
+
+    registry.request_memory_budget("loader2", 0)
+    assert registry.memory_budget_bytes == 300
+    registry.request_memory_budget("loader1", 0)
+    assert registry.memory_budget_bytes == 100
@@ -0,0 +1,61 @@
+from pathlib import Path
+
+import pytest
+import torch
+from standins import StandInModel
+
+from minicpm_o_nodes.minicpm_o_registry import estimate_model_bytes
+from minicpm_o_nodes.minicpm_o_replicas import ReplicatedModel, spawn_cpu_replicas
+
+STANDINS = Path(__file__).resolve().parent.parent / "benchmarks" / "standins.py"
+
+
+def _conversations(count):
+    return [[{"role": "user", "content": f"describe frame {i}"}] for i in range(count)]
+
+
+@pytest.fixture
+def workers():
+    replicas = spawn_cpu_replicas(2, STANDINS, "StandInModel", {"latency_ms": 1, "token_ms": 0})
+    yield replicas
+    for replica in replicas:
+        replica.close()
+
+
+def test_cpu_workers_return_results_in_order_and_steal(workers):
+    # 进程内副本远慢于工作进程，先完成的工作进程应从它的队列中窃取
+    slow = StandInModel(latency_ms=300, token_ms=0)
+    model = ReplicatedModel([slow] + workers, ["main", "worker1", "worker2"])
+    msgs = _conversations(12)
+
+    responses = model.chat(msgs=msgs, max_new_tokens=16)
+
+    reference = StandInModel(latency_ms=0, token_ms=0)
+    assert responses == [reference.chat(msgs=conversation, max_new_tokens=16) for conversation in msgs]
+    stats = model.replica_pool.stats()
+    assert stats["worker1"]["stolen"] + stats["worker2"]["stolen"] > 0
+    assert stats["main"]["completed"] < 4
+    assert sum(entry["completed"] for entry in stats.values()) == 12
+
+    model.close()
+    assert all(worker._process.poll() is not None for worker in workers)
+
+
+def test_worker_errors_are_raised_in_the_caller(workers):
+    with pytest.raises(TypeError):
+        workers[0].chat(msgs=None)
+    # 出错后工作进程仍可继续处理请求
+    assert isinstance(workers[0].chat(msgs=_conversations(1)[0]), str)
+    assert isinstance(workers[0].size_bytes, int)
+
+
+def test_replicated_size_counts_every_replica():
+    replicas = [torch.nn.Linear(64, 64), torch.nn.Linear(64, 64)]
+    single = estimate_model_bytes(replicas[0])
+
+    class _Worker:
+        size_bytes = 1000
+
+    model = ReplicatedModel(replicas + [_Worker()])
+    assert estimate_model_bytes(model) == 2 * single + 1000
+    model.close()
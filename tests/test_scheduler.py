@@ -0,0 +1,109 @@
+import threading
+import time
+
+import torch
+from standins import StandInModel, StandInTokenizer
+
+from minicpm_o_nodes.minicpm_o_scheduler import InferenceScheduler, RequestSampler, _Request
+from minicpm_o_nodes.minicpm_o_streaming import install_generation_hooks
+
+PARAMS = {"temperature": 0.7, "top_p": 0.9, "max_new_tokens": 16}
+
+
+def _messages(i):
+    return [{"role": "user", "content": f"request {i}"}]
+
+
+def test_concurrent_submits_become_one_batch():
+    model = StandInModel(latency_ms=1, token_ms=0)
+    scheduler = InferenceScheduler(model, StandInTokenizer(), max_batch_size=8, max_wait_ms=200)
+    try:
+        futures = [scheduler.submit(_messages(i), **PARAMS) for i in range(6)]
+        results = [future.result(timeout=5) for future in futures]
+        assert model.calls == 1
+        assert model.conversations == 6
+        assert results == [model.chat(msgs=_messages(i), **PARAMS) for i in range(6)]
+        assert scheduler.stats()["batch_size_histogram"] == {6: 1}
+    finally:
+        scheduler.shutdown()
+
+
+def test_concurrent_chat_threads_share_a_batch():
+    model = StandInModel(latency_ms=1, token_ms=0)
+    scheduler = InferenceScheduler(model, StandInTokenizer(), max_batch_size=4, max_wait_ms=200)
+    results = [None] * 4
+
+    def call(i):
+        results[i] = scheduler.chat(_messages(i), **PARAMS)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(4)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=5)
+        assert model.calls == 1
+        assert all(results)
+    finally:
+        scheduler.shutdown()
+
+
+def test_different_params_are_not_batched():
+    model = StandInModel(latency_ms=1, token_ms=0)
+    scheduler = InferenceScheduler(model, StandInTokenizer(), max_batch_size=8, max_wait_ms=50)
+    try:
+        futures = [scheduler.submit(_messages(i), **dict(PARAMS, temperature=0.1 * (i % 2 + 1))) for i in range(4)]
+        [future.result(timeout=5) for future in futures]
+        assert model.calls == 2
+    finally:
+        scheduler.shutdown()
+
+
+def test_mixed_sampling_params_batch_with_a_request_sampler():
+    model = StandInModel(latency_ms=1, token_ms=0)
+    install_generation_hooks(model)
+    scheduler = InferenceScheduler(model, StandInTokenizer(), max_batch_size=8, max_wait_ms=200)
+    try:
+        futures = [scheduler.submit(_messages(i), seed=i, **dict(PARAMS, temperature=0.1 * (i + 1))) for i in range(4)]
+        [future.result(timeout=5) for future in futures]
+        assert model.calls == 1
+        sampler = model.decode_kwargs[-1]["logits_processor"][0]
+        assert [settings["temperature"] for settings in sampler.settings] == [0.1 * (i + 1) for i in range(4)]
+        assert sampler.seeds == [0, 1, 2, 3]
+        assert model.decode_kwargs[-1]["temperature"] == 1.0
+    finally:
+        scheduler.shutdown()
+
+
+def test_request_sampler_rows_do_not_depend_on_the_batch():
+    torch.manual_seed(0)
+    scores = torch.randn(3, 50)
+    target = _Request(_messages(0), {"temperature": 0.9, "top_p": 0.8, "top_k": 20}, seed=7)
+
+    def sample(requests, rows):
+        sampler = RequestSampler([request.params for request in requests], [request.seed for request in requests])
+        return [sampler(None, rows).argmax(dim=-1).tolist() for _ in range(5)]
+
+    alone = sample([target], scores[:1])
+    others = [_Request(_messages(i), {"temperature": 1.5}, seed=i) for i in range(2)]
+    batched = sample([others[0], target, others[1]], scores[[1, 0, 2]])
+    assert [row[0] for row in alone] == [row[1] for row in batched]
+
+
+def test_lone_request_skips_the_wait_window():
+    model = StandInModel(latency_ms=0, token_ms=0)
+    # 等待窗口远长于测试超时：只有跳过窗口的请求才能按时完成
+    scheduler = InferenceScheduler(model, StandInTokenizer(), max_batch_size=8, max_wait_ms=60000)
+    try:
+        assert scheduler.submit(_messages(0), gather=False, **PARAMS).result(timeout=30)
+
+        waiting = scheduler.submit(_messages(1), **PARAMS)
+        time.sleep(0.05)
+        assert not waiting.done()
+        # 不等待窗口的请求会带走已在队列中的同组请求
+        lone = scheduler.submit(_messages(2), gather=False, **PARAMS)
+        assert waiting.result(timeout=30) and lone.result(timeout=30)
+        assert model.calls == 2
+        assert scheduler.stats()["batch_size_histogram"] == {1: 1, 2: 1}
+    finally:
+        scheduler.shutdown()
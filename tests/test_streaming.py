@@ -0,0 +1,55 @@
+import time
+
+from standins import StandInModel, StandInTokenizer
+
+from minicpm_o_nodes.minicpm_o_streaming import install_generation_hooks, stream_cache_extra, stream_chat
+
+MESSAGES = [{"role": "user", "content": "describe"}]
+
+
+def _stream(model, stop_after):
+    words = model._answer(MESSAGES, 512)
+    text, metrics = stream_chat(lambda **kwargs: model.chat(msgs=MESSAGES, **kwargs), StandInTokenizer(), 512,
+                                stop_strings=[" " + " ".join(words[stop_after:stop_after + 2])])
+    return words, text, metrics
+
+
+def test_stop_condition_ends_generation():
+    model = StandInModel(latency_ms=0, token_ms=2, tokens=64)
+    assert install_generation_hooks(model)
+    words, text, metrics = _stream(model, 5)
+    assert metrics["stopped_by"] == "stop_condition"
+    assert text == " ".join(words[:5])
+
+    # 等待停止时正在生成的 token 完成
+    time.sleep(0.05)
+    produced = model.generated_tokens
+    time.sleep(0.1)
+    # 停止后生成线程不再产出 token
+    assert model.generated_tokens == produced
+    # 生成线程可能比消费端多产出几个 token，但远少于完整回答
+    assert produced < 16 < len(words)
+
+
+def test_without_hooks_generation_runs_to_the_end():
+    model = StandInModel(latency_ms=0, token_ms=1, tokens=64)
+    words, _, metrics = _stream(model, 5)
+    assert metrics["stopped_by"] == "stop_condition"
+    time.sleep(len(words) * 0.001 + 0.2)
+    assert model.generated_tokens == len(words)
+
+
+def test_hooks_install_once():
+    model = StandInModel()
+    assert install_generation_hooks(model)
+    chat = model.chat
+    assert install_generation_hooks(model)
+    assert model.chat is chat
+
+
+def test_cache_extra_only_carries_stop_options_when_streaming():
+    options = {"stop_strings": ["\n"], "max_sentences": 2}
+    assert stream_cache_extra(None, None) is None
+    assert stream_cache_extra("prefix", None) == "prefix"
+    assert stream_cache_extra(None, options) == "stop:['\\n']:2"
+    assert stream_cache_extra("text", options) == "text:stop:['\\n']:2"
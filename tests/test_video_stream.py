@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+from standins import StandInModel, StandInTokenizer, SyntheticVideoReader, synthetic_video
+
+from minicpm_o_nodes.minicpm_o_video import MiniCPMVideoInference
+from minicpm_o_nodes.minicpm_o_video_stream import FrameSliceStream, video_frame_size
+
+
+class _CountingReader(SyntheticVideoReader):
+    """记录已解码、尚未被消费者用完的帧数峰值"""
+
+    def __init__(self, uri):
+        super().__init__(uri)
+        self.lock = threading.Lock()
+        self.held = 0
+        self.peak = 0
+
+    def get_batch(self, indices):
+        with self.lock:
+            self.held += len(indices)
+            self.peak = max(self.peak, self.held)
+        return super().get_batch(indices)
+
+    def done(self, count):
+        with self.lock:
+            self.held -= count
+
+
+def _consume(budget, slice_size, consumers=1, slices=12):
+    reader = _CountingReader(synthetic_video(32, 32, slices * slice_size))
+    frame_slices = [list(range(i * slice_size, (i + 1) * slice_size)) for i in range(slices)]
+    stream = FrameSliceStream(None, frame_slices, frame_budget=budget, reader=reader, consumers=consumers)
+    in_flight = []
+    with stream:
+        for indices, frames in stream:
+            assert len(frames) == slice_size
+            in_flight.append(len(indices))
+            # 模拟推理耗时，解码线程有机会预读
+            time.sleep(0.01)
+            if len(in_flight) >= consumers:
+                reader.done(in_flight.pop(0))
+    return stream, reader.peak
+
+
+def test_budget_smaller_than_three_slices_is_respected():
+    stream, peak = _consume(budget=20, slice_size=8)
+    assert stream.slots == 2
+    assert peak <= 20
+
+
+def test_concurrent_consumers_count_against_the_budget():
+    stream, peak = _consume(budget=32, slice_size=8, consumers=3)
+    assert stream.slots == 2
+    assert peak <= 32
+
+
+def test_budget_below_one_slice_warns_and_serialises(capsys):
+    stream, peak = _consume(budget=4, slice_size=8)
+    assert "警告" in capsys.readouterr().out
+    assert stream.slots == 1
+    assert peak == 8
+
+
+class _NoDecodeReader(SyntheticVideoReader):
+    def __getitem__(self, index):
+        raise AssertionError("读取尺寸时不应解码画面")
+
+    def get_batch(self, indices):
+        raise AssertionError("读取尺寸时不应解码画面")
+
+
+def test_frame_size_does_not_decode():
+    assert video_frame_size(None, _NoDecodeReader(synthetic_video(1920, 1080, 10))) == (1920, 1080)
+
+
+def test_frame_size_falls_back_to_the_first_frame():
+    class _PlainReader:
+        def __getitem__(self, index):
+            return SyntheticVideoReader(synthetic_video(320, 240, 1))[index]
+
+    assert video_frame_size(synthetic_video(320, 240, 1), _PlainReader()) == (320, 240)
+
+
+@pytest.mark.parametrize("mode", ["Concatenate", "Map-Reduce"])
+def test_empty_video_reports_a_clear_error(mode):
+    with pytest.raises(RuntimeError, match="视频中没有可解码的帧"):
+        MiniCPMVideoInference().generate(StandInModel(latency_ms=0, token_ms=0), StandInTokenizer(),
+                                         synthetic_video(64, 64, 0), "Use System Preset", "", 1,
+                                         cache_mode="Off", summary_mode=mode)